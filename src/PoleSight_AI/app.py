@@ -22,7 +22,7 @@ import matplotlib.patches as patches
 import rasterio
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 
-from tms2geotiff import download_extent, save_image_auto
+from tms2geotiff import download_extent, save_image_auto, save_reprojected, TileCache, TileServer
 import tempfile
 
 # Enable GDAL exceptions
@@ -42,6 +42,20 @@ def load_model():
 
 model = load_model()
 
+# Tiles are cached on disk so repeated downloads of the same bounds are free
+@st.cache_resource
+def load_tile_cache():
+    return TileCache(os.path.join(tempfile.gettempdir(), "polesight_tile_cache.sqlite"))
+
+# Downloaded imagery is also kept in an MBTiles file that a local tile server
+# serves to the map, so panning over it doesn't hit Esri again
+TILE_MBTILES = os.path.join(tempfile.gettempdir(), "polesight_tiles.mbtiles")
+ESRI_TILES = "https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}"
+
+@st.cache_resource
+def load_tile_server():
+    return TileServer(TILE_MBTILES, upstream=ESRI_TILES).start()
+
 # Function to detect poles
 def detect_poles(image_path, confidence_threshold=0.8):
     image = Image.open(image_path).convert("RGB")
@@ -190,11 +204,16 @@ def tms_download(bounds, zoom=17, output_path="high_res_extent.tif"):
             source = "https://services.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
 
             lat0=lat0, lon0=lon0, lat1=lat1, lon1=lon1,
-            zoom=zoom, save_image=True
+            zoom=zoom, save_image=True,
+            mbtiles=TILE_MBTILES,
+            engine="async", concurrency=16, max_concurrency=64,
+            cache=load_tile_cache()
         )
 
         # Save the GeoTIFF temporarily or to a user-specified path
-        save_image_auto(image, output_path, matrix)
+        save_image_auto(image, output_path, matrix, cog=True)
+        # Reproject while the mosaic is still in memory
+        save_reprojected(image, output_path.replace(".tif", "_4326.tif"), matrix, 4326)
         render_geotiff_with_context(output_path)
         return output_path
 
@@ -255,30 +274,32 @@ def reproject_and_render_geotiff(output_path, target_crs="EPSG:4326"):
     reprojected_path = output_path.replace(".tif", "_4326.tif")
     
     try:
-        # Step 1: Reproject the GeoTIFF
-        with rasterio.open(output_path) as src:
-            transform, width, height = calculate_default_transform(
-                src.crs, target_crs, src.width, src.height, *src.bounds
-            )
-            kwargs = src.meta.copy()
-            kwargs.update({
-                'crs': target_crs,
-                'transform': transform,
-                'width': width,
-                'height': height
-            })
-
-            with rasterio.open(reprojected_path, 'w', **kwargs) as dst:
-                for i in range(1, src.count + 1):
-                    reproject(
-                        source=rasterio.band(src, i),
-                        destination=rasterio.band(dst, i),
-                        src_transform=src.transform,
-                        src_crs=src.crs,
-                        dst_transform=transform,
-                        dst_crs=target_crs,
-                        resampling=Resampling.nearest
-                    )
+        # Step 1: Reproject the GeoTIFF, unless tms_download already did
+        if not (os.path.exists(reprojected_path) and
+                os.path.getmtime(reprojected_path) >= os.path.getmtime(output_path)):
+            with rasterio.open(output_path) as src:
+                transform, width, height = calculate_default_transform(
+                    src.crs, target_crs, src.width, src.height, *src.bounds
+                )
+                kwargs = src.meta.copy()
+                kwargs.update({
+                    'crs': target_crs,
+                    'transform': transform,
+                    'width': width,
+                    'height': height
+                })
+
+                with rasterio.open(reprojected_path, 'w', **kwargs) as dst:
+                    for i in range(1, src.count + 1):
+                        reproject(
+                            source=rasterio.band(src, i),
+                            destination=rasterio.band(dst, i),
+                            src_transform=src.transform,
+                            src_crs=src.crs,
+                            dst_transform=transform,
+                            dst_crs=target_crs,
+                            resampling=Resampling.nearest
+                        )
         
         # Step 2: Plot the reprojected GeoTIFF
         with rasterio.open(reprojected_path) as src:
@@ -385,7 +406,7 @@ m = folium.Map(location=map_center, zoom_start=17, tiles="")
 
 # Add a tile layer for satellite imagery
 tile_layer = folium.TileLayer(
-    tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
+    tiles=load_tile_server().url,
     attr='Esri',
     name='Esri Satellite',
     overlay=False,
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Compare the PIL paste_tile compositor with the NumPy TileMosaic.
+
+Builds a grid of synthetic tiles (opaque RGB, RGBA with partial alpha and
+fully transparent overlay tiles), composites them with both, crops the
+result to a fractional extent and prints the timings:
+
+    python bench_compositor.py --tiles 4096
+"""
+
+import io
+import os
+import sys
+import math
+import time
+import random
+import argparse
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tms2geotiff  # noqa: E402
+
+
+def synthetic_tiles(count, mode, seed=0):
+    rng = random.Random(seed)
+    side = math.ceil(math.sqrt(count))
+    tiles = {}
+    for i in range(count):
+        x, y = i % side, i // side
+        if mode == 'RGBA' and rng.random() < 0.5:
+            im = Image.new('RGBA', (256, 256))
+        else:
+            color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+            im = Image.new(mode, (256, 256), color + ((255,) if mode == 'RGBA' else ()))
+            if mode == 'RGBA':
+                im.paste((0, 0, 0, 0), (0, 0, 128, 256))
+        buf = io.BytesIO()
+        im.save(buf, 'PNG', compress_level=1)
+        tiles[(x, y)] = buf.getvalue()
+    bbox = (0, 0, side, math.ceil(count / side))
+    return tiles, bbox
+
+
+def bench_pil(tiles, bbox, extent):
+    start = time.perf_counter()
+    bigim = None
+    base_size = [256, 256]
+    for xy, tile in tiles.items():
+        bigim = tms2geotiff.paste_tile(bigim, base_size, tile, xy, bbox)
+    x2, y2, imgw, imgh = tms2geotiff.crop_window(*extent, bbox, base_size)
+    retim = bigim.crop((x2, y2, x2+imgw, y2+imgh))
+    if retim.mode == 'RGBA' and retim.getextrema()[3] == (255, 255):
+        retim = retim.convert('RGB')
+    bigim.close()
+    return time.perf_counter() - start, retim.size
+
+
+def bench_numpy(tiles, bbox, extent):
+    start = time.perf_counter()
+    mosaic = tms2geotiff.TileMosaic(bbox)
+    for xy, tile in tiles.items():
+        mosaic.paste(tile, xy)
+    view = mosaic.crop(*extent)
+    im = tms2geotiff.array_to_image(view)
+    return time.perf_counter() - start, im.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tiles", type=int, default=2048)
+    args = parser.parse_args()
+    for mode in ('RGB', 'RGBA'):
+        tiles, bbox = synthetic_tiles(args.tiles, mode)
+        extent = (bbox[0] + 0.3, bbox[1] + 0.6, bbox[2] - 0.4, bbox[3] - 0.2)
+        pil_time, pil_size = bench_pil(tiles, bbox, extent)
+        np_time, np_size = bench_numpy(tiles, bbox, extent)
+        assert pil_size == np_size
+        print("%s %d tiles: paste_tile %.2fs (%.0f tiles/s), TileMosaic %.2fs "
+              "(%.0f tiles/s), %.1fx" % (
+                  mode, len(tiles), pil_time, len(tiles) / pil_time,
+                  np_time, len(tiles) / np_time, pil_time / np_time))
+
+
+if __name__ == '__main__':
+    main()
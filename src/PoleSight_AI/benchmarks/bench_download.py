@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Benchmark download_extent against a local synthetic tile server.
+
+Runs every combination of tile count, tile format, MBTiles on/off and
+output format, each in a fresh process so peak RSS is per scenario, and
+prints the results as JSON:
+
+    python bench_download.py --tiles 1000 --formats png --latency 0.02 \\
+        --jitter 0.02 --error-rate 0.01 -o baseline.json
+
+Stage times are the Telemetry stage totals (HTTP requests, decoding,
+compositing and MBTiles writes), summed over the pipeline's threads, so
+they overlap each other and the download time; "save" is the image saver.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import tempfile
+import itertools
+import multiprocessing
+import concurrent.futures
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'tests'))
+import tms2geotiff  # noqa: E402
+from fake_tile_server import FakeTileServer  # noqa: E402
+
+CENTER = (34.4265, -117.4281)
+ZOOM = 18
+OUTPUTS = ('none', 'tif', 'cog', 'jpg', 'stream')
+
+
+def scenario_extent(count, zoom=ZOOM):
+    """An extent around CENTER covering at least `count` whole tiles."""
+    side = math.ceil(math.sqrt(count))
+    rows = math.ceil(count / side)
+    x, y = map(math.floor, tms2geotiff.deg2num(*CENTER, zoom))
+    x -= side // 2
+    y -= rows // 2
+    lat0, lon0 = tms2geotiff.num2deg(x + 0.5, y + 0.5, zoom)
+    lat1, lon1 = tms2geotiff.num2deg(x + side - 0.5, y + rows - 0.5, zoom)
+    return (lat0, lon0, lat1, lon1), side * rows
+
+
+def quiet(progress, total, done=False):
+    pass
+
+
+def run_scenario(scenario):
+    """Run one scenario; called in a fresh worker process."""
+    telemetry = tms2geotiff.Telemetry()
+    workdir = scenario['workdir']
+    name = '%(tiles)d_%(format)s_%(output)s' % scenario
+    mbtiles = None
+    if scenario['mbtiles']:
+        mbtiles = os.path.join(workdir, name + '.mbtiles')
+    output = scenario['output']
+    out_file = os.path.join(workdir, name + ('.jpg' if output == 'jpg' else '.tif'))
+    start = time.perf_counter()
+    img, matrix = tms2geotiff.download_extent(
+        scenario['source'], *scenario['extent'], ZOOM, mbtiles,
+        save_image=output not in ('none', 'stream'), progress_callback=quiet,
+        stream_to=out_file if output == 'stream' else None,
+        engine=scenario['engine'], concurrency=scenario['concurrency'],
+        max_concurrency=scenario['max_concurrency'], as_array=True,
+        telemetry=telemetry)
+    download = time.perf_counter() - start
+    summary = telemetry.summary()
+    timers = {name: stage['total'] for name, stage in summary['stages'].items()
+              if name in ('http', 'decode', 'composite', 'db')}
+    if output in ('tif', 'cog', 'jpg'):
+        start = time.perf_counter()
+        tms2geotiff.save_image_auto(img, out_file, matrix, cog=(output == 'cog'))
+        timers['save'] = time.perf_counter() - start
+    del img
+    for filename in (mbtiles, out_file):
+        if filename and os.path.exists(filename):
+            os.remove(filename)
+    return {
+        'seconds': round(download, 3),
+        'tiles_per_s': round(scenario['tiles'] / download, 1),
+        'peak_rss_mb': round((tms2geotiff.peak_rss() or 0) / 1024 / 1024, 1),
+        'stages': {k: round(v, 3) for k, v in sorted(timers.items())},
+        'queues': summary['queues'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tiles", type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument("--formats", nargs='+', choices=('png', 'jpg'),
+                        default=['png', 'jpg'])
+    parser.add_argument("--outputs", nargs='+', choices=OUTPUTS, default=list(OUTPUTS))
+    parser.add_argument("--mbtiles", choices=('both', 'yes', 'no'), default='both')
+    parser.add_argument("--engine", choices=('thread', 'async'), default='async')
+    parser.add_argument("-c", "--concurrency", type=int)
+    parser.add_argument("--max-concurrency", type=int)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--max-mosaic-mb", type=int, default=4096,
+        help="skip in-memory outputs whose mosaic would be larger (default 4096)")
+    parser.add_argument("-o", "--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    mbtiles_options = {'both': (False, True), 'yes': (True,), 'no': (False,)}
+    results = []
+    ctx = multiprocessing.get_context('spawn')
+    with FakeTileServer(latency=args.latency, jitter=args.jitter,
+                        error_rate=args.error_rate) as server, \
+            tempfile.TemporaryDirectory() as workdir:
+        for count, fmt, mbtiles, output in itertools.product(
+                args.tiles, args.formats, mbtiles_options[args.mbtiles], args.outputs):
+            extent, tiles = scenario_extent(count)
+            scenario = {
+                'tiles': tiles, 'format': fmt, 'mbtiles': mbtiles,
+                'output': output, 'engine': args.engine,
+            }
+            if (output not in ('none', 'stream') and
+                    tiles * 256 * 256 * 3 > args.max_mosaic_mb * 1024 * 1024):
+                results.append(dict(scenario, skipped='mosaic too large'))
+                continue
+            requests, errors = server.requests, server.errors
+            job = dict(
+                scenario, extent=extent, workdir=workdir,
+                source=server.url.replace('.png', '.' + fmt),
+                concurrency=args.concurrency, max_concurrency=args.max_concurrency)
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=ctx) as pool:
+                result = pool.submit(run_scenario, job).result()
+            result['requests'] = server.requests - requests
+            result['server_errors'] = server.errors - errors
+            results.append(dict(scenario, **result))
+            print("%(tiles)d %(format)s mbtiles=%(mbtiles)s %(output)s: "
+                  "%(tiles_per_s).0f tiles/s, %(peak_rss_mb).0f MB" % results[-1],
+                  file=sys.stderr)
+    report = {
+        'server': {'latency': args.latency, 'jitter': args.jitter,
+                   'error_rate': args.error_rate},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
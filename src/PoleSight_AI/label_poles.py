@@ -5,6 +5,17 @@ import json
 import uuid
 from datetime import datetime
 import os
+import tempfile
+
+from tms2geotiff import TileServer
+
+# Serve imagery saved by app.py from the local MBTiles file, Esri elsewhere
+@st.cache_resource
+def load_tile_server():
+    return TileServer(
+        os.path.join(tempfile.gettempdir(), "polesight_tiles.mbtiles"),
+        upstream="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
+    ).start()
 
 # Initialize session state
 if "session_id" not in st.session_state:
@@ -39,7 +50,7 @@ with col1:
     m = folium.Map(
         location=[34.4265, -117.428113],
         zoom_start=17,
-        tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
+        tiles=load_tile_server().url,
         attr='Esri'
     )
 
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+A local XYZ tile server that renders deterministic synthetic tiles.
+
+Used by the tests to exercise the fetch engines offline, and handy for
+measuring throughput by hand:
+
+    python fake_tile_server.py --port 8000 --latency 0.05
+    python ../tms2geotiff.py -s "http://127.0.0.1:8000/{z}/{x}/{y}.png" ...
+"""
+
+import io
+import re
+import sys
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from PIL import Image
+
+re_tile_path = re.compile(r'^/(\d+)/(\d+)/(\d+)\.(png|jpg)$')
+
+
+def render_tile(z, x, y, fmt='png', size=256):
+    color = ((x * 37) % 256, (y * 59) % 256, (z * 11) % 256)
+    im = Image.new('RGB', (size, size), color)
+    for i in range(0, size, 8):
+        im.putpixel((i, i), (255, 255, 255))
+    buf = io.BytesIO()
+    im.save(buf, 'PNG' if fmt == 'png' else 'JPEG')
+    return buf.getvalue()
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        match = re_tile_path.match(self.path)
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            server.peak_in_flight = max(server.peak_in_flight, server.in_flight)
+            overloaded = (server.capacity is not None and
+                          server.in_flight > server.capacity)
+        try:
+            delay, failed = server.draw()
+            if match and server.stalled:
+                tile = tuple(map(int, match.groups()[:3]))
+                with server.lock:
+                    if tile in server.stalled:
+                        server.stalled.discard(tile)
+                        delay += server.stall
+            if delay:
+                time.sleep(delay)
+            if failed:
+                with server.lock:
+                    server.errors += 1
+                self.send_error(500)
+                return
+            if overloaded:
+                with server.lock:
+                    server.throttled += 1
+                self.send_response(429)
+                self.send_header('Retry-After', str(server.retry_after))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_tile(match)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def send_tile(self, match):
+        server = self.server
+        if not match:
+            self.send_error(404)
+            return
+        z, x, y = map(int, match.groups()[:3])
+        if (z, x, y) in server.missing:
+            self.send_error(404)
+            return
+        etag = '"%d-%d-%d"' % (z, x, y)
+        if self.headers.get('If-None-Match') == etag:
+            with server.lock:
+                server.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = render_tile(z, x, y, match.group(4), server.tile_size)
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header(
+            'Content-Type', 'image/png' if match.group(4) == 'png' else 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTileServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, missing=(),
+                 tile_size=256, capacity=None, retry_after=1, jitter=0.0,
+                 error_rate=0.0, seed=0, stall_rate=0.0, stall=5.0, stalled=()):
+        super().__init__((host, port), TileHandler)
+        self.latency = latency
+        # up to `jitter` extra seconds per request, and random 500 errors
+        self.jitter = jitter
+        self.error_rate = error_rate
+        # a `stall_rate` fraction of requests takes `stall` more seconds
+        self.stall_rate = stall_rate
+        self.stall = stall
+        # and so does the first request for each of these (z, x, y) tiles
+        self.stalled = set(stalled)
+        self.random = random.Random(seed)
+        self.errors = 0
+        self.missing = set(missing)
+        self.tile_size = tile_size
+        # answer 429 with Retry-After above this many concurrent requests
+        self.capacity = capacity
+        self.retry_after = retry_after
+        self.requests = 0
+        self.not_modified = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def draw(self):
+        """Return (delay, failed) for the next request."""
+        with self.lock:
+            delay = self.latency
+            if self.jitter:
+                delay += self.random.uniform(0, self.jitter)
+            if self.stall_rate and self.random.random() < self.stall_rate:
+                delay += self.stall
+            failed = bool(self.error_rate) and self.random.random() < self.error_rate
+        return delay, failed
+
+    def handle_error(self, request, client_address):
+        # clients hang up on cancelled and hedged requests
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return 'http://%s:%d/{z}/{x}/{y}.png' % self.server_address[:2]
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic XYZ tiles.")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0,
+        help="seconds to wait before answering each request")
+    parser.add_argument("--jitter", type=float, default=0.0,
+        help="up to this many extra seconds of random latency")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+        help="fraction of requests answered with 500")
+    parser.add_argument("--stall-rate", type=float, default=0.0,
+        help="fraction of requests that stall")
+    parser.add_argument("--stall", type=float, default=5.0,
+        help="extra seconds a stalled request takes (default 5)")
+    parser.add_argument("--capacity", type=int,
+        help="answer 429 above this many concurrent requests")
+    args = parser.parse_args()
+    server = FakeTileServer(args.host, args.port, args.latency,
+                            capacity=args.capacity, jitter=args.jitter,
+                            error_rate=args.error_rate, stall_rate=args.stall_rate,
+                            stall=args.stall)
+    print("Serving %s" % server.url)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1145 @@
+import os
+import json
+import math
+import itertools
+import re
+import sqlite3
+import sys
+import time
+import concurrent.futures
+
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tms2geotiff  # noqa: E402
+from fake_tile_server import FakeTileServer, render_tile  # noqa: E402
+
+
+SOURCE = 'http://tiles.invalid/{z}/{x}/{y}.png'
+EXTENT = (34.4230, -117.4330, 34.4300, -117.4230)
+
+
+@pytest.fixture
+def fake_tiles(monkeypatch):
+    """Serve synthetic tiles from get_tile without touching the network."""
+    requested = []
+
+    def get_tile(url, *args, **kwargs):
+        z, x, y = map(int, re.findall(r'/(\d+)/(\d+)/(\d+)\.png', url)[0])
+        requested.append((z, x, y))
+        return render_tile(z, x, y)
+
+    monkeypatch.setattr(tms2geotiff, 'get_tile', get_tile)
+    return requested
+
+
+def quiet(progress, total, done=False):
+    pass
+
+
+def test_stream_to_matches_in_memory_mosaic(fake_tiles, tmp_path):
+    img, matrix = tms2geotiff.download_extent(
+        SOURCE, *EXTENT, 16, progress_callback=quiet)
+    out = str(tmp_path / 'stream.tif')
+    none, stream_matrix = tms2geotiff.download_extent(
+        SOURCE, *EXTENT, 16, progress_callback=quiet,
+        stream_to=out, block_size=256)
+    assert none is None
+    assert stream_matrix == pytest.approx(matrix)
+    with Image.open(out) as streamed:
+        assert streamed.size == img.size
+        assert streamed.tag_v2[322] == 256
+        assert streamed.tag_v2[34735][:4] == (1, 1, 0, 7)
+        assert streamed.convert('RGB').tobytes() == img.convert('RGB').tobytes()
+
+
+def test_stream_to_pending_blocks_bounded_by_width(fake_tiles, monkeypatch, tmp_path):
+    # a corridor 4 tiles wide and 200 tall
+    x, y = map(math.floor, tms2geotiff.deg2num(*EXTENT[:2], 18))
+    lat0, lon0 = tms2geotiff.num2deg(x + 0.5, y + 0.5, 18)
+    lat1, lon1 = tms2geotiff.num2deg(x + 3.5, y + 199.5, 18)
+    pending = []
+    add = tms2geotiff.StreamingGeoTIFF._add
+
+    def counting_add(self, im, xy):
+        add(self, im, xy)
+        pending.append(len(self.pending))
+
+    monkeypatch.setattr(tms2geotiff.StreamingGeoTIFF, '_add', counting_add)
+    tms2geotiff.download_extent(
+        SOURCE, lat0, lon0, lat1, lon1, 18, progress_callback=quiet,
+        stream_to=str(tmp_path / 'corridor.tif'))
+    assert len(fake_tiles) == 4 * 200
+    # two rows of 4 blocks, plus the rows the tiles in flight reach
+    assert max(pending) <= 20, max(pending)
+
+
+def test_tiled_tiff_writer_fills_missing_blocks(tmp_path):
+    out = str(tmp_path / 'sparse.tif')
+    with tms2geotiff.TiledTiffWriter(out, (600, 300), 3, 512) as writer:
+        writer.write_block(0, 0, b'\x7f' * (512 * 512 * 3))
+    with Image.open(out) as im:
+        assert im.size == (600, 300)
+        assert im.getpixel((10, 10)) == (127, 127, 127)
+        assert im.getpixel((590, 10)) == (0, 0, 0)
+
+
+def test_async_engine_matches_thread_engine(tmp_path):
+    with FakeTileServer(missing={(16, 11390, 26085)}) as server:
+        img, matrix = tms2geotiff.download_extent(
+            server.url, *EXTENT, 16, progress_callback=quiet)
+        requests = server.requests
+        async_img, async_matrix = tms2geotiff.download_extent(
+            server.url, *EXTENT, 16, progress_callback=quiet,
+            engine='async', concurrency=8)
+        assert server.requests == 2 * requests
+    assert async_matrix == matrix
+    assert async_img.tobytes() == img.tobytes()
+
+
+def test_async_engine_cancel():
+    calls = []
+
+    def cancel(progress, total, done=False):
+        calls.append(progress)
+        if len(calls) > 1:
+            raise tms2geotiff.TaskCancelled()
+
+    with FakeTileServer(latency=0.2) as server:
+        with pytest.raises(tms2geotiff.TaskCancelled):
+            tms2geotiff.download_extent(
+                server.url, *EXTENT, 17, progress_callback=cancel,
+                engine='async', concurrency=2)
+        # cancelled tasks never reach the server
+        assert server.requests < 8
+
+
+def drain(events):
+    items = []
+    while not events.empty():
+        items.append(events.get())
+    return items
+
+
+def test_download_worker_saves_in_background(fake_tiles, tmp_path):
+    out = str(tmp_path / 'worker.tif')
+    worker = tms2geotiff.DownloadWorker([SOURCE, *EXTENT, 16], out)
+    worker.start()
+    worker.join(30)
+    kinds = [event[0] for event in drain(worker.events)]
+    assert kinds[0] == 'progress'
+    assert kinds[-2:] == ['saving', 'done']
+    with Image.open(out) as im:
+        assert im.size[0] > 0
+
+
+@pytest.mark.parametrize('engine', ['thread', 'async'])
+def test_download_worker_cancel_aborts_requests(engine):
+    latency = 5
+    with FakeTileServer(latency=latency) as server:
+        worker = tms2geotiff.DownloadWorker(
+            [server.url, *EXTENT, 17], engine=engine, concurrency=4,
+            save_image=False)
+        worker.start()
+        assert worker.events.get(timeout=10)[0] == 'progress'
+        start = time.perf_counter()
+        while not server.in_flight and time.perf_counter() - start < latency:
+            time.sleep(0.01)
+        assert server.in_flight
+        start = time.perf_counter()
+        worker.cancel()
+        worker.join(2 * latency)
+        assert not worker.is_alive()
+        # requests in flight are not waited for
+        assert time.perf_counter() - start < latency
+        assert drain(worker.events)[-1] == ('cancelled',)
+
+
+def test_async_engine_concurrency():
+    # the async engine keeps far more requests in flight than threads would
+    with FakeTileServer(latency=0.2) as server:
+        tms2geotiff.download_extent(
+            server.url, *EXTENT, 18, save_image=False,
+            progress_callback=quiet, engine='async', concurrency=32)
+        assert server.peak_in_flight >= 16
+        assert server.requests == 63
+
+
+@pytest.mark.parametrize('engine', ['thread', 'async'])
+def test_tile_cache_hits_and_revalidation(tmp_path, engine):
+    cache = tms2geotiff.TileCache(str(tmp_path / 'cache.sqlite'))
+    with FakeTileServer(missing={(16, 11390, 26085)}) as server:
+        img, matrix = tms2geotiff.download_extent(
+            server.url, *EXTENT, 16, progress_callback=quiet,
+            engine=engine, cache=cache)
+        fetched = server.requests
+        assert cache.stats()['misses'] == fetched
+        cached_img, cached_matrix = tms2geotiff.download_extent(
+            server.url, *EXTENT, 16, progress_callback=quiet,
+            engine=engine, cache=cache)
+        assert server.requests == fetched
+        assert cache.stats()['hits'] == fetched
+        assert cached_img.tobytes() == img.tobytes()
+        # expired entries are revalidated with If-None-Match
+        cache.ttl = 0
+        tms2geotiff.download_extent(
+            server.url, *EXTENT, 16, save_image=False,
+            progress_callback=quiet, engine=engine, cache=cache)
+        assert server.not_modified == fetched - 1
+    cache.close()
+
+
+def test_tile_cache_lru_eviction(tmp_path):
+    cache = tms2geotiff.TileCache(str(tmp_path / 'cache.sqlite'), max_bytes=2500)
+    for x in range(3):
+        cache.put((SOURCE, 1, x, 0), bytes([x]) * 1000)
+        time.sleep(0.01)
+    assert cache.get((SOURCE, 1, 0, 0)) is None
+    assert cache.get((SOURCE, 1, 2, 0)).data == b'\x02' * 1000
+    assert cache.stats()['bytes'] <= 2500
+    cache.close()
+
+
+def test_resume_fetches_only_missing_tiles(fake_tiles, tmp_path):
+    mbtiles = str(tmp_path / 'out.mbtiles')
+    img, matrix = tms2geotiff.download_extent(
+        SOURCE, *EXTENT, 16, mbtiles=mbtiles, progress_callback=quiet)
+    total = len(fake_tiles)
+    db = tms2geotiff.sqlite3.connect(mbtiles)
+    db.execute("DELETE FROM tiles WHERE tile_column=11390")
+    db.commit()
+    db.close()
+    del fake_tiles[:]
+    resumed, resumed_matrix = tms2geotiff.download_extent(
+        SOURCE, *EXTENT, 16, mbtiles=mbtiles, progress_callback=quiet,
+        resume=True)
+    assert fake_tiles and len(fake_tiles) < total
+    assert all(x == 11390 for z, x, y in fake_tiles)
+    assert resumed_matrix == matrix
+    assert resumed.tobytes() == img.tobytes()
+
+
+def test_build_pyramid_from_highest_zoom(fake_tiles, tmp_path):
+    mbtiles = str(tmp_path / 'out.mbtiles')
+    tms2geotiff.download_extent(
+        SOURCE, *EXTENT, 16, mbtiles=mbtiles, save_image=False,
+        progress_callback=quiet)
+    del fake_tiles[:]
+    written = tms2geotiff.mbtiles_build_pyramid(mbtiles, 13, processes=2)
+    assert not fake_tiles
+    assert sorted(written) == [13, 14, 15]
+    db = tms2geotiff.sqlite3.connect(mbtiles)
+    meta = dict(db.execute("SELECT name, value FROM metadata"))
+    assert (meta['minzoom'], meta['maxzoom']) == ('13', '16')
+    assert db.execute(
+        "SELECT COUNT(*) FROM tiles WHERE zoom_level=13").fetchone()[0] == 1
+    # pick a stored child that is the top-left quadrant of its parent
+    x, y = next(
+        (x, 2**16 - 1 - row) for x, row in db.execute(
+            "SELECT tile_column, tile_row FROM tiles WHERE zoom_level=16")
+        if x % 2 == 0 and (2**16 - 1 - row) % 2 == 0)
+    data = db.execute(
+        "SELECT tile_data FROM tiles WHERE zoom_level=15 AND tile_column=? "
+        "AND tile_row=?", (x // 2, 2**15 - 1 - y // 2)).fetchone()[0]
+    db.close()
+    # away from the diagonal marks the quadrant keeps its child's colour
+    with Image.open(tms2geotiff.io.BytesIO(data)) as im:
+        pixel = im.convert('RGB').getpixel((1, 2))
+    assert pixel == ((x * 37) % 256, (y * 59) % 256, (16 * 11) % 256)
+
+
+def test_downsample_2x2_mean_ignores_transparent_pixels():
+    import numpy
+    canvas = numpy.zeros((4, 4, 4), dtype=numpy.uint8)
+    canvas[0, 0] = (200, 100, 50, 255)
+    out = tms2geotiff.downsample_2x2(canvas)
+    assert out.shape == (2, 2, 4)
+    assert tuple(out[0, 0]) == (200, 100, 50, 64)
+    assert not out[1, 1].any()
+
+
+def _png(im):
+    buf = tms2geotiff.io.BytesIO()
+    im.save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def test_tile_mosaic_matches_paste_tile():
+    bbox = (10, 20, 13, 22)
+    tiles = {}
+    for x in range(10, 13):
+        for y in range(20, 22):
+            im = Image.new('RGBA', (256, 256), (x * 20, y * 10, 90, 255))
+            im.paste((0, 0, 0, 0), (0, 0, 100, 256))
+            tiles[(x, y)] = _png(im)
+    tiles[(12, 21)] = _png(Image.new('RGBA', (256, 256)))
+    tiles[(11, 21)] = None
+    bigim = None
+    base_size = [256, 256]
+    mosaic = tms2geotiff.TileMosaic(bbox)
+    for xy, tile in tiles.items():
+        bigim = tms2geotiff.paste_tile(bigim, base_size, tile, xy, bbox)
+        mosaic.paste(tile, xy)
+    extent = (10.25, 20.5, 12.5, 21.75)
+    view = mosaic.crop(*extent)
+    x2, y2, imgw, imgh = tms2geotiff.crop_window(*extent, bbox, base_size)
+    expected = bigim.crop((x2, y2, x2 + imgw, y2 + imgh))
+    im = tms2geotiff.array_to_image(view)
+    assert im.mode == 'RGBA' and im.size == expected.size
+    assert im.tobytes() == expected.tobytes()
+
+
+def test_as_array_returns_view_of_canvas(fake_tiles):
+    import numpy
+    view, matrix = tms2geotiff.download_extent(
+        SOURCE, *EXTENT, 16, progress_callback=quiet, as_array=True)
+    img, img_matrix = tms2geotiff.download_extent(
+        SOURCE, *EXTENT, 16, progress_callback=quiet)
+    assert not view.flags.owndata
+    assert view.shape == (img.size[1], img.size[0], 3)
+    assert matrix == img_matrix
+    assert numpy.array_equal(view, numpy.asarray(img))
+
+
+def test_pipeline_bounds_tiles_in_memory(fake_tiles, monkeypatch):
+    expected, matrix = tms2geotiff.download_extent(
+        SOURCE, *EXTENT, 17, progress_callback=quiet)
+    written = []
+    outstanding = []
+    get_tile = tms2geotiff.get_tile
+    paste_array = tms2geotiff.TileMosaic.paste_array
+
+    def counting_get_tile(*args, **kwargs):
+        outstanding.append(len(fake_tiles) - len(written))
+        return get_tile(*args, **kwargs)
+
+    def counting_paste_array(self, array, xy):
+        written.append(xy)
+        return paste_array(self, array, xy)
+
+    monkeypatch.setattr(tms2geotiff, 'get_tile', counting_get_tile)
+    monkeypatch.setattr(tms2geotiff.TileMosaic, 'paste_array', counting_paste_array)
+    del fake_tiles[:]
+    telemetry = tms2geotiff.Telemetry()
+    img, pipeline_matrix = tms2geotiff.download_extent(
+        SOURCE, *EXTENT, 17, progress_callback=quiet, queue_size=4,
+        decode_threads=2, telemetry=telemetry)
+    assert pipeline_matrix == matrix
+    assert img.tobytes() == expected.tobytes()
+    assert len(written) == len(fake_tiles) > 4
+    assert max(outstanding) < 4
+    queues = telemetry.summary()['queues']
+    assert set(queues) == {'fetch', 'decode', 'write'}
+    assert queues['fetch']['max'] <= 4
+    assert queues['decode']['max'] <= 4 and queues['write']['max'] <= 4
+
+
+def test_dedup_mbtiles_stores_identical_tiles_once(monkeypatch, tmp_path):
+    blank = _png(Image.new('RGBA', (256, 256)))
+
+    def get_tile(url, *args, **kwargs):
+        z, x, y = map(int, re.findall(r'/(\d+)/(\d+)/(\d+)\.png', url)[0])
+        return blank if x % 2 else render_tile(z, x, y)
+
+    monkeypatch.setattr(tms2geotiff, 'get_tile', get_tile)
+    mbtiles = str(tmp_path / 'dedup.mbtiles')
+    tms2geotiff.download_extent(
+        SOURCE, *EXTENT, 16, mbtiles=mbtiles, save_image=False,
+        progress_callback=quiet, dedup=True)
+    db = tms2geotiff.sqlite3.connect(mbtiles)
+    assert db.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    count = db.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+    assert count > 1
+    assert db.execute("SELECT COUNT(*) FROM map").fetchone()[0] == count
+    blanks = db.execute(
+        "SELECT COUNT(*) FROM map WHERE tile_column % 2 = 1").fetchone()[0]
+    assert blanks > 1
+    assert db.execute(
+        "SELECT COUNT(*) FROM images").fetchone()[0] == count - blanks + 1
+    db.close()
+    # the layout is kept when the file is reopened, and resume reads the map
+    tms2geotiff.download_extent(
+        SOURCE, *EXTENT, 16, mbtiles=mbtiles, save_image=False,
+        progress_callback=quiet, resume=True)
+    assert tms2geotiff.mbtiles_build_pyramid(mbtiles, 15, processes=1)[15]
+
+
+@pytest.mark.parametrize('dedup', [False, True])
+def test_mbtiles_export_matches_download(fake_tiles, tmp_path, dedup):
+    mbtiles = str(tmp_path / 'export.mbtiles')
+    img, matrix = tms2geotiff.download_extent(
+        SOURCE, *EXTENT, 16, mbtiles, progress_callback=quiet, dedup=dedup)
+    requested = len(fake_tiles)
+    exported, export_matrix = tms2geotiff.mbtiles_export(
+        mbtiles, *EXTENT, 16, band_rows=1)
+    assert export_matrix == matrix
+    assert exported.tobytes() == img.tobytes()
+    out = str(tmp_path / 'export.tif')
+    none, stream_matrix = tms2geotiff.mbtiles_export(
+        mbtiles, *EXTENT, 16, stream_to=out)
+    assert none is None
+    assert stream_matrix == pytest.approx(matrix)
+    with Image.open(out) as streamed:
+        assert streamed.convert('RGB').tobytes() == img.convert('RGB').tobytes()
+    # a wider extent than stored leaves the missing tiles transparent
+    wider, _ = tms2geotiff.mbtiles_export(
+        mbtiles, EXTENT[0], EXTENT[1] - 0.01, EXTENT[2], EXTENT[3], 16)
+    assert wider.mode == 'RGBA'
+    assert wider.getpixel((0, wider.size[1] // 2))[3] == 0
+    assert len(fake_tiles) == requested
+
+
+def test_mbtiles_maintain_merges_and_prunes(fake_tiles, tmp_path):
+    west = str(tmp_path / 'west.mbtiles')
+    east = str(tmp_path / 'east.mbtiles')
+    lat0, lon0, lat1, lon1 = EXTENT
+    middle = (lon0 + lon1) / 2
+    tms2geotiff.download_extent(
+        SOURCE, lat0, lon0, lat1, middle, 16, west, save_image=False,
+        progress_callback=quiet)
+    tms2geotiff.download_extent(
+        SOURCE, lat0, lon0, lat1, middle, 17, west, save_image=False,
+        progress_callback=quiet)
+    tms2geotiff.download_extent(
+        SOURCE, lat0, middle, lat1, lon1, 16, east, save_image=False,
+        progress_callback=quiet, dedup=True)
+    expected, _ = tms2geotiff.download_extent(
+        SOURCE, *EXTENT, 16, progress_callback=quiet)
+    merged = str(tmp_path / 'merged.mbtiles')
+    stats = tms2geotiff.mbtiles_maintain(merged, [west, east], dedup=True)
+    db = sqlite3.connect(merged)
+    z16 = db.execute("SELECT COUNT(*) FROM tiles WHERE zoom_level=16").fetchone()[0]
+    z17 = db.execute("SELECT COUNT(*) FROM tiles WHERE zoom_level=17").fetchone()[0]
+    # the halves share a column of tiles
+    assert stats['tiles'] == z16 + z17 < stats['merged']
+    assert tms2geotiff.mbtiles_is_dedup(db)
+    metadata = dict(db.execute("SELECT name, value FROM metadata"))
+    assert (metadata['minzoom'], metadata['maxzoom']) == ('16', '17')
+    bounds = [float(v) for v in metadata['bounds'].split(',')]
+    assert bounds[0] <= lon0 and bounds[2] >= lon1
+    assert bounds[1] <= lat0 and bounds[3] >= lat1
+    db.close()
+    img, _ = tms2geotiff.mbtiles_export(merged, *EXTENT, 16)
+    assert img.tobytes() == expected.tobytes()
+    # prune to the zoom 16 tiles of the west half
+    stats = tms2geotiff.mbtiles_maintain(
+        merged, bounds=(lon0, lat0, middle, lat1), maxzoom=16)
+    db = sqlite3.connect(merged)
+    assert stats['tiles'] == db.execute(
+        "SELECT COUNT(*) FROM map").fetchone()[0] < z16
+    assert db.execute(
+        "SELECT COUNT(*) FROM images WHERE tile_id NOT IN "
+        "(SELECT tile_id FROM map)").fetchone()[0] == 0
+    assert db.execute(
+        "SELECT value FROM metadata WHERE name='maxzoom'").fetchone()[0] == '16'
+    db.close()
+
+
+@pytest.mark.parametrize('src_dedup', [False, True])
+def test_mbtiles_merge_drops_replaced_images(tmp_path, src_dedup):
+    sources = []
+    for name in ('old', 'new'):
+        filename = str(tmp_path / (name + '.mbtiles'))
+        db = tms2geotiff.mbtiles_init(filename, dedup=src_dedup)
+        writer = tms2geotiff.MBTilesWriter(db)
+        for x in range(4):
+            writer.add(3, x, 0, b'%s %d' % (name.encode(), x % 2))
+        writer.flush()
+        db.close()
+        sources.append(filename)
+    db = tms2geotiff.mbtiles_init(str(tmp_path / 'merged.mbtiles'), dedup=True)
+    assert tms2geotiff.mbtiles_merge(db, sources) == 8
+    assert db.execute("SELECT COUNT(*) FROM images").fetchone()[0] == db.execute(
+        "SELECT COUNT(DISTINCT tile_id) FROM map").fetchone()[0] == 2
+    db.close()
+
+
+def test_mbtiles_writer_flushes_by_size(tmp_path):
+    db = tms2geotiff.mbtiles_init(str(tmp_path / 'batch.mbtiles'))
+    writer = tms2geotiff.MBTilesWriter(db, batch_size=100, batch_bytes=3000)
+    for x in range(5):
+        writer.add(3, x, 0, b'x' * 1000)
+    assert writer.written == 3 and len(writer.rows) == 2
+    writer.flush()
+    assert db.execute("SELECT COUNT(*) FROM tiles").fetchone()[0] == 5
+    db.close()
+
+
+def test_mbtiles_writer_drops_replaced_images(tmp_path):
+    db = tms2geotiff.mbtiles_init(str(tmp_path / 'dedup.mbtiles'), dedup=True)
+    writer = tms2geotiff.MBTilesWriter(db)
+    for x in range(3):
+        writer.add(3, x, 0, b'old %d' % x)
+    writer.add(3, 3, 0, b'shared')
+    writer.flush()
+    # a new image, one shared with a kept tile, and the same image again
+    writer.add(3, 0, 0, b'new')
+    writer.add(3, 1, 0, b'shared')
+    writer.add(3, 2, 0, b'old 2')
+    writer.flush()
+    images = {row[0] for row in db.execute("SELECT tile_data FROM images")}
+    assert images == {b'new', b'shared', b'old 2'}
+    assert db.execute("SELECT COUNT(*) FROM tiles").fetchone()[0] == 4
+    # the lookup of remaining users is indexed, also in older files
+    index = "SELECT COUNT(*) FROM sqlite_master WHERE name='map_tile_id'"
+    db.execute("DROP INDEX map_tile_id")
+    db.close()
+    db = tms2geotiff.mbtiles_init(str(tmp_path / 'dedup.mbtiles'))
+    assert db.execute(index).fetchone()[0] == 1
+    db.close()
+
+
+def test_mbtiles_transcodes_mismatched_tiles(fake_tiles, tmp_path):
+    mbtiles = str(tmp_path / 'jpeg.mbtiles')
+    db = tms2geotiff.mbtiles_init(mbtiles)
+    db.execute("INSERT INTO metadata VALUES ('format', 'jpg')")
+    db.commit()
+    db.close()
+    reports = []
+
+    def progress(progress, total, done=False, stats=None):
+        reports.append(dict(stats or {}))
+
+    tms2geotiff.download_extent(
+        SOURCE, *EXTENT, 16, mbtiles, save_image=False,
+        progress_callback=progress, transcode_processes=1)
+    db = tms2geotiff.sqlite3.connect(mbtiles)
+    rows = db.execute("SELECT tile_data FROM tiles").fetchall()
+    db.close()
+    assert len(rows) == len(set(fake_tiles))
+    assert all(row[0][:3] == b'\xff\xd8\xff' for row in rows)
+    assert reports[-1]['encoded'] == len(rows)
+    assert reports[-1]['encoded_per_s'] > 0
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA'])
+def test_save_cog_writes_overviews_before_data(tmp_path, mode):
+    im = Image.new(mode, (1300, 700), (10, 20, 30, 255)[:len(mode)])
+    im.paste((200, 100, 50, 255)[:len(mode)], (0, 0, 651, 351))
+    out = str(tmp_path / 'cog.tif')
+    matrix = (-13073000.0, 0.3, 0.0, 4080000.0, 0.0, -0.3)
+    tms2geotiff.save_cog(im, out, matrix, block_size=256)
+    with Image.open(out) as cog:
+        assert cog.size == (1300, 700)
+        assert cog.tag_v2[322] == 256
+        assert cog.tag_v2[34735][:4] == (1, 1, 0, 7)
+        assert cog.tag_v2[33922][3:5] == (matrix[0], matrix[3])
+        assert cog.tobytes() == im.tobytes()
+        first_block = min(cog.tag_v2[324])
+        with open(out, 'rb') as f:
+            assert int.from_bytes(f.read(8)[4:], 'little') < first_block
+        sizes = []
+        for frame in range(cog.n_frames):
+            cog.seek(frame)
+            sizes.append(cog.size)
+            # overview blocks come before the full resolution ones
+            assert max(cog.tag_v2[324]) < first_block or frame == 0
+        assert sizes == [(1300, 700), (650, 350), (325, 175), (163, 88)]
+        cog.seek(1)
+        assert cog.getpixel((0, 0)) == (200, 100, 50, 255)[:len(mode)]
+        assert cog.getpixel((649, 349)) == (10, 20, 30, 255)[:len(mode)]
+
+
+def test_bigtiff_array_goes_to_gdal_without_pil_copy(monkeypatch, tmp_path):
+    numpy = pytest.importorskip('numpy')
+    array = numpy.zeros((4, 4, 3), dtype=numpy.uint8)
+    saved = []
+
+    def fail(array):
+        raise AssertionError("converted to a PIL image")
+
+    monkeypatch.setattr(tms2geotiff, 'img_memorysize', lambda img: 4 << 30)
+    monkeypatch.setattr(tms2geotiff, 'array_to_image', fail)
+    monkeypatch.setattr(tms2geotiff, 'save_geotiff_gdal',
+                        lambda img, filename, matrix: saved.append(img))
+    tms2geotiff.save_image(array, str(tmp_path / 'big.tif'), (0, 1, 0, 0, 0, -1))
+    assert saved[0] is array
+
+
+def test_image_blocks_of_array_are_views():
+    numpy = pytest.importorskip('numpy')
+    array = numpy.arange(300 * 200 * 3, dtype=numpy.uint8).reshape(200, 300, 3)
+    blocks = list(tms2geotiff.image_blocks(array, 128))
+    assert [(x, y) for x, y, _ in blocks] == [
+        (0, 0), (128, 0), (256, 0), (0, 128), (128, 128), (256, 128)]
+    assert blocks[-1][2].shape == (72, 44, 3)
+    assert all(numpy.shares_memory(block, array) for _, _, block in blocks)
+    im = Image.fromarray(array)
+    for (x, y, block), (_, _, view) in zip(
+            tms2geotiff.image_blocks(im, 128), blocks):
+        assert block.dtype == numpy.uint8
+        assert (block == view).all()
+
+
+@pytest.mark.parametrize('resampling', ['nearest', 'bilinear'])
+def test_save_reprojected_to_4326(tmp_path, resampling):
+    numpy = pytest.importorskip('numpy')
+    array = numpy.zeros((400, 600, 3), dtype=numpy.uint8)
+    array[:200, :300] = (200, 0, 0)
+    array[:200, 300:] = (0, 200, 0)
+    array[200:, :300] = (0, 0, 200)
+    array[200:, 300:] = (200, 200, 0)
+    lat0, lon0, lat1, lon1 = 60.0, 10.0, 50.0, 30.0
+    matrix = tms2geotiff.extent_matrix(lat0, lon0, lat1, lon1, (600, 400))
+    out = str(tmp_path / 'out.tif')
+    size, dst = tms2geotiff.save_reprojected(
+        array, out, matrix, 4326, resampling, block_size=128)
+    assert dst[0] == pytest.approx(lon0)
+    assert dst[3] == pytest.approx(lat0)
+    assert dst[0] + size[0] * dst[1] == pytest.approx(lon1, abs=dst[1])
+    assert dst[3] - size[1] * dst[1] == pytest.approx(lat1, abs=dst[1])
+    # the source rows are even in metres, so the split moves north in degrees
+    split_lat = tms2geotiff.mercator_to_lonlat(0, (matrix[3] + 200 * matrix[5]))[1]
+    assert 55.0 < split_lat < 56.0
+
+    def pixel(lat, lon):
+        return (int((lon - dst[0]) / dst[1]), int((dst[3] - lat) / dst[1]))
+
+    with Image.open(out) as im:
+        assert im.size == size
+        assert im.mode == 'RGBA'
+        assert im.tag_v2[34735][4:] == (1024, 0, 1, 2, 1025, 0, 1, 1,
+                                        2048, 0, 1, 4326, 2054, 0, 1, 9102)
+        assert im.getpixel(pixel(split_lat + 0.5, 15)) == (200, 0, 0, 255)
+        assert im.getpixel(pixel(split_lat - 0.5, 15)) == (0, 0, 200, 255)
+        assert im.getpixel(pixel(split_lat + 0.5, 25)) == (0, 200, 0, 255)
+        assert im.getpixel(pixel(split_lat - 0.5, 25)) == (200, 200, 0, 255)
+    outside = tms2geotiff.reproject_block(
+        array, matrix, tms2geotiff.lonlat_to_mercator, dst, size[0] + 10, 0, 8, 8)
+    assert not outside.any()
+
+
+def test_save_reprojected_cog(tmp_path, monkeypatch):
+    numpy = pytest.importorskip('numpy')
+    array = numpy.full((600, 900, 3), 120, dtype=numpy.uint8)
+    matrix = tms2geotiff.extent_matrix(60.0, 10.0, 50.0, 30.0, (900, 600))
+    out = str(tmp_path / 'out.tif')
+    size, dst = tms2geotiff.save_reprojected(array, out, matrix, 4326, cog=True)
+    with Image.open(out) as im:
+        assert im.size == size
+        assert im.n_frames == 3
+        assert im.tag_v2[34735][-4:] == (2054, 0, 1, 9102)
+        assert im.getpixel((size[0] // 2, size[1] // 2)) == (120, 120, 120, 255)
+    with pytest.raises(ValueError):
+        tms2geotiff.save_reprojected(
+            array, str(tmp_path / 'out.png'), matrix, 4326)
+    monkeypatch.setattr(sys, 'argv', [
+        'tms2geotiff.py', '-f', '60,10', '-t', '50,30', '-z', '5',
+        '--epsg', '4326', str(tmp_path / 'out.jpg')])
+    with pytest.raises(SystemExit):
+        tms2geotiff.main()
+    assert not os.path.exists(str(tmp_path / 'out.jpg'))
+    # the streaming writer can't make a COG either
+    monkeypatch.setattr(sys, 'argv', [
+        'tms2geotiff.py', '-f', '60,10', '-t', '50,30', '-z', '5',
+        '--stream', '--cog', str(tmp_path / 'stream.tif')])
+    with pytest.raises(SystemExit):
+        tms2geotiff.main()
+    assert not os.path.exists(str(tmp_path / 'stream.tif'))
+
+
+def test_bilinear_repeats_edge_pixels():
+    numpy = pytest.importorskip('numpy')
+    array = numpy.zeros((2, 3, 3), dtype=numpy.uint8)
+    array[:, 1:] = 150
+    array[1:] = 50
+    identity = (0, 1, 0, 0, 0, 1)
+    # the output pixel centres fall a quarter pixel outside each edge
+    block = tms2geotiff.reproject_block(
+        array, identity, lambda x, y: (x, y), (-0.25, 1, 0, -0.25, 0, 1),
+        0, 0, 1, 1)
+    assert tuple(block[0, 0]) == (0, 0, 0, 255)
+    block = tms2geotiff.reproject_block(
+        array, identity, lambda x, y: (x, y), (0.25, 1, 0, 0.25, 0, 1),
+        2, 1, 1, 1)
+    assert tuple(block[0, 0]) == (50, 50, 50, 255)
+
+
+def test_chunked_download_writes_vrt(tmp_path):
+    numpy = pytest.importorskip('numpy')
+    out = str(tmp_path / 'big.vrt')
+    cache = str(tmp_path / 'cache.sqlite')
+    with FakeTileServer() as server:
+        img, matrix = tms2geotiff.download_extent(
+            server.url, *EXTENT, 17, progress_callback=quiet)
+        requests = server.requests
+        # two tiles per chunk side
+        chunks = tms2geotiff.download_chunked(
+            server.url, *EXTENT, 17, out, max_bytes=4 * 256 * 256 * 4,
+            processes=2, cache_file=cache, progress_callback=quiet)
+        assert server.requests == 2 * requests
+    assert len(chunks) == 9
+    root = tms2geotiff.ElementTree.parse(out).getroot()
+    assert (int(root.get('rasterXSize')), int(root.get('rasterYSize'))) == img.size
+    geotransform = [float(v) for v in root.find('GeoTransform').text.split(',')]
+    assert geotransform == pytest.approx(matrix)
+    bands = root.findall('VRTRasterBand')
+    assert len(bands) == len(img.getbands())
+    mosaic = numpy.zeros_like(numpy.asarray(img))
+    for source in bands[0].findall('SimpleSource'):
+        rect = source.find('DstRect')
+        x, y, w, h = (int(rect.get(k)) for k in ('xOff', 'yOff', 'xSize', 'ySize'))
+        with Image.open(str(tmp_path / source.find('SourceFilename').text)) as chunk:
+            assert chunk.size == (w, h)
+            mosaic[y:y+h, x:x+w] = numpy.asarray(chunk)
+    assert (mosaic == numpy.asarray(img)).all()
+    # both workers filled the one cache
+    db = tms2geotiff.sqlite3.connect(cache)
+    assert db.execute("SELECT COUNT(*) FROM tile_cache").fetchone()[0] == requests
+    db.close()
+
+
+def test_cli_only_chunks_vrt_outputs(fake_tiles, monkeypatch, tmp_path):
+    out = str(tmp_path / 'small.png')
+    mbtiles = str(tmp_path / 'small.mbtiles')
+    monkeypatch.setattr(sys, 'argv', [
+        'tms2geotiff.py', '--extent=%s,%s,%s,%s' % (
+            EXTENT[1], EXTENT[0], EXTENT[3], EXTENT[2]),
+        '-z', '16', '-m', mbtiles, '--max-memory', '0', out])
+    assert tms2geotiff.main() == 0
+    assert os.path.exists(out)
+    assert not os.path.exists(str(tmp_path / 'small.vrt'))
+
+
+def test_cli_vrt_keeps_telemetry_and_hedging(fake_tiles, monkeypatch, tmp_path):
+    pytest.importorskip('numpy')
+    extent = '--extent=%s,%s,%s,%s' % (EXTENT[1], EXTENT[0], EXTENT[3], EXTENT[2])
+    report = str(tmp_path / 'run.json')
+    monkeypatch.setattr(sys, 'argv', [
+        'tms2geotiff.py', extent, '-z', '16', '--hedge', '--telemetry', report,
+        '--max-memory', '1', str(tmp_path / 'big.vrt')])
+    assert tms2geotiff.main() == 0
+    with open(report) as f:
+        assert json.load(f)['counters']['tiles'] == len(fake_tiles)
+    # worker processes can't report back
+    monkeypatch.setattr(sys, 'argv', [
+        'tms2geotiff.py', extent, '-z', '16', '--hedge', '-p', '2',
+        str(tmp_path / 'other.vrt')])
+    with pytest.raises(SystemExit):
+        tms2geotiff.main()
+    assert not os.path.exists(str(tmp_path / 'other.vrt'))
+
+
+def test_tile_source_pickles_with_its_shard():
+    import pickle
+    source = tms2geotiff.TileSource('http://{s}.t/{z}/{x}/{y}.png', 'ab')
+    source.url(1, 0, 0)
+    copy = pickle.loads(pickle.dumps(source))
+    assert copy.url(1, 0, 0) == source.url(1, 0, 0) == 'http://b.t/1/0/0.png'
+
+
+def test_blank_index_skips_known_blank_tiles(monkeypatch, tmp_path):
+    import io
+    buf = io.BytesIO()
+    Image.new('RGBA', (256, 256)).save(buf, 'PNG')
+    transparent = buf.getvalue()
+    requested = []
+
+    def get_tile(url, *args, **kwargs):
+        z, x, y = map(int, re.findall(r'/(\d+)/(\d+)/(\d+)\.png', url)[0])
+        requested.append((x, y))
+        if x % 2:
+            return None
+        if y % 2:
+            return transparent
+        return render_tile(z, x, y)
+
+    monkeypatch.setattr(tms2geotiff, 'get_tile', get_tile)
+    filename = str(tmp_path / 'blank.sqlite')
+    index = tms2geotiff.BlankTileIndex(filename)
+    img, matrix = tms2geotiff.download_extent(
+        SOURCE, *EXTENT, 17, progress_callback=quiet, blank_index=index)
+    index.close()
+    blank = {(x, y) for x, y in requested if x % 2 or y % 2}
+    assert blank and len(blank) < len(requested)
+    first = set(requested)
+    del requested[:]
+    index = tms2geotiff.BlankTileIndex(filename)
+    assert index.blank_tiles(SOURCE, 17, first) == blank
+    again, _ = tms2geotiff.download_extent(
+        SOURCE, *EXTENT, 17, progress_callback=quiet, blank_index=index)
+    assert set(requested) == first - blank
+    # skipped tiles stay transparent
+    assert again.mode == 'RGBA'
+    assert again.convert('RGB').tobytes() == img.convert('RGB').tobytes()
+    index.close()
+    # expired blocks are forgotten
+    index = tms2geotiff.BlankTileIndex(filename, ttl=0)
+    assert not index.blank_tiles(SOURCE, 17, first)
+    index.close()
+
+
+def test_aimd_controller_window():
+    controller = tms2geotiff.AIMDController(4, maximum=8)
+    ok = {'error': False, 'throttled': False, 'retry_after': None}
+    for i in range(40):
+        controller.release(controller.acquire(), ok)
+    assert controller.window == 8
+    started = [controller.acquire() for i in range(8)]
+    assert controller.try_acquire() is None
+    throttled = {'error': True, 'throttled': True, 'retry_after': 0.2}
+    # one cut per round trip, however many requests were throttled
+    for s in started:
+        pause = controller.release(s, throttled)
+    assert controller.window == 4
+    assert 0 < pause <= 0.2
+    assert controller.free() == 0
+    start = time.monotonic()
+    controller.acquire()
+    assert time.monotonic() - start >= 0.15
+
+
+def test_aimd_controller_keeps_freed_slot_for_hedge():
+    controller = tms2geotiff.AIMDController(2)
+    started = [controller.acquire(), controller.acquire()]
+    assert controller.acquire(0.01, priority=True) is None
+    assert controller.reserved == 0
+    controller.reserve(1)
+    controller.release(started.pop())
+    assert controller.try_acquire() is None
+    assert controller.try_acquire(priority=True) is not None
+    controller.reserve(-1)
+    assert controller.free() == 0
+
+
+@pytest.mark.parametrize('engine', ['thread', 'async'])
+def test_adaptive_concurrency_backs_off_on_429(engine):
+    windows = []
+
+    def progress(progress, total, done=False, stats=None):
+        if 'window' in stats:
+            windows.append(stats['window'])
+
+    with FakeTileServer(latency=0.02) as server:
+        expected, _ = tms2geotiff.download_extent(
+            server.url, *EXTENT, 18, progress_callback=quiet)
+    with FakeTileServer(latency=0.02, capacity=4, retry_after=0.1) as server:
+        img, _ = tms2geotiff.download_extent(
+            server.url, *EXTENT, 18, progress_callback=progress,
+            callback_interval=0, engine=engine, concurrency=2,
+            max_concurrency=32)
+        assert server.throttled
+    assert img.tobytes() == expected.tobytes()
+    assert max(windows) > 2
+    assert windows[-1] < 16
+
+
+def test_latency_histogram_percentiles():
+    hist = tms2geotiff.LatencyHistogram()
+    for ms in range(1, 1001):
+        hist.add(ms / 1000)
+    summary = hist.summary()
+    assert summary['count'] == 1000
+    assert summary['mean'] == pytest.approx(0.5005)
+    assert summary['p50'] == pytest.approx(0.5, rel=0.03)
+    assert summary['p99'] == pytest.approx(0.99, rel=0.03)
+    assert summary['p99.9'] == pytest.approx(0.999, rel=0.03)
+    assert summary['max'] == 1.0
+
+
+@pytest.mark.parametrize('engine', ['thread', 'async'])
+def test_telemetry_report(tmp_path, engine):
+    telemetry = tms2geotiff.Telemetry()
+    with FakeTileServer(missing={(16, 11390, 26085)}, error_rate=0.2,
+                        seed=3) as server:
+        tms2geotiff.download_extent(
+            server.url, *EXTENT, 16, str(tmp_path / 'out.mbtiles'),
+            progress_callback=quiet, engine=engine, telemetry=telemetry)
+        requests, errors = server.requests, server.errors
+    summary = telemetry.summary()
+    tiles = summary['counters']['tiles']
+    assert summary['status_codes'] == {
+        '200': tiles - 1, '404': 1, '500': errors}
+    assert summary['counters']['retries'] == errors
+    assert summary['counters']['bytes'] > 0
+    stages = summary['stages']
+    assert stages['http']['count'] == requests
+    assert stages['queue']['count'] == tiles
+    assert stages['db']['count'] == tiles
+    # the missing tile has nothing to decode
+    assert stages['decode']['count'] == stages['composite']['count'] == tiles - 1
+    assert stages['http']['p50'] <= stages['http']['p99'] <= stages['http']['max']
+    prom = str(tmp_path / 'run.prom')
+    telemetry.write_prometheus(prom)
+    with open(prom) as f:
+        text = f.read()
+    assert 'tms2geotiff_stage_seconds{stage="http",quantile="0.99"}' in text
+    assert 'tms2geotiff_responses_total{status="404"} 1\n' in text
+    assert 'tms2geotiff_tiles_total %d\n' % tiles in text
+
+
+@pytest.mark.parametrize('engine', ['thread', 'async'])
+def test_hedged_requests_cut_tail_latency(engine):
+    x0, y0, x1, y1 = tms2geotiff.tile_bbox(*tms2geotiff.tile_extent(*EXTENT, 18))
+    corners = list(itertools.product(range(x0, x1), range(y0, y1)))
+    # stall the first request for three tiles requested after the warmup
+    stalled = {(18,) + xy for xy in corners[-20::7]}
+    telemetry = tms2geotiff.Telemetry()
+    hedger = tms2geotiff.Hedger(max_rate=0.1, warmup=10, telemetry=telemetry)
+    with FakeTileServer(latency=0.01, stall=1.0) as server:
+        expected, _ = tms2geotiff.download_extent(
+            server.url, *EXTENT, 18, progress_callback=quiet)
+        server.stalled = stalled
+        img, _ = tms2geotiff.download_extent(
+            server.url, *EXTENT, 18, progress_callback=quiet, engine=engine,
+            concurrency=4, hedger=hedger, telemetry=telemetry)
+        # let the stalled originals finish
+        time.sleep(1.1)
+    assert img.tobytes() == expected.tobytes()
+    summary = hedger.summary()
+    assert summary['hedge_wins'] == 3
+    # only the stalls run past twice the p95
+    assert 3 <= summary['hedges'] <= 0.1 * len(corners)
+    assert summary['p99'] < 0.5
+    if engine == 'thread':
+        assert summary['p99_unhedged'] >= 1.0
+    else:
+        # cancelled when the fetcher closed, so only a lower bound
+        assert summary['p99_unhedged'] >= summary['p99']
+    stages = telemetry.summary()['stages']
+    assert stages['tile']['count'] == len(corners)
+    assert telemetry.summary()['counters']['hedge_wins'] == 3
+
+
+def test_tile_source_templates():
+    assert tms2geotiff.quadkey(3, 5, 3) == '213'
+    bing = tms2geotiff.TileSource('http://t/a{q}.jpeg')
+    assert bing.url(3, 3, 5) == 'http://t/a213.jpeg'
+    tms = tms2geotiff.TileSource('http://t/{z}/{x}/{y}.png', tms=True)
+    assert tms.url(3, 3, 5) == 'http://t/3/3/2.png'
+    assert tms2geotiff.TileSource('{z}/{x}/{-y}').url(3, 3, 5) == '3/3/2'
+    sharded = tms2geotiff.TileSource('http://{s}.t/{z}/{x}/{y}.png', 'ab')
+    assert [sharded.url(1, 0, 0)[7] for i in range(4)] == ['a', 'b', 'a', 'b']
+
+
+WMTS_CAPABILITIES = """<?xml version="1.0" encoding="UTF-8"?>
+<Capabilities xmlns="http://www.opengis.net/wmts/1.0"
+    xmlns:ows="http://www.opengis.net/ows/1.1" version="1.0.0">
+  <Contents>
+    <Layer>
+      <ows:Identifier>imagery</ows:Identifier>
+      <Style isDefault="true"><ows:Identifier>default</ows:Identifier></Style>
+      <Format>image/jpeg</Format>
+      <Dimension><ows:Identifier>Time</ows:Identifier><Default>2021</Default></Dimension>
+      <TileMatrixSetLink><TileMatrixSet>WGS84</TileMatrixSet></TileMatrixSetLink>
+      <TileMatrixSetLink><TileMatrixSet>GoogleMaps</TileMatrixSet></TileMatrixSetLink>
+      <ResourceURL format="image/jpeg" resourceType="tile"
+        template="http://t/{Style}/{Time}/{TileMatrixSet}/{TileMatrix}/{TileRow}/{TileCol}.jpg"/>
+    </Layer>
+    <TileMatrixSet>
+      <ows:Identifier>WGS84</ows:Identifier>
+      <TileMatrix>
+        <ows:Identifier>0</ows:Identifier>
+        <ScaleDenominator>279541132.0143589</ScaleDenominator>
+        <TopLeftCorner>-180 90</TopLeftCorner>
+        <TileWidth>256</TileWidth><TileHeight>256</TileHeight>
+        <MatrixWidth>2</MatrixWidth><MatrixHeight>1</MatrixHeight>
+      </TileMatrix>
+    </TileMatrixSet>
+    <TileMatrixSet>
+      <ows:Identifier>GoogleMaps</ows:Identifier>
+      <TileMatrix>
+        <ows:Identifier>GoogleMaps:0</ows:Identifier>
+        <ScaleDenominator>559082264.0287178</ScaleDenominator>
+        <TopLeftCorner>-20037508.3427892 20037508.3427892</TopLeftCorner>
+        <TileWidth>256</TileWidth><TileHeight>256</TileHeight>
+        <MatrixWidth>1</MatrixWidth><MatrixHeight>1</MatrixHeight>
+      </TileMatrix>
+      <TileMatrix>
+        <ows:Identifier>GoogleMaps:1</ows:Identifier>
+        <ScaleDenominator>279541132.0143589</ScaleDenominator>
+        <TopLeftCorner>-20037508.3427892 20037508.3427892</TopLeftCorner>
+        <TileWidth>256</TileWidth><TileHeight>256</TileHeight>
+        <MatrixWidth>2</MatrixWidth><MatrixHeight>2</MatrixHeight>
+      </TileMatrix>
+    </TileMatrixSet>
+  </Contents>
+</Capabilities>
+"""
+
+
+def test_wmts_source_from_capabilities():
+    source = tms2geotiff.wmts_source(WMTS_CAPABILITIES)
+    assert source.matrices == {0: 'GoogleMaps:0', 1: 'GoogleMaps:1'}
+    assert source.url(1, 1, 0) == 'http://t/default/2021/GoogleMaps/GoogleMaps:1/0/1.jpg'
+    with pytest.raises(ValueError):
+        source.url(2, 0, 0)
+    with pytest.raises(ValueError):
+        tms2geotiff.wmts_source(WMTS_CAPABILITIES, matrix_set='WGS84')
+
+
+def test_subdomains_spread_requests_over_hosts():
+    with FakeTileServer() as server:
+        expected, _ = tms2geotiff.download_extent(
+            server.url, *EXTENT, 16, progress_callback=quiet)
+        port = server.server_address[1]
+        source = tms2geotiff.TileSource(
+            'http://{s}/{z}/{x}/{y}.png', ['127.0.0.1:%d' % port, 'localhost:%d' % port])
+        with tms2geotiff.make_fetcher('thread') as fetcher:
+            for x in range(4):
+                fetcher.submit(source.url(16, x, 0)).result()
+            assert len(fetcher.controllers) == 2
+        img, _ = tms2geotiff.download_extent(
+            source, *EXTENT, 16, progress_callback=quiet)
+    assert img.tobytes() == expected.tobytes()
+
+
+def test_slow_host_does_not_hold_up_others():
+    with FakeTileServer(latency=3) as slow, FakeTileServer() as fast:
+        with tms2geotiff.make_fetcher('thread', concurrency=2) as fetcher:
+            stalled = [fetcher.submit(slow.url.format(z=16, x=x, y=0))
+                       for x in range(4)]
+            done = [fetcher.submit(fast.url.format(z=16, x=x, y=0))
+                    for x in range(4)]
+            assert all(f.result(timeout=10) for f in done)
+            assert not any(f.done() for f in stalled)
+
+
+def test_hedges_go_to_the_next_subdomain(monkeypatch, tmp_path):
+    requested = []
+
+    def submit(self, url, key=None, alternate=None):
+        requested.append((url, alternate))
+        future = concurrent.futures.Future()
+        future.set_result(render_tile(*key[1:]))
+        return future
+
+    monkeypatch.setattr(tms2geotiff.ThreadTileFetcher, 'submit', submit)
+    source = tms2geotiff.TileSource('http://{s}.t/{z}/{x}/{y}.png', 'ab')
+    tms2geotiff.download_extent(
+        source, *EXTENT, 17, save_image=False, progress_callback=quiet,
+        hedger=tms2geotiff.Hedger())
+    pytest.importorskip('numpy')
+    tms2geotiff.download_batch(
+        source, [tms2geotiff.BatchJob(*EXTENT, 17, str(tmp_path / 'b.png'))],
+        quiet, hedger=tms2geotiff.Hedger())
+    hosts = [(url[7], alternate[7]) for url, alternate in requested]
+    assert {primary for primary, _ in hosts} == {'a', 'b'}
+    assert all(primary != hedge for primary, hedge in hosts)
+
+
+def test_tile_server_serves_mbtiles(fake_tiles, tmp_path):
+    import urllib.error
+    import urllib.request
+    mbtiles = str(tmp_path / 'served.mbtiles')
+    tms2geotiff.download_extent(
+        SOURCE, *EXTENT, 16, mbtiles, save_image=False, progress_callback=quiet)
+    z, x, y = fake_tiles[0]
+    with tms2geotiff.TileServer(
+            [str(tmp_path / 'missing.mbtiles'), mbtiles],
+            upstream=SOURCE).start() as server:
+        base = 'http://%s:%d' % server.server_address[:2]
+        with urllib.request.urlopen('%s/%d/%d/%d.png' % (base, z, x, y)) as r:
+            assert r.read() == render_tile(z, x, y)
+            assert r.headers['Content-Type'] == 'image/png'
+            assert 'max-age=86400' in r.headers['Cache-Control']
+            etag = r.headers['ETag']
+        request = urllib.request.Request(
+            '%s/%d/%d/%d' % (base, z, x, y), headers={'If-None-Match': etag})
+        with pytest.raises(urllib.error.HTTPError) as excinfo:
+            urllib.request.urlopen(request)
+        assert excinfo.value.code == 304
+        # tiles outside the file come from upstream, once
+        for i in range(2):
+            with urllib.request.urlopen('%s/15/1/2' % base) as r:
+                assert r.read() == render_tile(15, 1, 2)
+        assert fake_tiles.count((15, 1, 2)) == 1
+        with pytest.raises(urllib.error.HTTPError) as excinfo:
+            urllib.request.urlopen('%s/tiles/15/1' % base)
+        assert excinfo.value.code == 404
+
+
+def test_tile_server_fails_fast_on_upstream_errors(tmp_path):
+    import urllib.error
+    import urllib.request
+    mbtiles = str(tmp_path / 'empty.mbtiles')
+    tms2geotiff.mbtiles_init(mbtiles).close()
+    for upstream, kwargs in ((FakeTileServer(error_rate=1.0), {}),
+                             (FakeTileServer(latency=3), {'upstream_timeout': 0.5})):
+        with upstream, tms2geotiff.TileServer(
+                mbtiles, upstream=upstream.url, **kwargs).start() as server:
+            base = 'http://%s:%d' % server.server_address[:2]
+            start = time.perf_counter()
+            with pytest.raises(urllib.error.HTTPError) as excinfo:
+                urllib.request.urlopen(base + '/16/1/2.png')
+            assert excinfo.value.code == 502
+            # no retries, and the slow upstream isn't waited for
+            assert upstream.requests == 1
+            assert time.perf_counter() - start < 2.5
+
+
+def test_rasterize_rings_covers_intersecting_cells():
+    triangle = [(0.1, 0.1), (5.9, 0.2), (0.2, 5.9)]
+    cells = tms2geotiff.rasterize_rings([triangle])
+    # x + y < 6.1 along the hypotenuse
+    assert cells == {(x, y) for x in range(6) for y in range(6) if x + y <= 6} - {
+        (0, 6), (6, 0)}
+    square = [(0.5, 0.5), (5.5, 0.5), (5.5, 5.5), (0.5, 5.5)]
+    hole = [(1.5, 1.5), (4.5, 1.5), (4.5, 4.5), (1.5, 4.5)]
+    ring = tms2geotiff.rasterize_rings([square, hole])
+    assert (3, 3) not in ring and (2, 2) not in ring
+    assert (1, 1) in ring and (4, 1) in ring and len(ring) == 36 - 4
+
+
+def test_corridor_downloads_only_tiles_along_line(fake_tiles):
+    pytest.importorskip('numpy')
+    line = {'type': 'Feature', 'geometry': {
+        'type': 'LineString', 'coordinates': [
+            [EXTENT[1], EXTENT[0]], [EXTENT[3], EXTENT[2]]]}}
+    extent = tms2geotiff.area_extent(line, 20)
+    wanted = tms2geotiff.area_tiles(line, 18, 20)
+    img, matrix = tms2geotiff.download_extent(
+        SOURCE, *extent, 18, progress_callback=quiet, area=line, buffer=20,
+        as_array=True)
+    x0, y0 = tms2geotiff.deg2num(extent[0], extent[1], 18)
+    x1, y1 = tms2geotiff.deg2num(extent[2], extent[3], 18)
+    bbox = set(itertools.product(range(math.floor(x0), math.ceil(x1)),
+                                 range(math.floor(y0), math.ceil(y1))))
+    assert set((x, y) for z, x, y in fake_tiles) == wanted & bbox
+    assert len(wanted) * 3 < len(bbox)
+    assert img.shape[2] == 4
+    # the line runs from the south-west to the north-east corner
+    assert img[0, 0, 3] == 0 and img[-1, -1, 3] == 0
+    assert img[-1, 0, 3] == 255 and img[0, -1, 3] == 255
+
+
+def test_batch_bounds_pending_requests(monkeypatch, tmp_path):
+    pytest.importorskip('numpy')
+    pending = []
+    futures = []
+    submit = tms2geotiff.ThreadTileFetcher.submit
+
+    def counting_submit(self, *args, **kwargs):
+        futures.append(submit(self, *args, **kwargs))
+        pending.append(sum(not f.done() for f in futures))
+        return futures[-1]
+
+    monkeypatch.setattr(tms2geotiff.ThreadTileFetcher, 'submit', counting_submit)
+    jobs = [tms2geotiff.BatchJob(*EXTENT, 17, str(tmp_path / ('%d.png' % i)))
+            for i in range(3)]
+    with FakeTileServer(latency=0.01) as server:
+        stats = tms2geotiff.download_batch(
+            server.url, jobs, quiet, concurrency=2, queue_size=4)
+    assert len(futures) == stats['fetched'] > 4
+    assert max(pending) <= 4
+
+
+def test_batch_fetches_shared_tiles_once(fake_tiles, tmp_path):
+    pytest.importorskip('numpy')
+    lat0, lon0, lat1, lon1 = EXTENT
+    mid = (lon0 + lon1) / 2
+    jobs_csv = tmp_path / 'jobs.csv'
+    jobs_csv.write_text(
+        'min_lon,min_lat,max_lon,max_lat,zoom,output\n'
+        '%s,%s,%s,%s,16,%s\n' % (lon0, lat0, mid + 0.002, lat1, tmp_path / 'west.tif') +
+        '%s,%s,%s,%s,16,\n' % (mid - 0.002, lat0, lon1, lat1))
+    jobs = tms2geotiff.read_batch_jobs(str(jobs_csv), output_dir=str(tmp_path))
+    stats = tms2geotiff.download_batch(SOURCE, jobs, progress_callback=quiet)
+    assert len(fake_tiles) == len(set(fake_tiles)) == stats['fetched']
+    assert stats['saved'] == stats['requested'] - stats['fetched'] > 0
+    for job, name in zip(jobs, ('west.tif', 'extent_2.tif')):
+        expected, _ = tms2geotiff.download_extent(
+            SOURCE, *job.extent, 16, progress_callback=quiet)
+        with Image.open(str(tmp_path / name)) as im:
+            assert im.tobytes() == expected.tobytes()
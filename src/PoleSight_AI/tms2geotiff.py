@@ -4,12 +4,30 @@
 import io
 import os
 import re
+import sys
+import csv
+import json
 import math
 import time
+import zlib
+import random
+import string
+import struct
+import hashlib
 import sqlite3
+import asyncio
+import inspect
+import queue
 import argparse
 import itertools
+import threading
+import http.server
+import collections
+import email.utils
+import multiprocessing
+import urllib.parse
 import concurrent.futures
+import xml.etree.ElementTree as ElementTree
 
 from PIL import Image
 from PIL import TiffImagePlugin
@@ -20,8 +38,20 @@ try:
     SESSION = httpx.Client()
 except ImportError:
     import requests
+    httpx = None
     SESSION = requests.Session()
 
+try:
+    import h2
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 SESSION.headers.update({
     "Accept": "*/*",
@@ -53,6 +83,204 @@ def deg2num(lat, lon, zoom):
     return (xtile, ytile)
 
 
+def num2deg(x, y, zoom):
+    n = 2 ** zoom
+    lon = x / n * 360 - 180
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return (lat, lon)
+
+
+def snap_tile_edge(value):
+    # corners given as tile edges (see num2deg) shouldn't pull in a
+    # neighbouring row or column through rounding errors
+    nearest = round(value)
+    return nearest if abs(value - nearest) < 1e-9 else value
+
+
+def tile_extent(lat0, lon0, lat1, lon1, zoom):
+    """Fractional tile coordinates (x0, y0, x1, y1) of an extent, sorted."""
+    x0, y0 = map(snap_tile_edge, deg2num(lat0, lon0, zoom))
+    x1, y1 = map(snap_tile_edge, deg2num(lat1, lon1, zoom))
+    return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+
+def tile_bbox(x0, y0, x1, y1):
+    """The whole tiles covering a fractional tile extent."""
+    return (math.floor(x0), math.floor(y0), math.ceil(x1), math.ceil(y1))
+
+
+def crop_window(x0, y0, x1, y1, bbox, tile_size):
+    x2 = round(tile_size[0]*(x0 - bbox[0]))
+    y2 = round(tile_size[1]*(y0 - bbox[1]))
+    imgw = round(tile_size[0]*(x1-x0))
+    imgh = round(tile_size[1]*(y1-y0))
+    return x2, y2, imgw, imgh
+
+
+def extent_matrix(lat0, lon0, lat1, lon1, size):
+    xp0, yp0 = from4326_to3857(lat0, lon0)
+    xp1, yp1 = from4326_to3857(lat1, lon1)
+    pwidth = abs(xp1 - xp0) / size[0]
+    pheight = abs(yp1 - yp0) / size[1]
+    return (min(xp0, xp1), pwidth, 0, max(yp0, yp1), 0, -pheight)
+
+
+def geojson_geometries(obj):
+    """Yield the geometries of a GeoJSON geometry, Feature or FeatureCollection."""
+    kind = obj.get('type')
+    if kind == 'FeatureCollection':
+        for feature in obj['features']:
+            yield from geojson_geometries(feature)
+    elif kind == 'Feature':
+        if obj.get('geometry'):
+            yield from geojson_geometries(obj['geometry'])
+    elif kind == 'GeometryCollection':
+        for geometry in obj['geometries']:
+            yield from geojson_geometries(geometry)
+    else:
+        yield obj
+
+
+def geojson_bounds(obj):
+    """(lat0, lon0, lat1, lon1) of all coordinates in a GeoJSON object."""
+    lons = []
+    lats = []
+    for geometry in geojson_geometries(obj):
+        coords = geometry['coordinates']
+        depth = {'Point': 0, 'LineString': 1, 'MultiPoint': 1, 'Polygon': 2,
+                 'MultiLineString': 2, 'MultiPolygon': 3}[geometry['type']]
+        points = [coords]
+        for i in range(depth):
+            points = list(itertools.chain.from_iterable(points))
+        lons.extend(p[0] for p in points)
+        lats.extend(p[1] for p in points)
+    if not lons:
+        raise ValueError("The area has no coordinates")
+    return (max(lats), min(lons), min(lats), max(lons))
+
+
+def area_extent(area, buffer=0):
+    """Bounds of a GeoJSON area grown by `buffer` metres, as (lat0, lon0, lat1, lon1)."""
+    lat0, lon0, lat1, lon1 = geojson_bounds(area)
+    dlat = buffer / 111320
+    dlon = dlat / max(math.cos(math.radians(max(abs(lat0), abs(lat1)))), 0.01)
+    return (min(lat0 + dlat, 85.0511), max(lon0 - dlon, -180),
+            max(lat1 - dlat, -85.0511), min(lon1 + dlon, 180))
+
+
+def tile_edge_cells(p0, p1):
+    """Yield the grid cells that the segment p0-p1 (in tile units) crosses."""
+    x, y = math.floor(p0[0]), math.floor(p0[1])
+    end = (math.floor(p1[0]), math.floor(p1[1]))
+    dx, dy = p1[0] - p0[0], p1[1] - p0[1]
+    step_x = 1 if dx > 0 else -1
+    step_y = 1 if dy > 0 else -1
+    # parameter t along the segment of the next vertical/horizontal grid line
+    t_max_x = ((x + (step_x > 0) - p0[0]) / dx) if dx else math.inf
+    t_max_y = ((y + (step_y > 0) - p0[1]) / dy) if dy else math.inf
+    t_dx = abs(1 / dx) if dx else math.inf
+    t_dy = abs(1 / dy) if dy else math.inf
+    yield x, y
+    while (x, y) != end and min(t_max_x, t_max_y) <= 1:
+        if t_max_x < t_max_y:
+            x += step_x
+            t_max_x += t_dx
+        else:
+            y += step_y
+            t_max_y += t_dy
+        yield x, y
+
+
+def rasterize_rings(rings):
+    """
+    Return the set of (x, y) grid cells that intersect a polygon given as
+    rings of (x, y) points in tile units (even-odd rule, so holes work).
+
+    Cells on the boundary are found by walking each edge through the grid,
+    interior cells by a scanline through each row's centre.
+    """
+    cells = set()
+    crossings = collections.defaultdict(list)
+    for ring in rings:
+        for p0, p1 in zip(ring, ring[1:] + ring[:1]):
+            cells.update(tile_edge_cells(p0, p1))
+            if p0[1] == p1[1]:
+                continue
+            (xa, ya), (xb, yb) = sorted((p0, p1), key=lambda p: p[1])
+            for row in range(math.ceil(ya - 0.5), math.ceil(yb - 0.5)):
+                yc = row + 0.5
+                crossings[row].append(xa + (yc - ya) * (xb - xa) / (yb - ya))
+    for row, xs in crossings.items():
+        xs.sort()
+        for xa, xb in zip(xs[::2], xs[1::2]):
+            for col in range(math.ceil(xa - 0.5), math.floor(xb - 0.5) + 1):
+                cells.add((col, row))
+    return cells
+
+
+def segment_buffer(p0, p1, radius):
+    """A rectangle around the segment p0-p1, extended by `radius` all round."""
+    dx, dy = p1[0] - p0[0], p1[1] - p0[1]
+    length = math.hypot(dx, dy)
+    if length:
+        ux, uy = dx / length * radius, dy / length * radius
+    else:
+        ux, uy = radius, 0.0
+    # square caps: extend along the segment, offset across it
+    a = (p0[0] - ux, p0[1] - uy)
+    b = (p1[0] + ux, p1[1] + uy)
+    return [(a[0] - uy, a[1] + ux), (b[0] - uy, b[1] + ux),
+            (b[0] + uy, b[1] - ux), (a[0] + uy, a[1] - ux)]
+
+
+def area_tiles(area, zoom, buffer=0):
+    """
+    Return the set of (x, y) tiles at `zoom` that intersect a GeoJSON area.
+
+    Polygons cover their inside, lines and points cover only what lies
+    within `buffer` metres of them; a buffer also grows polygons.
+    """
+    n = 2 ** zoom
+    # Web Mercator tile width in ground metres is this times cos(latitude)
+    tile_metres = 2 * math.pi * EARTH_EQUATORIAL_RADIUS / n
+
+    def project(ring):
+        return [deg2num(lat, lon, zoom) for lon, lat, *_ in ring]
+
+    def buffered(line):
+        points = project(line)
+        cells = set()
+        for (lon0, lat0, *_), (lon1, lat1, *_), p0, p1 in zip(
+                line, line[1:] + line[-1:], points, points[1:] + points[-1:]):
+            radius = buffer / (tile_metres * math.cos(math.radians((lat0 + lat1) / 2)))
+            cells.update(rasterize_rings([segment_buffer(p0, p1, radius)]))
+        return cells
+
+    cells = set()
+    for geometry in geojson_geometries(area):
+        kind, coords = geometry['type'], geometry['coordinates']
+        if kind == 'Polygon':
+            coords, kind = [coords], 'MultiPolygon'
+        elif kind in ('LineString', 'MultiPoint'):
+            coords, kind = [coords], 'MultiLineString'
+        elif kind == 'Point':
+            coords, kind = [[coords]], 'MultiLineString'
+        if kind == 'MultiPolygon':
+            for polygon in coords:
+                cells.update(rasterize_rings([project(ring) for ring in polygon]))
+                if buffer:
+                    for ring in polygon:
+                        cells.update(buffered(ring + ring[:1]))
+        elif kind == 'MultiLineString':
+            if not buffer:
+                raise ValueError("Lines and points need a buffer distance")
+            for line in coords:
+                cells.update(buffered(line))
+        else:
+            raise ValueError("Unsupported geometry type: %s" % kind)
+    return {(x, y) for x, y in cells if 0 <= x < n and 0 <= y < n}
+
+
 def is_empty(im):
     extrema = im.getextrema()
     if len(extrema) >= 3:
@@ -66,20 +294,144 @@ def is_empty(im):
         return extrema[0] == (0, 0)
 
 
-def mbtiles_init(dbname):
-    db = sqlite3.connect(dbname, isolation_level=None)
+def mbtiles_init(dbname, dedup=False):
+    """
+    Open or create an MBTiles file in WAL mode.
+
+    New files get a flat `tiles` table, or with `dedup` the `map` + `images`
+    layout where identical tiles are stored once under their MD5 and `tiles`
+    is a view. An existing file keeps its layout.
+    """
+    db = sqlite3.connect(dbname, isolation_level=None, timeout=60)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
     cur = db.cursor()
     cur.execute("BEGIN")
     cur.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
-    cur.execute("CREATE TABLE IF NOT EXISTS tiles ("
+    cur.execute("SELECT type FROM sqlite_master WHERE name='tiles'")
+    row = cur.fetchone()
+    if row is None and dedup:
+        mbtiles_create_dedup(cur)
+    elif row is not None and row[0] == 'view':
+        # files written before the index existed
+        cur.execute("CREATE INDEX IF NOT EXISTS map_tile_id ON map (tile_id)")
+    else:
+        cur.execute("CREATE TABLE IF NOT EXISTS tiles ("
+            "zoom_level INTEGER NOT NULL, "
+            "tile_column INTEGER NOT NULL, "
+            "tile_row INTEGER NOT NULL, "
+            "tile_data BLOB NOT NULL, "
+            "UNIQUE (zoom_level, tile_column, tile_row)"
+        ")")
+    cur.execute("COMMIT")
+    return db
+
+
+def mbtiles_create_dedup(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS map ("
         "zoom_level INTEGER NOT NULL, "
         "tile_column INTEGER NOT NULL, "
         "tile_row INTEGER NOT NULL, "
-        "tile_data BLOB NOT NULL, "
+        "tile_id TEXT NOT NULL, "
         "UNIQUE (zoom_level, tile_column, tile_row)"
     ")")
-    cur.execute("COMMIT")
-    return db
+    # finds the tiles still using an image, to drop unused ones
+    cur.execute("CREATE INDEX IF NOT EXISTS map_tile_id ON map (tile_id)")
+    cur.execute("CREATE TABLE IF NOT EXISTS images ("
+        "tile_id TEXT PRIMARY KEY, "
+        "tile_data BLOB NOT NULL"
+    ")")
+    cur.execute("CREATE VIEW tiles AS SELECT "
+        "map.zoom_level AS zoom_level, "
+        "map.tile_column AS tile_column, "
+        "map.tile_row AS tile_row, "
+        "images.tile_data AS tile_data "
+        "FROM map JOIN images ON images.tile_id = map.tile_id")
+
+
+def mbtiles_is_dedup(db):
+    row = db.execute("SELECT type FROM sqlite_master WHERE name='tiles'").fetchone()
+    return bool(row) and row[0] == 'view'
+
+
+class MBTilesWriter:
+    """
+    Buffer tile rows and write them with executemany, one transaction per
+    batch. A batch is flushed once it holds `batch_size` tiles or
+    `batch_bytes` of tile data. Rows use TMS numbering.
+    """
+
+    def __init__(self, db, batch_size=1000, batch_bytes=16*1024*1024):
+        self.db = db
+        self.dedup = mbtiles_is_dedup(db)
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.rows = []
+        self.nbytes = 0
+        self.written = 0
+
+    def add(self, zoom, x, y, data):
+        self.rows.append((zoom, x, y, data))
+        self.nbytes += len(data)
+        if len(self.rows) >= self.batch_size or self.nbytes >= self.batch_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        cur = self.db.cursor()
+        cur.execute("BEGIN")
+        if self.dedup:
+            rows = [(z, x, y, hashlib.md5(data).hexdigest(), data)
+                    for z, x, y, data in self.rows]
+            # images of the tiles being replaced, which may now be unused
+            replaced = set()
+            for row in rows:
+                old = cur.execute(
+                    "SELECT tile_id FROM map WHERE zoom_level=? AND "
+                    "tile_column=? AND tile_row=?", row[:3]).fetchone()
+                if old is not None and old[0] != row[3]:
+                    replaced.add(old[0])
+            cur.executemany("INSERT OR IGNORE INTO images VALUES (?,?)", (
+                row[3:] for row in rows))
+            cur.executemany("REPLACE INTO map VALUES (?,?,?,?)", (
+                row[:4] for row in rows))
+            cur.executemany(
+                "DELETE FROM images WHERE tile_id=? AND NOT EXISTS "
+                "(SELECT 1 FROM map WHERE tile_id=?)",
+                ((tile_id, tile_id) for tile_id in replaced))
+        else:
+            cur.executemany("REPLACE INTO tiles VALUES (?,?,?,?)", self.rows)
+        cur.execute("COMMIT")
+        self.written += len(self.rows)
+        self.rows = []
+        self.nbytes = 0
+
+
+def mbtiles_existing(db, zoom, bbox):
+    """Return the (x, y) XYZ tiles inside bbox that are already stored."""
+    n = 2**zoom
+    cur = db.execute(
+        "SELECT tile_column, tile_row FROM %s WHERE zoom_level=? "
+        "AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?" % (
+            'map' if mbtiles_is_dedup(db) else 'tiles'),
+        (zoom, bbox[0], bbox[2] - 1, n - bbox[3], n - 1 - bbox[1]))
+    return {(x, n - 1 - y) for x, y in cur}
+
+
+def mbtiles_read(db, zoom, bbox, row_major=False):
+    """
+    Yield ((x, y), tile_data) for the stored tiles inside bbox, row by row
+    from the north with `row_major`.
+    """
+    n = 2**zoom
+    cur = db.execute(
+        "SELECT tile_column, tile_row, tile_data FROM tiles WHERE zoom_level=? "
+        "AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?%s" % (
+            " ORDER BY tile_row DESC, tile_column" if row_major else ''),
+        (zoom, bbox[0], bbox[2] - 1, n - bbox[3], n - 1 - bbox[1]))
+    for x, y, data in cur:
+        yield (x, n - 1 - y), data
 
 
 def paste_tile(bigim, base_size, tile, corner_xy, bbox):
@@ -110,16 +462,113 @@ def paste_tile(bigim, base_size, tile, corner_xy, bbox):
     return newim
 
 
-def get_tile(url):
-    retry = 3
-    while 1:
-        try:
-            r = SESSION.get(url, timeout=60)
-            break
-        except Exception:
-            retry -= 1
-            if not retry:
-                raise
+class TileMosaic:
+    """
+    Composite tiles into a preallocated uint8 NumPy canvas of shape
+    (H, W, bands).
+
+    Each decoded tile is copied once into its view of the canvas, and
+    transparent tiles are skipped with a vectorised alpha check. The tile
+    size and mode come from the first tile, as with paste_tile.
+    """
+
+    def __init__(self, bbox, mode=None, telemetry=None):
+        self.bbox = bbox
+        self.canvas = None
+        self.mode = None
+        # force the canvas mode, e.g. RGBA to keep unfetched tiles transparent
+        self.force_mode = mode
+        self.tile_size = None
+        self.telemetry = telemetry
+
+    def _init(self, tile_size, mode):
+        self.tile_size = tile_size
+        self.mode = mode
+        height = tile_size[1] * (self.bbox[3] - self.bbox[1])
+        # one spare row lets array_to_image map any crop without copying
+        self.canvas = numpy.zeros((
+            height + 1, tile_size[0] * (self.bbox[2] - self.bbox[0]),
+            len(mode)), dtype=numpy.uint8)[:height]
+
+    def paste(self, tile, corner_xy):
+        if tile is None:
+            return
+        self.paste_array(decode_tile(tile, self.telemetry), corner_xy)
+
+    def paste_array(self, array, corner_xy):
+        """Paste a tile decoded by decode_tile."""
+        if self.telemetry is not None:
+            start = time.perf_counter()
+        if self.canvas is None:
+            self._init((array.shape[1], array.shape[0]), self.force_mode or (
+                'RGB' if array.shape[2] == 3 else 'RGBA'))
+        if array.shape[2] != len(self.mode):
+            if self.mode == 'RGB':
+                array = array[..., :3]
+            else:
+                array = numpy.dstack((array, numpy.full(
+                    array.shape[:2], 255, dtype=numpy.uint8)))
+        if self.mode == 'RGBA' and not array[..., 3].any():
+            return
+        w, h = self.tile_size
+        dx = corner_xy[0] - self.bbox[0]
+        dy = corner_xy[1] - self.bbox[1]
+        self.canvas[dy*h:(dy+1)*h, dx*w:(dx+1)*w] = array
+        if self.telemetry is not None:
+            self.telemetry.record('composite', time.perf_counter() - start)
+
+    def crop(self, x0, y0, x1, y1):
+        """
+        Return a view of the tile-grid pixels inside the fractional tile
+        extent; opaque RGBA is reduced to its RGB bands.
+        """
+        if self.canvas is None:
+            self._init((256, 256), 'RGBA')
+        x2, y2, imgw, imgh = crop_window(x0, y0, x1, y1, self.bbox, self.tile_size)
+        view = self.canvas[y2:y2+imgh, x2:x2+imgw]
+        if self.mode == 'RGBA' and (view[..., 3] == 255).all():
+            view = view[..., :3]
+        return view
+
+
+def decode_tile(tile, telemetry=None):
+    """Decode tile data to an (H, W, 3) RGB or (H, W, 4) RGBA uint8 array."""
+    if telemetry is not None:
+        start = time.perf_counter()
+    with Image.open(io.BytesIO(tile)) as im:
+        if im.mode not in ('RGB', 'RGBA'):
+            im = im.convert('RGBA')
+        array = numpy.asarray(im)
+    if telemetry is not None:
+        telemetry.record('decode', time.perf_counter() - start)
+    return array
+
+
+def array_to_image(array):
+    """
+    Wrap an (H, W, bands) uint8 array, or a cropped view of one, as a PIL
+    image. RGBA shares the array's memory; RGB is unpacked once by PIL.
+    """
+    h, w, bands = array.shape
+    row_stride, pixel_stride, band_stride = array.strides
+    root = array
+    while isinstance(root.base, numpy.ndarray):
+        root = root.base
+    # PIL wants `row_stride * h` bytes from the first pixel on
+    available = (root.__array_interface__['data'][0] + root.nbytes -
+                 array.__array_interface__['data'][0])
+    if (array.dtype != numpy.uint8 or bands not in (3, 4) or band_stride != 1
+            or pixel_stride not in (bands, 4) or row_stride <= 0
+            or not root.flags.c_contiguous or available < row_stride * h):
+        return Image.fromarray(numpy.ascontiguousarray(array))
+    buf = numpy.lib.stride_tricks.as_strided(
+        array, shape=(row_stride * h,), strides=(1,))
+    mode = 'RGB' if bands == 3 else 'RGBA'
+    rawmode = 'RGBX' if pixel_stride != bands else mode
+    return Image.frombuffer(mode, (w, h), buf, 'raw', rawmode, row_stride, 1)
+
+
+def tile_content(r):
     if r.status_code == 404:
         return None
     elif not r.content:
@@ -128,9 +577,1312 @@ def get_tile(url):
     return r.content
 
 
-def print_progress(progress, total, done=False):
+CacheEntry = collections.namedtuple(
+    'CacheEntry', 'data etag last_modified fetched fresh')
+
+
+class TileCache:
+    """
+    Persistent tile cache in a SQLite file, keyed by (source, z, x, y).
+
+    Entries older than `ttl` seconds are revalidated with a conditional
+    request (If-None-Match / If-Modified-Since). Once the stored tiles exceed
+    `max_bytes`, the least recently used ones are evicted. Missing tiles are
+    cached as empty blobs so they are not requested again either.
+    """
+
+    def __init__(self, filename, max_bytes=1024*1024*1024, ttl=7*86400):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            filename, isolation_level=None, check_same_thread=False, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS tile_cache ("
+            "source TEXT NOT NULL, "
+            "zoom_level INTEGER NOT NULL, "
+            "tile_column INTEGER NOT NULL, "
+            "tile_row INTEGER NOT NULL, "
+            "tile_data BLOB NOT NULL, "
+            "etag TEXT, "
+            "last_modified TEXT, "
+            "fetched REAL NOT NULL, "
+            "accessed REAL NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "PRIMARY KEY (source, zoom_level, tile_column, tile_row)"
+        ")")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tile_cache_accessed "
+            "ON tile_cache (accessed)")
+        self.total_bytes = self._stored_bytes()
+
+    def _stored_bytes(self):
+        return self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM tile_cache").fetchone()[0]
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT tile_data, etag, last_modified, fetched FROM tile_cache "
+                "WHERE source=? AND zoom_level=? AND tile_column=? AND tile_row=?",
+                key).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE tile_cache SET accessed=? WHERE source=? AND "
+                "zoom_level=? AND tile_column=? AND tile_row=?", (now,) + key)
+            fresh = now - row[3] < self.ttl
+            if fresh:
+                self.hits += 1
+        return CacheEntry(*row, fresh=fresh)
+
+    def put(self, key, data, etag=None, last_modified=None):
+        now = time.time()
+        data = data or b''
+        with self.lock:
+            row = self.db.execute(
+                "SELECT size FROM tile_cache WHERE source=? AND zoom_level=? "
+                "AND tile_column=? AND tile_row=?", key).fetchone()
+            self.db.execute(
+                "REPLACE INTO tile_cache VALUES (?,?,?,?,?,?,?,?,?,?)",
+                key + (data, etag, last_modified, now, now, len(data)))
+            self.total_bytes += len(data) - (row[0] if row else 0)
+            self.misses += 1
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def touch(self, key):
+        with self.lock:
+            self.db.execute(
+                "UPDATE tile_cache SET fetched=? WHERE source=? AND "
+                "zoom_level=? AND tile_column=? AND tile_row=?",
+                (time.time(),) + key)
+            self.revalidated += 1
+
+    def _evict(self):
+        # other processes may share the file, so recount before deleting
+        self.total_bytes = self._stored_bytes()
+        excess = self.total_bytes - self.max_bytes
+        if excess <= 0:
+            return
+        victims = []
+        cur = self.db.execute(
+            "SELECT source, zoom_level, tile_column, tile_row, size "
+            "FROM tile_cache ORDER BY accessed")
+        for row in cur:
+            victims.append(row[:4])
+            excess -= row[4]
+            self.total_bytes -= row[4]
+            if excess <= 0:
+                break
+        cur.close()
+        self.db.execute("BEGIN")
+        self.db.executemany(
+            "DELETE FROM tile_cache WHERE source=? AND zoom_level=? "
+            "AND tile_column=? AND tile_row=?", victims)
+        self.db.execute("COMMIT")
+
+    def request_headers(self, entry):
+        if entry is None:
+            return None
+        headers = {}
+        if entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers or None
+
+    def response(self, key, entry, r):
+        """Store a response (or apply a 304) and return the tile data."""
+        if r.status_code == 304 and entry is not None:
+            self.touch(key)
+            return entry.data or None
+        data = tile_content(r)
+        self.put(key, data, r.headers.get('ETag'), r.headers.get('Last-Modified'))
+        return data
+
+    def stats(self):
+        return {
+            'hits': self.hits, 'revalidated': self.revalidated,
+            'misses': self.misses, 'bytes': self.total_bytes,
+        }
+
+    def close(self):
+        self.db.close()
+
+
+BLANK_TILE_MAX_BYTES = 4096
+
+
+def is_blank_tile(data):
+    """Whether fetched tile data is missing or fully transparent."""
+    if not data:
+        return True
+    # fully transparent tiles compress to almost nothing
+    if len(data) > BLANK_TILE_MAX_BYTES:
+        return False
+    with Image.open(io.BytesIO(data)) as im:
+        if im.mode not in ('RGBA', 'LA', 'PA') and not (
+                im.mode == 'P' and 'transparency' in im.info):
+            return False
+        return im.convert('RGBA').getextrema()[3] == (0, 0)
+
+
+class BlankTileIndex:
+    """
+    Persistent index of tiles known to be blank (404, no content or fully
+    transparent), consulted before scheduling so later runs don't request
+    them again.
+
+    Each source and zoom level is covered by packed bitsets of BLOCK x BLOCK
+    tiles, stored zlib-compressed in a SQLite file. A block expires `ttl`
+    seconds after its first bit was set and is then forgotten as a whole.
+    """
+    BLOCK = 256
+
+    def __init__(self, filename, ttl=30*86400):
+        self.filename = filename
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.blocks = {}
+        self.dirty = set()
+        self.db = sqlite3.connect(
+            filename, isolation_level=None, check_same_thread=False, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS blank_tiles ("
+            "source TEXT NOT NULL, "
+            "zoom_level INTEGER NOT NULL, "
+            "block_column INTEGER NOT NULL, "
+            "block_row INTEGER NOT NULL, "
+            "bits BLOB NOT NULL, "
+            "created REAL NOT NULL, "
+            "PRIMARY KEY (source, zoom_level, block_column, block_row)"
+        ")")
+
+    def _locate(self, source, zoom, x, y):
+        bx, ox = divmod(x, self.BLOCK)
+        by, oy = divmod(y, self.BLOCK)
+        return (str(source), zoom, bx, by), oy * self.BLOCK + ox
+
+    def _block(self, key):
+        block = self.blocks.get(key)
+        if block is None:
+            row = self.db.execute(
+                "SELECT bits, created FROM blank_tiles WHERE source=? AND "
+                "zoom_level=? AND block_column=? AND block_row=?", key).fetchone()
+            if row and row[1] > time.time() - self.ttl:
+                block = [bytearray(zlib.decompress(row[0])), row[1]]
+            else:
+                block = [None, None]
+            self.blocks[key] = block
+        return block
+
+    def is_blank(self, source, zoom, x, y):
+        key, bit = self._locate(source, zoom, x, y)
+        with self.lock:
+            bits = self._block(key)[0]
+        return bits is not None and bool(bits[bit >> 3] >> (bit & 7) & 1)
+
+    def blank_tiles(self, source, zoom, tiles):
+        """The subset of (x, y) `tiles` known to be blank."""
+        return {xy for xy in tiles if self.is_blank(source, zoom, *xy)}
+
+    def add(self, source, zoom, x, y):
+        key, bit = self._locate(source, zoom, x, y)
+        with self.lock:
+            block = self._block(key)
+            if block[0] is None:
+                block[:] = [bytearray(self.BLOCK * self.BLOCK // 8), time.time()]
+            block[0][bit >> 3] |= 1 << (bit & 7)
+            self.dirty.add(key)
+
+    def flush(self):
+        with self.lock:
+            rows = [key + (zlib.compress(bytes(self.blocks[key][0])),
+                           self.blocks[key][1]) for key in self.dirty]
+            self.dirty.clear()
+        self.db.execute("BEGIN")
+        self.db.executemany(
+            "REPLACE INTO blank_tiles VALUES (?,?,?,?,?,?)", rows)
+        self.db.execute("DELETE FROM blank_tiles WHERE created < ?",
+                        (time.time() - self.ttl,))
+        self.db.execute("COMMIT")
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+def quadkey(x, y, zoom):
+    """Bing Maps quadkey of a tile."""
+    digits = []
+    for i in range(zoom, 0, -1):
+        mask = 1 << (i - 1)
+        digits.append(str((1 if x & mask else 0) + (2 if y & mask else 0)))
+    return ''.join(digits)
+
+
+class TileSource:
+    """
+    A tile URL template.
+
+    Besides {z}, {x} and {y}, templates may use {q} (Bing quadkey), {-y}
+    (row counted from the south) and {s}, which rotates round-robin over
+    `subdomains`; requests to each host get their own connection pool and
+    concurrency window. `tms=True` flips {y} for servers whose rows count
+    from the south. `matrices` maps zoom levels to WMTS TileMatrix
+    identifiers for {m} (see wmts_source).
+    """
+
+    def __init__(self, template, subdomains='abc', tms=False, matrices=None):
+        self.template = template
+        self.subdomains = subdomains
+        self.tms = tms
+        self.matrices = matrices
+        # a plain int, so sources pickle for worker processes; threads
+        # racing on it at worst send two tiles to the same host
+        self.next_shard = 0
+        self.fields = {
+            name for _, name, _, _ in string.Formatter().parse(template) if name}
+
+    def shard(self):
+        """Index of the next {s} subdomain, for url(shard=...)."""
+        shard = self.next_shard
+        self.next_shard += 1
+        return shard
+
+    def url(self, zoom, x, y, shard=None):
+        row = (1 << zoom) - 1 - y
+        params = {'z': zoom, 'x': x, 'y': row if self.tms else y, '-y': row}
+        if 'q' in self.fields:
+            params['q'] = quadkey(x, y, zoom)
+        if 's' in self.fields:
+            if shard is None:
+                shard = self.shard()
+            params['s'] = self.subdomains[shard % len(self.subdomains)]
+        if self.matrices is not None:
+            if zoom not in self.matrices:
+                raise ValueError("Zoom %d is not in the tile matrix set" % zoom)
+            params['m'] = self.matrices[zoom]
+        return self.template.format(**params)
+
+    def __str__(self):
+        return self.template
+
+
+def tile_source(source):
+    if isinstance(source, TileSource):
+        return source
+    return TileSource(source)
+
+
+WMTS_NS = {
+    'wmts': 'http://www.opengis.net/wmts/1.0',
+    'ows': 'http://www.opengis.net/ows/1.1',
+    'xlink': 'http://www.w3.org/1999/xlink',
+}
+# half the width of the Web Mercator world in metres
+WEB_MERCATOR_ORIGIN = math.pi * EARTH_EQUATORIAL_RADIUS
+
+
+def wmts_matrices(matrix_set):
+    """
+    Map XYZ zoom levels to the TileMatrix identifiers of a WMTS
+    TileMatrixSet, or return None if it is not the Web Mercator tile grid.
+    """
+    matrices = {}
+    for tm in matrix_set.findall('wmts:TileMatrix', WMTS_NS):
+        scale = float(tm.findtext('wmts:ScaleDenominator', namespaces=WMTS_NS))
+        corner = tm.findtext('wmts:TopLeftCorner', namespaces=WMTS_NS).split()
+        width = int(tm.findtext('wmts:TileWidth', namespaces=WMTS_NS))
+        # 0.28 mm is the standardized rendering pixel size
+        resolution = scale * 0.00028
+        zoom = math.log2(2 * WEB_MERCATOR_ORIGIN / (width * resolution))
+        if (abs(zoom - round(zoom)) > 0.01 or
+                any(abs(abs(float(v)) - WEB_MERCATOR_ORIGIN) > 1 for v in corner)):
+            return None
+        matrices[round(zoom)] = tm.findtext('ows:Identifier', namespaces=WMTS_NS)
+    return matrices or None
+
+
+def wmts_source(capabilities, layer=None, matrix_set=None, style=None,
+                img_format=None):
+    """
+    Build a TileSource from a WMTS GetCapabilities document (XML text or
+    bytes, or its URL). Uses the layer's RESTful tile template if there is
+    one, KVP GetTile requests otherwise. Only tile matrix sets on the Web
+    Mercator XYZ grid are supported.
+    """
+    if isinstance(capabilities, str) and not capabilities.lstrip().startswith('<'):
+        r = SESSION.get(capabilities, timeout=60)
+        r.raise_for_status()
+        capabilities = r.content
+    root = ElementTree.fromstring(capabilities)
+
+    def ident(el):
+        return el.findtext('ows:Identifier', namespaces=WMTS_NS)
+
+    layers = root.findall('wmts:Contents/wmts:Layer', WMTS_NS)
+    layer_el = next((el for el in layers if layer in (None, ident(el))), None)
+    if layer_el is None:
+        raise ValueError("Layer not found: %s (available: %s)" % (
+            layer, ', '.join(map(ident, layers))))
+    if style is None:
+        styles = layer_el.findall('wmts:Style', WMTS_NS)
+        default = [el for el in styles if el.get('isDefault') == 'true']
+        style = ident((default or styles)[0]) if styles else 'default'
+    links = [el.findtext('wmts:TileMatrixSet', namespaces=WMTS_NS)
+             for el in layer_el.findall('wmts:TileMatrixSetLink', WMTS_NS)]
+    matrices = None
+    for el in root.findall('wmts:Contents/wmts:TileMatrixSet', WMTS_NS):
+        if ident(el) in links and matrix_set in (None, ident(el)):
+            matrices = wmts_matrices(el)
+            if matrices:
+                matrix_set = ident(el)
+                break
+    if not matrices:
+        raise ValueError("No Web Mercator tile matrix set for layer %s" % ident(layer_el))
+    values = {'Style': style, 'TileMatrixSet': matrix_set}
+    for dim in layer_el.findall('wmts:Dimension', WMTS_NS):
+        values[ident(dim)] = dim.findtext('wmts:Default', namespaces=WMTS_NS)
+    resources = [el for el in layer_el.findall('wmts:ResourceURL', WMTS_NS)
+                 if el.get('resourceType') == 'tile' and
+                 img_format in (None, el.get('format'))]
+    if resources:
+        template = resources[0].get('template')
+        for name, value in values.items():
+            template = template.replace('{%s}' % name, value)
+        template = (template.replace('{TileMatrix}', '{m}')
+                    .replace('{TileRow}', '{y}').replace('{TileCol}', '{x}'))
+    else:
+        href = root.find(
+            "ows:OperationsMetadata/ows:Operation[@name='GetTile']/ows:DCP/"
+            "ows:HTTP/ows:Get", WMTS_NS).get('{%s}href' % WMTS_NS['xlink'])
+        img_format = img_format or layer_el.findtext('wmts:Format', namespaces=WMTS_NS)
+        query = urllib.parse.urlencode((
+            ('SERVICE', 'WMTS'), ('REQUEST', 'GetTile'), ('VERSION', '1.0.0'),
+            ('LAYER', ident(layer_el)), ('STYLE', style),
+            ('TILEMATRIXSET', matrix_set), ('FORMAT', img_format),
+        ) + tuple((k.upper(), v) for k, v in values.items()
+                  if k not in ('Style', 'TileMatrixSet')))
+        if not href.endswith(('?', '&')):
+            href += '&' if '?' in href else '?'
+        url = href + query
+        template = (url.replace('{', '{{').replace('}', '}}') +
+                    '&TILEMATRIX={m}&TILEROW={y}&TILECOL={x}')
+    return TileSource(template, matrices=matrices)
+
+
+TILE_RETRIES = 5
+THROTTLE_STATUS = (429, 503)
+
+
+def is_timeout(ex):
+    # requests.Timeout, httpx.TimeoutException, socket.timeout
+    return isinstance(ex, TimeoutError) or 'Timeout' in type(ex).__name__
+
+
+def retry_after_seconds(r):
+    value = r.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp()
+                   - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def response_signal(r):
+    """How a response should steer the concurrency controller and retries."""
+    throttled = r.status_code in THROTTLE_STATUS
+    return {
+        'error': throttled or r.status_code >= 500,
+        'throttled': throttled,
+        'retry_after': retry_after_seconds(r) if throttled else None,
+    }
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Seconds to wait before retrying: Retry-After, or jittered exponential."""
+    if retry_after is not None:
+        return min(retry_after, 300)
+    return random.uniform(0.5, 1.0) * min(30, 0.5 * 2 ** attempt)
+
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of durations in the spirit of HdrHistogram: values
+    are counted in microsecond buckets with 32 sub-buckets per power of
+    two, so percentiles are within about 3% over any range.
+    """
+    SUB_BITS = 5
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        value = max(0, int(seconds * 1e6))
+        shift = max(0, value.bit_length() - self.SUB_BITS - 1)
+        self.counts[(shift << self.SUB_BITS) + (value >> shift)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def bucket_value(self, bucket):
+        shift = max(0, (bucket >> self.SUB_BITS) - 1)
+        low = (bucket - (shift << self.SUB_BITS)) << shift
+        return (low + (1 << shift) / 2) / 1e6
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(q / 100 * self.count))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.bucket_value(bucket), self.max)
+        return self.max
+
+    def summary(self):
+        result = {'count': self.count, 'total': round(self.total, 6),
+                  'mean': round(self.total / self.count, 6) if self.count else 0.0}
+        for q in PERCENTILES:
+            result['p%g' % q] = round(self.percentile(q), 6)
+        result['max'] = round(self.max, 6)
+        return result
+
+
+class Telemetry:
+    """
+    Timings and counters for one download: per-stage latency histograms
+    (queue wait, HTTP, decode, composite, MBTiles writes), response status
+    codes, bytes received, retries and cache hits.
+
+    Pass one as `telemetry` to download_extent or download_batch; with the
+    default of None nothing is measured. The NumPy mosaic times decoding
+    separately, the other compositors count it under "composite".
+    download_extent also samples the depth of its fetch, decode and write
+    queues.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = collections.defaultdict(LatencyHistogram)
+        self.status = collections.Counter()
+        self.counters = collections.Counter()
+        # queue: [samples, sum, max]
+        self.queues = collections.defaultdict(lambda: [0, 0, 0])
+        self.started = time.time()
+        self.finished = None
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.stages[stage].add(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def queue_depth(self, queue, depth):
+        with self.lock:
+            entry = self.queues[queue]
+            entry[0] += 1
+            entry[1] += depth
+            entry[2] = max(entry[2], depth)
+
+    def request(self, seconds, r=None, error=None):
+        """Record one HTTP attempt, with its response or the exception raised."""
+        if r is not None:
+            status = str(r.status_code)
+        else:
+            status = type(error).__name__ if error is not None else 'cancelled'
+        with self.lock:
+            self.stages['http'].add(seconds)
+            self.status[status] += 1
+            if r is not None:
+                self.counters['bytes'] += len(r.content)
+
+    def summary(self):
+        with self.lock:
+            return {
+                'started': self.started,
+                'seconds': round((self.finished or time.time()) - self.started, 3),
+                'counters': dict(sorted(self.counters.items())),
+                'status_codes': dict(sorted(self.status.items())),
+                'stages': {name: hist.summary()
+                           for name, hist in sorted(self.stages.items())},
+                'queues': {name: {'mean': round(total / samples, 3), 'max': peak}
+                           for name, (samples, total, peak)
+                           in sorted(self.queues.items())},
+            }
+
+    def write_json(self, filename):
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, filename):
+        """Write the summary for the node_exporter textfile collector."""
+        summary = self.summary()
+        lines = [
+            '# HELP tms2geotiff_stage_seconds Time spent per tile in each stage.',
+            '# TYPE tms2geotiff_stage_seconds summary',
+        ]
+        for name, stage in summary['stages'].items():
+            for q in PERCENTILES:
+                lines.append('tms2geotiff_stage_seconds{stage="%s",quantile="%g"} %g'
+                             % (name, q / 100, stage['p%g' % q]))
+            lines.append('tms2geotiff_stage_seconds_sum{stage="%s"} %g' % (
+                name, stage['total']))
+            lines.append('tms2geotiff_stage_seconds_count{stage="%s"} %d' % (
+                name, stage['count']))
+        lines.append('# TYPE tms2geotiff_responses_total counter')
+        for status, n in summary['status_codes'].items():
+            lines.append('tms2geotiff_responses_total{status="%s"} %d' % (status, n))
+        for name, n in summary['counters'].items():
+            lines.append('# TYPE tms2geotiff_%s_total counter' % name)
+            lines.append('tms2geotiff_%s_total %d' % (name, n))
+        lines.append('# TYPE tms2geotiff_queue_depth gauge')
+        for name, queue in summary['queues'].items():
+            for stat in ('mean', 'max'):
+                lines.append('tms2geotiff_queue_depth{queue="%s",stat="%s"} %g'
+                             % (name, stat, queue[stat]))
+        lines.append('# TYPE tms2geotiff_run_seconds gauge')
+        lines.append('tms2geotiff_run_seconds %g' % summary['seconds'])
+        # the collector may read the file at any time, so replace it whole
+        with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(filename + '.tmp', filename)
+
+
+class AIMDController:
+    """
+    Limit the requests in flight to one host, adapting the window with
+    additive increase / multiplicative decrease.
+
+    The window grows by about one request per window of successful
+    responses while the error rate and p95 latency stay healthy (p95 within
+    `latency_factor` of the best p95 seen), and is cut by `decrease` on
+    429/503 responses and timeouts, at most once per round trip. A
+    Retry-After pauses all requests to the host. Slots waited for with
+    `priority` (hedged requests) go to those before any other request.
+    """
+
+    def __init__(self, initial=5, maximum=None, minimum=1, decrease=0.5,
+                 latency_factor=2.0, max_error_rate=0.05, samples=64):
+        self.limit = float(initial)
+        self.maximum = max(maximum or initial, initial)
+        self.minimum = minimum
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.max_error_rate = max_error_rate
+        self.latencies = collections.deque(maxlen=samples)
+        self.errors = collections.deque(maxlen=samples)
+        self.baseline = None
+        self.in_flight = 0
+        self.reserved = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.throttled = 0
+        self.lock = threading.Condition()
+
+    @property
+    def window(self):
+        return int(self.limit)
+
+    def free(self, priority=False):
+        """Number of requests that may start right now."""
+        if time.monotonic() < self.paused_until:
+            return 0
+        reserved = 0 if priority else self.reserved
+        return max(0, int(self.limit) - self.in_flight - reserved)
+
+    def try_acquire(self, priority=False):
+        """Take a slot and return its start time, or None if none is free."""
+        with self.lock:
+            if not self.free(priority):
+                return None
+            self.in_flight += 1
+            return time.monotonic()
+
+    def reserve(self, count):
+        """Add `count` (or take it back, if negative) priority waiters."""
+        with self.lock:
+            self.reserved += count
+            self.lock.notify_all()
+
+    def acquire(self, timeout=None, priority=False):
+        """
+        Block until a slot is free and return its start time, or None if
+        none was after `timeout` seconds.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            self.reserved += priority
+            try:
+                while 1:
+                    if self.free(priority):
+                        self.in_flight += 1
+                        return time.monotonic()
+                    now = time.monotonic()
+                    if end is not None and now >= end:
+                        return None
+                    wait = [t - now for t in (self.paused_until, end)
+                            if t is not None and t > now]
+                    self.lock.wait(min(wait) if wait else None)
+            finally:
+                self.reserved -= priority
+                if priority:
+                    self.lock.notify_all()
+
+    def healthy(self):
+        if (len(self.errors) >= 10 and
+                sum(self.errors) / len(self.errors) > self.max_error_rate):
+            return False
+        if len(self.latencies) < 16:
+            return True
+        latencies = sorted(self.latencies)
+        p95 = latencies[int(len(latencies) * 0.95)]
+        if self.baseline is None or p95 < self.baseline:
+            self.baseline = p95
+        return p95 <= self.baseline * self.latency_factor
+
+    def release(self, started, signal=None):
+        """
+        Free the slot taken at `started` and adjust the window according to
+        `signal` (from response_signal; None if the request never finished).
+        Returns the seconds left in a Retry-After pause.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.in_flight -= 1
+            if signal is not None:
+                self.errors.append(signal['error'])
+                if signal['throttled']:
+                    self.throttled += 1
+                    # requests sent before the last cut don't cut again
+                    if started >= self.last_decrease:
+                        self.limit = max(self.minimum, self.limit * self.decrease)
+                        self.last_decrease = now
+                    if signal['retry_after']:
+                        self.paused_until = max(
+                            self.paused_until, now + signal['retry_after'])
+                elif not signal['error']:
+                    self.latencies.append(now - started)
+                    if self.healthy():
+                        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.lock.notify_all()
+            return max(0.0, self.paused_until - now)
+
+
+class Hedger:
+    """
+    Duplicate slow tile requests ("hedged requests") to cut tail latency.
+
+    Once `warmup` requests have completed, a request still running after
+    `factor` times the `quantile` of recent request latencies gets one
+    duplicate, sent to the next {s} host when the source has several, and
+    whichever answers first wins. The factor keeps the ordinary tail above
+    the quantile (by definition 5% of requests for p95) from spending the
+    budget meant for stalls. Hedges are capped at `max_rate` of all
+    requests and take a slot of their host's concurrency window. A losing
+    original request is left to finish, so its latency shows what the tile
+    would have taken without hedging (the async engine cancels those still
+    running when it closes and counts the time so far); with `telemetry`,
+    both are recorded as the "tile" and "tile_unhedged" stages.
+    """
+
+    def __init__(self, quantile=95, max_rate=0.05, min_delay=0.05,
+                 warmup=20, samples=256, telemetry=None, factor=2.0):
+        self.quantile = quantile
+        self.factor = factor
+        self.max_rate = max_rate
+        self.min_delay = min_delay
+        self.warmup = warmup
+        self.telemetry = telemetry
+        self.latencies = collections.deque(maxlen=samples)
+        self.completion = LatencyHistogram()
+        self.unhedged = LatencyHistogram()
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+        self.lock = threading.Lock()
+
+    def deadline(self):
+        """Seconds to wait before hedging a request, or None to not hedge."""
+        with self.lock:
+            self.requests += 1
+            if len(self.latencies) < self.warmup:
+                return None
+            latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.quantile / 100))
+        return max(self.min_delay, self.factor * latencies[index])
+
+    def allow(self):
+        """Take a hedge from the budget, if any is left."""
+        with self.lock:
+            if self.hedges + 1 > self.max_rate * self.requests:
+                return False
+            self.hedges += 1
+        if self.telemetry is not None:
+            self.telemetry.count('hedges')
+        return True
+
+    def primary_done(self, seconds, finished=True):
+        """The first request for a tile finished (or was cancelled) after `seconds`."""
+        with self.lock:
+            if finished:
+                self.latencies.append(seconds)
+            self.unhedged.add(seconds)
+        if self.telemetry is not None:
+            self.telemetry.record('tile_unhedged', seconds)
+
+    def completed(self, seconds, hedge_won=False):
+        """A tile's data arrived `seconds` after its first request."""
+        with self.lock:
+            self.completion.add(seconds)
+            self.wins += hedge_won
+        if self.telemetry is not None:
+            self.telemetry.record('tile', seconds)
+            if hedge_won:
+                self.telemetry.count('hedge_wins')
+
+    def summary(self):
+        with self.lock:
+            return {
+                'hedges': self.hedges, 'hedge_wins': self.wins,
+                'p99': self.completion.percentile(99),
+                'p99_unhedged': self.unhedged.percentile(99),
+            }
+
+
+def error_signal(error):
+    """response_signal for a request that raised `error`."""
+    return {'error': True, 'throttled': is_timeout(error), 'retry_after': None}
+
+
+def hedged_get(hedger, url, alternate, headers, executor, controller=None,
+               started=None, alternate_controller=None, alternate_executor=None):
+    """
+    SESSION.get on `executor`, with a duplicate request to `alternate` on
+    `alternate_executor` (default: the same) if it runs late.
+
+    Each request holds a slot of its host's controller until it finishes,
+    including a losing one left running, so hedges never push the requests
+    in flight past the window: a hedge waits for a slot like any other
+    request, and is dropped if the original answers meanwhile. The slot of
+    the first request was taken at `started`.
+    """
+    start = time.perf_counter()
+
+    def finished(controller, started, primary):
+        def done(future):
+            error = future.exception()
+            if primary and error is None:
+                hedger.primary_done(time.perf_counter() - start)
+            if controller is not None:
+                controller.release(started, error_signal(error) if error
+                                   else response_signal(future.result()))
+        return done
+
+    primary = executor.submit(SESSION.get, url, timeout=60, headers=headers)
+    primary.add_done_callback(finished(controller, started, True))
+    pending = {primary}
+    deadline = hedger.deadline()
+    if deadline is not None:
+        concurrent.futures.wait(pending, timeout=deadline)
+        hedge_started = None
+        while (alternate_controller is not None and hedge_started is None
+               and not primary.done()):
+            hedge_started = alternate_controller.acquire(
+                hedger.min_delay, priority=True)
+        if not primary.done() and hedger.allow():
+            hedge = (alternate_executor or executor).submit(
+                SESSION.get, alternate, timeout=60, headers=headers)
+            hedge.add_done_callback(
+                finished(alternate_controller, hedge_started, False))
+            pending.add(hedge)
+        elif hedge_started is not None:
+            alternate_controller.release(hedge_started)
+    while 1:
+        done, pending = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        winner = next((f for f in done if f.exception() is None), None)
+        if winner is not None or not pending:
+            break
+    if winner is None:
+        return primary.result()
+    hedger.completed(time.perf_counter() - start, winner is not primary)
+    return winner.result()
+
+
+def host_controller(controllers, url, concurrency, max_concurrency):
+    host = urllib.parse.urlsplit(url).netloc
+    controller = controllers.get(host)
+    if controller is None:
+        controller = controllers[host] = AIMDController(concurrency, max_concurrency)
+    return controller
+
+
+def get_tile(url, cache=None, key=None, controller=None, telemetry=None,
+             submitted=None, hedger=None, alternate=None, cancelled=None,
+             executor=None, alternate_controller=None, alternate_executor=None,
+             retries=TILE_RETRIES, timeout=60):
+    entry = None
+    headers = None
+    if cache is not None:
+        entry = cache.get(key)
+        if entry is not None and entry.fresh:
+            if telemetry is not None:
+                telemetry.count('cache_hits')
+            return entry.data or None
+        headers = cache.request_headers(entry)
+    attempt = 0
+    while 1:
+        attempt += 1
+        if cancelled is not None and cancelled.is_set():
+            raise concurrent.futures.CancelledError()
+        started = controller.acquire() if controller is not None else None
+        if telemetry is not None:
+            request_start = time.perf_counter()
+            if attempt == 1 and submitted is not None:
+                telemetry.record('queue', request_start - submitted)
+        r = signal = error = None
+        try:
+            if hedger is not None:
+                # releases the slots itself, when each request finishes
+                r = hedged_get(hedger, url, alternate or url, headers, executor,
+                               controller, started, alternate_controller,
+                               alternate_executor)
+            else:
+                r = SESSION.get(url, timeout=timeout, headers=headers)
+            signal = response_signal(r)
+        except Exception as ex:
+            error = ex
+            signal = error_signal(ex)
+            if attempt >= retries:
+                raise
+        finally:
+            if controller is not None and hedger is None:
+                controller.release(started, signal)
+            if telemetry is not None:
+                telemetry.request(time.perf_counter() - request_start, r, error)
+        if r is not None and (not signal['error'] or attempt >= retries):
+            break
+        if telemetry is not None:
+            telemetry.count('retries')
+        delay = backoff_delay(attempt, signal['retry_after'])
+        if cancelled is not None:
+            cancelled.wait(delay)
+        else:
+            time.sleep(delay)
+    if cache is not None:
+        return cache.response(key, entry, r)
+    return tile_content(r)
+
+
+class ThreadTileFetcher:
+    """
+    Fetch tiles with get_tile on pools of worker threads, one per host.
+
+    Requests in flight per host start at `concurrency` and adapt up to
+    `max_concurrency` (see AIMDController); each host has that many
+    workers, so a throttled host doesn't hold up the others. After
+    cancel(), blocking requests already on the wire are abandoned rather
+    than waited for.
+    """
+
+    def __init__(self, concurrency=5, cache=None, max_concurrency=None,
+                 telemetry=None, hedger=None):
+        self.concurrency = concurrency
+        self.max_concurrency = max(max_concurrency or concurrency, concurrency)
+        self.cache = cache
+        self.telemetry = telemetry
+        self.hedger = hedger
+        self.controllers = {}
+        # controller: (workers, requests); with a hedger, hedged requests
+        # and their originals run on `requests` while a worker waits for
+        # the first answer
+        self.pools = {}
+        self.cancelled = threading.Event()
+
+    def host(self, url):
+        controller = host_controller(
+            self.controllers, url, self.concurrency, self.max_concurrency)
+        pools = self.pools.get(controller)
+        if pools is None:
+            pools = self.pools[controller] = (
+                concurrent.futures.ThreadPoolExecutor(self.max_concurrency),
+                concurrent.futures.ThreadPoolExecutor(self.max_concurrency)
+                if self.hedger is not None else None)
+        return controller, pools
+
+    def submit(self, url, key=None, alternate=None):
+        if self.cancelled.is_set():
+            raise RuntimeError("cannot schedule new futures after cancel")
+        controller, (workers, requests) = self.host(url)
+        alternate_controller = alternate_requests = None
+        if self.hedger is not None:
+            alternate_controller, (_, alternate_requests) = self.host(
+                alternate or url)
+        submitted = time.perf_counter() if self.telemetry is not None else None
+        return workers.submit(
+            get_tile, url, self.cache, key, controller, self.telemetry, submitted,
+            self.hedger, alternate, self.cancelled, requests,
+            alternate_controller, alternate_requests)
+
+    def window(self):
+        return sum(c.window for c in list(self.controllers.values()))
+
+    def cancel(self):
+        """Drop queued requests and stop retrying the ones in flight."""
+        self.cancelled.set()
+        for workers, _ in list(self.pools.values()):
+            workers.shutdown(wait=False, cancel_futures=True)
+
+    def close(self):
+        for workers, requests in list(self.pools.values()):
+            workers.shutdown(
+                wait=not self.cancelled.is_set(), cancel_futures=True)
+            if requests is not None:
+                # losing originals finish in the background
+                requests.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class AsyncTileFetcher:
+    """
+    Fetch tiles with an httpx.AsyncClient (HTTP/2 when h2 is installed).
+
+    The event loop runs in a background thread and submit() returns
+    concurrent.futures.Future objects, so download_extent can wait on and
+    cancel them exactly like thread pool futures. Cancelling a future
+    cancels the request in flight. Requests in flight per host start at
+    `concurrency` and adapt up to `max_concurrency` (see AIMDController).
+    """
+
+    def __init__(self, concurrency=16, cache=None, http2=True, timeout=60,
+                 max_concurrency=None, telemetry=None, hedger=None):
+        if httpx is None:
+            raise RuntimeError("The async engine needs httpx")
+        self.concurrency = concurrency
+        self.max_concurrency = max(max_concurrency or concurrency, concurrency)
+        self.cache = cache
+        self.telemetry = telemetry
+        self.hedger = hedger
+        self.http2 = http2 and HTTP2
+        self.timeout = timeout
+        self.controllers = {}
+        self.conditions = {}
+        self.wakers = set()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.client = asyncio.run_coroutine_threadsafe(
+            self._open(), self.loop).result()
+
+    async def _open(self):
+        return httpx.AsyncClient(
+            http2=self.http2,
+            headers=SESSION.headers,
+            timeout=self.timeout,
+            limits=httpx.Limits(
+                max_connections=None,
+                max_keepalive_connections=self.max_concurrency),
+        )
+
+    def _condition(self, controller):
+        condition = self.conditions.get(controller)
+        if condition is None:
+            condition = self.conditions[controller] = asyncio.Condition()
+        return condition
+
+    async def _acquire(self, controller, priority=False):
+        condition = self._condition(controller)
+        if priority:
+            controller.reserve(1)
+        try:
+            async with condition:
+                while (started := controller.try_acquire(priority)) is None:
+                    await condition.wait()
+        finally:
+            if priority:
+                controller.reserve(-1)
+                # the slot may have gone free meanwhile
+                self._release_waiters(controller)
+        return started
+
+    def _release_waiters(self, controller, pause=0):
+        waker = self.loop.create_task(
+            self._wake(controller, self._condition(controller), pause))
+        self.wakers.add(waker)
+        waker.add_done_callback(self.wakers.discard)
+
+    def _release(self, controller, started, signal):
+        self._release_waiters(controller, controller.release(started, signal))
+
+    async def _hedged_get(self, url, alternate, headers, controller, started):
+        # each request releases its own slot when it finishes, see hedged_get
+        hedger = self.hedger
+        start = time.perf_counter()
+
+        def finished(controller, started, primary):
+            def done(task):
+                if task.cancelled():
+                    signal = None
+                    if primary:
+                        hedger.primary_done(
+                            time.perf_counter() - start, finished=False)
+                elif task.exception() is not None:
+                    signal = error_signal(task.exception())
+                else:
+                    signal = response_signal(task.result())
+                    if primary:
+                        hedger.primary_done(time.perf_counter() - start)
+                self._release(controller, started, signal)
+            return done
+
+        primary = self.loop.create_task(self.client.get(url, headers=headers))
+        primary.add_done_callback(finished(controller, started, True))
+        pending = {primary}
+        try:
+            deadline = hedger.deadline()
+            if deadline is not None:
+                await asyncio.wait(pending, timeout=deadline)
+                alternate_controller = host_controller(
+                    self.controllers, alternate, self.concurrency,
+                    self.max_concurrency)
+                hedge_started = None
+                if not primary.done():
+                    slot = self.loop.create_task(
+                        self._acquire(alternate_controller, priority=True))
+                    try:
+                        await asyncio.wait(
+                            {primary, slot}, return_when=asyncio.FIRST_COMPLETED)
+                    finally:
+                        if not slot.done():
+                            slot.cancel()
+                    if slot.done():
+                        hedge_started = slot.result()
+                if hedge_started is not None:
+                    if not primary.done() and hedger.allow():
+                        hedge = self.loop.create_task(
+                            self.client.get(alternate, headers=headers))
+                        hedge.add_done_callback(finished(
+                            alternate_controller, hedge_started, False))
+                        pending.add(hedge)
+                    else:
+                        self._release(alternate_controller, hedge_started, None)
+            while 1:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((t for t in done if t.exception() is None), None)
+                if winner is not None or not pending:
+                    break
+        except asyncio.CancelledError:
+            for task in pending:
+                task.cancel()
+            raise
+        for task in pending:
+            if task is primary:
+                # finish in the background to measure the unhedged latency;
+                # close() cancels it
+                self.wakers.add(task)
+                task.add_done_callback(self.wakers.discard)
+            else:
+                task.cancel()
+        if winner is None:
+            return primary.result()
+        hedger.completed(time.perf_counter() - start, winner is not primary)
+        return winner.result()
+
+    async def _get(self, url, key, submitted=None, alternate=None):
+        telemetry = self.telemetry
+        entry = None
+        headers = None
+        if self.cache is not None:
+            entry = await asyncio.to_thread(self.cache.get, key)
+            if entry is not None and entry.fresh:
+                if telemetry is not None:
+                    telemetry.count('cache_hits')
+                return entry.data or None
+            headers = self.cache.request_headers(entry)
+        controller = host_controller(
+            self.controllers, url, self.concurrency, self.max_concurrency)
+        attempt = 0
+        while 1:
+            attempt += 1
+            started = await self._acquire(controller)
+            if telemetry is not None:
+                request_start = time.perf_counter()
+                if attempt == 1 and submitted is not None:
+                    telemetry.record('queue', request_start - submitted)
+            r = signal = error = None
+            try:
+                if self.hedger is not None:
+                    r = await self._hedged_get(
+                        url, alternate or url, headers, controller, started)
+                else:
+                    r = await self.client.get(url, headers=headers)
+                signal = response_signal(r)
+            except Exception as ex:
+                error = ex
+                signal = error_signal(ex)
+                if attempt >= TILE_RETRIES:
+                    raise
+            finally:
+                if self.hedger is None:
+                    self._release(controller, started, signal)
+                if telemetry is not None:
+                    telemetry.request(time.perf_counter() - request_start, r, error)
+            if r is not None and (not signal['error'] or attempt >= TILE_RETRIES):
+                break
+            if telemetry is not None:
+                telemetry.count('retries')
+            await asyncio.sleep(backoff_delay(attempt, signal['retry_after']))
+        if self.cache is not None:
+            return await asyncio.to_thread(self.cache.response, key, entry, r)
+        return tile_content(r)
+
+    async def _wake(self, controller, condition, pause=0):
+        if pause:
+            await asyncio.sleep(pause)
+        async with condition:
+            if controller.reserved:
+                # a hedge may be anywhere in the queue
+                condition.notify_all()
+            else:
+                condition.notify(controller.free())
+
+    def submit(self, url, key=None, alternate=None):
+        submitted = time.perf_counter() if self.telemetry is not None else None
+        return asyncio.run_coroutine_threadsafe(
+            self._get(url, key, submitted, alternate), self.loop)
+
+    def window(self):
+        return sum(c.window for c in list(self.controllers.values()))
+
+    async def _cancel(self):
+        # cancelled requests schedule wakers, so repeat until none are left
+        while 1:
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            if not tasks:
+                break
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _close(self):
+        await self._cancel()
+        await self.client.aclose()
+
+    def cancel(self):
+        """Abort every request in flight, closing its connection."""
+        if not self.loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self._cancel(), self.loop).result()
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+DEFAULT_CONCURRENCY = {'thread': 5, 'async': 16}
+
+
+def make_fetcher(engine='thread', concurrency=None, cache=None,
+                 max_concurrency=None, telemetry=None, hedger=None):
+    if engine not in DEFAULT_CONCURRENCY:
+        raise ValueError("Unknown engine: %s" % engine)
+    if engine == 'async' and httpx is None:
+        engine = 'thread'
+    concurrency = concurrency or DEFAULT_CONCURRENCY[engine]
+    if engine == 'async':
+        return AsyncTileFetcher(concurrency, cache, max_concurrency=max_concurrency,
+                                telemetry=telemetry, hedger=hedger)
+    return ThreadTileFetcher(concurrency, cache, max_concurrency, telemetry, hedger)
+
+
+def print_run_report(hedger=None, telemetry=None, json_file=None, prom_file=None):
+    """Print the hedging and HTTP summaries and write the telemetry files."""
+    if hedger:
+        print("Hedged %(hedges)d requests, %(hedge_wins)d won; p99 time to tile "
+              "%(p99).2fs, %(p99_unhedged).2fs without hedging" % hedger.summary())
+    if telemetry is None:
+        return
+    http = telemetry.summary()['stages'].get('http')
+    if http:
+        print("HTTP: %(count)d requests, p50 %(p50).3fs, p99 %(p99).3fs, "
+              "max %(max).3fs" % http)
+    if json_file:
+        telemetry.write_json(json_file)
+    if prom_file:
+        telemetry.write_prometheus(prom_file)
+
+
+def check_http2(engine):
+    """Tell the user when the async engine can't use HTTP/2."""
+    if engine == 'async' and httpx is not None and not HTTP2:
+        print("h2 is not installed, so the async engine uses HTTP/1.1 "
+              "(pip install 'httpx[http2]')", file=sys.stderr)
+
+
+def format_stats(stats):
+    return ', '.join(
+        '%s %s' % (k.replace('_', ' '), ('%.1f' % v) if isinstance(v, float) else v)
+        for k, v in stats.items())
+
+
+def print_progress(progress, total, done=False, stats=None):
     if done:
-        print('Downloaded image %d/%d, %.2f%%' % (progress, total, progress*100/total))
+        print('Downloaded image %d/%d, %.2f%%%s' % (
+            progress, total, progress*100/total,
+            ' (%s)' % format_stats(stats) if stats else ''))
+
+
+def progress_with_stats(callback):
+    """
+    Let download_extent pass a `stats` dict to progress callbacks that
+    accept one, and call older three-argument callbacks without it.
+    """
+    try:
+        params = inspect.signature(callback).parameters.values()
+    except (TypeError, ValueError):
+        params = ()
+    if any(p.name == 'stats' or p.kind == p.VAR_KEYWORD for p in params):
+        return callback
+    return lambda progress, total, done=False, stats=None: callback(
+        progress, total, done)
 
 
 class ProgressBar:
@@ -146,15 +1898,17 @@ class ProgressBar:
             except ImportError:
                 pass
 
-    def print_progress(self, progress, total, done=False):
+    def print_progress(self, progress, total, done=False, stats=None):
         if self.tqdm_bar is None and self._tqdm_fn:
             self.tqdm_bar = self._tqdm_fn(total)
         if not done:
             return
         if self.tqdm_bar is None:
-            print_progress(progress, total, done)
+            print_progress(progress, total, done, stats)
         elif progress > self.tqdm_progress:
             delta = progress - self.tqdm_progress
+            if stats:
+                self.tqdm_bar.set_postfix_str(format_stats(stats), refresh=False)
             self.tqdm_bar.update(delta)
             self.tqdm_progress = progress
 
@@ -165,7 +1919,68 @@ class ProgressBar:
             print('\nDone.')
 
 
-def mbtiles_save(db, img_data, xy, zoom, img_format):
+def transcode_tile(args):
+    zoom, x, y, img_data, img_format = args
+    with Image.open(io.BytesIO(img_data)) as im:
+        return zoom, x, y, encode_image(im, img_format)
+
+
+class TileTranscoder:
+    """
+    Re-encode tiles to the MBTiles format in a process pool and hand the
+    results to an MBTilesWriter.
+
+    At most `max_pending` tiles are queued; submit() waits for the oldest
+    one once the queue is full, so memory stays flat however far the
+    downloads run ahead of the encoders.
+    """
+
+    def __init__(self, writer, processes=None, max_pending=None):
+        self.writer = writer
+        self.processes = processes or os.cpu_count() or 1
+        self.pool = None
+        self.max_pending = max_pending or 4 * self.processes
+        self.pending = collections.deque()
+        self.encoded = 0
+        self.started = None
+
+    def submit(self, zoom, x, y, img_data, img_format):
+        if self.pool is None:
+            # only start worker processes once a tile needs re-encoding;
+            # spawn, as the fetcher and decoder threads are running by then
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                self.processes, mp_context=multiprocessing.get_context('spawn'))
+            self.started = time.monotonic()
+        if len(self.pending) >= self.max_pending:
+            self.collect(wait=True)
+        self.pending.append(self.pool.submit(
+            transcode_tile, (zoom, x, y, img_data, img_format)))
+
+    def collect(self, wait=False):
+        """Write finished tiles in submission order."""
+        while self.pending and (wait or self.pending[0].done()):
+            self.writer.add(*self.pending.popleft().result())
+            self.encoded += 1
+            wait = False
+
+    def rate(self):
+        if self.started is None:
+            return 0.0
+        return self.encoded / max(time.monotonic() - self.started, 1e-6)
+
+    def close(self, cancel=False):
+        if self.pool is None:
+            return
+        if cancel:
+            for fut in self.pending:
+                fut.cancel()
+            self.pending.clear()
+        while self.pending:
+            self.collect(wait=True)
+        self.pool.shutdown(wait=True, cancel_futures=cancel)
+
+
+def mbtiles_save(writer, img_data, xy, zoom, img_format, transcoder=None):
     if not img_data:
         return
     im = Image.open(io.BytesIO(img_data))
@@ -179,48 +1994,378 @@ def mbtiles_save(db, img_data, xy, zoom, img_format):
         current_format = 'image/' + im.format.lower()
     x, y = xy
     y = 2**zoom - 1 - y
-    cur = db.cursor()
     if img_format is None or img_format == current_format:
-        cur.execute("REPLACE INTO tiles VALUES (?,?,?,?)", (
-            zoom, x, y, img_data))
+        writer.add(zoom, x, y, img_data)
         return img_format or current_format
+    im.close()
+    if transcoder is not None:
+        transcoder.submit(zoom, x, y, img_data, img_format)
+    else:
+        writer.add(*transcode_tile((zoom, x, y, img_data, img_format)))
+    return img_format
+
+
+def encode_image(im, img_format):
     buf = io.BytesIO()
     if img_format == 'png':
         im.save(buf, 'PNG')
     elif img_format == 'jpg':
+        if im.mode not in ('RGB', 'L'):
+            im = im.convert('RGB')
         im.save(buf, 'JPEG', quality=93)
     elif img_format == 'webp':
         im.save(buf, 'WEBP')
     else:
         im.save(buf, img_format.split('/')[-1].upper())
-    cur.execute("REPLACE INTO tiles VALUES (?,?,?,?)", (
-        zoom, x, y, buf.getvalue()))
-    return img_format
+    return buf.getvalue()
+
+
+def mbtiles_set_zoom_range(cur, minzoom, maxzoom):
+    cur.execute("""
+        INSERT INTO metadata VALUES ('minzoom', ?)
+        ON CONFLICT(name) DO UPDATE SET value=excluded.value
+        WHERE CAST(excluded.value AS INTEGER)<CAST(metadata.value AS INTEGER)
+    """, (str(minzoom),))
+    cur.execute("""
+        INSERT INTO metadata VALUES ('maxzoom', ?)
+        ON CONFLICT(name) DO UPDATE SET value=excluded.value
+        WHERE CAST(excluded.value AS INTEGER)>CAST(metadata.value AS INTEGER)
+    """, (str(maxzoom),))
+
+
+_pyramid_db = None
+
+
+def _pyramid_init(dbname):
+    global _pyramid_db
+    _pyramid_db = sqlite3.connect(
+        'file:%s?mode=ro' % urllib.parse.quote(os.path.abspath(dbname)),
+        uri=True, timeout=60)
+
+
+def downsample_2x2(canvas, resampling='mean'):
+    """Halve an (H, W, 4) uint8 RGBA array."""
+    h, w = canvas.shape[0] // 2, canvas.shape[1] // 2
+    if resampling == 'lanczos':
+        im = Image.fromarray(canvas, 'RGBA').resize((w, h), Image.LANCZOS)
+        return numpy.asarray(im)
+    blocks = canvas.reshape(h, 2, w, 2, 4).astype(numpy.uint32)
+    alpha = blocks[..., 3].sum(axis=(1, 3))
+    # weight colours by alpha so transparent pixels don't darken the edges
+    rgb = (blocks[..., :3] * blocks[..., 3:]).sum(axis=(1, 3))
+    out = numpy.empty((h, w, 4), dtype=numpy.uint8)
+    out[..., :3] = (rgb + alpha[..., None] // 2) // numpy.maximum(alpha, 1)[..., None]
+    out[..., 3] = (alpha + 2) // 4
+    return out
+
+
+def pyramid_tile(args):
+    """Build one tile from its four children; runs in a worker process."""
+    zoom, x, y, img_format, resampling = args
+    children = _pyramid_db.execute(
+        "SELECT tile_column, tile_row, tile_data FROM tiles WHERE zoom_level=? "
+        "AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?",
+        (zoom + 1, 2*x, 2*x + 1, 2*y, 2*y + 1)).fetchall()
+    canvas = None
+    for column, row, data in children:
+        with Image.open(io.BytesIO(data)) as im:
+            child = numpy.asarray(im.convert('RGBA'))
+        h, w = child.shape[:2]
+        if canvas is None:
+            canvas = numpy.zeros((2*h, 2*w, 4), dtype=numpy.uint8)
+        # TMS rows count from the south, so the higher row is the top half
+        dx = column - 2*x
+        dy = 2*y + 1 - row
+        canvas[dy*h:(dy+1)*h, dx*w:(dx+1)*w] = child
+    if canvas is None:
+        return None
+    out = downsample_2x2(canvas, resampling)
+    if not out[..., 3].any():
+        return None
+    im = Image.fromarray(out, 'RGBA')
+    if out[..., 3].min() == 255:
+        im = im.convert('RGB')
+    return zoom, x, y, encode_image(im, img_format)
+
+
+def mbtiles_build_pyramid(
+    dbname, minzoom, maxzoom=None, resampling='mean', processes=None,
+    progress_callback=None, batch_size=256
+):
+    """
+    Fill the zoom levels below `maxzoom` (default: the highest stored zoom)
+    down to `minzoom` by downsampling each 2x2 block of child tiles.
+
+    Every level is built in a process pool from the level above it, so no
+    tiles are downloaded. `progress_callback(zoom, done, total)` is called
+    after each batch. Returns {zoom: number of tiles written}.
+    """
+    db = mbtiles_init(dbname)
+    cur = db.cursor()
+    if maxzoom is None:
+        cur.execute("SELECT MAX(zoom_level) FROM tiles")
+        maxzoom = cur.fetchone()[0]
+        if maxzoom is None:
+            raise ValueError("No tiles in %s" % dbname)
+    cur.execute("SELECT value FROM metadata WHERE name='format'")
+    row = cur.fetchone()
+    img_format = row[0] if row and row[0] else 'png'
+    written = {}
+    writer = MBTilesWriter(db, batch_size)
+    with concurrent.futures.ProcessPoolExecutor(
+            processes, initializer=_pyramid_init, initargs=(dbname,)) as pool:
+        for zoom in range(maxzoom - 1, minzoom - 1, -1):
+            cur.execute(
+                "SELECT DISTINCT tile_column/2, tile_row/2 FROM %s "
+                "WHERE zoom_level=?" % ('map' if writer.dedup else 'tiles'),
+                (zoom + 1,))
+            parents = cur.fetchall()
+            total = len(parents)
+            start = writer.written + len(writer.rows)
+            results = pool.map(pyramid_tile, (
+                (zoom, x, y, img_format, resampling) for x, y in parents),
+                chunksize=16)
+            for done_num, result in enumerate(results, 1):
+                if result:
+                    writer.add(*result)
+                if progress_callback and (done_num % batch_size == 0 or done_num == total):
+                    progress_callback(zoom, done_num, total)
+            # the next level reads this one from the worker processes
+            writer.flush()
+            written[zoom] = writer.written - start
+    if written:
+        cur.execute("BEGIN")
+        mbtiles_set_zoom_range(cur, minzoom, maxzoom)
+        cur.execute("COMMIT")
+    db.close()
+    return written
+
+
+def tile_md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def mbtiles_drop_unused_images(cur):
+    """Delete the images of a dedup file that no tile refers to."""
+    cur.execute("DELETE FROM images WHERE tile_id NOT IN "
+                "(SELECT tile_id FROM map)")
+
+
+def mbtiles_merge(db, sources):
+    """
+    Copy all tiles of the `sources` MBTiles files into `db`, each with one
+    INSERT ... SELECT from the attached file. Later files overwrite tiles
+    of earlier ones; metadata missing from `db` is copied. Returns the
+    number of tiles copied.
+    """
+    dedup = mbtiles_is_dedup(db)
+    db.create_function('md5', 1, tile_md5, deterministic=True)
+    cur = db.cursor()
+    cur.execute("SELECT value FROM metadata WHERE name='format'")
+    row = cur.fetchone()
+    img_format = row[0] if row else None
+    merged = 0
+    for filename in sources:
+        if not os.path.isfile(filename):
+            raise FileNotFoundError(filename)
+        cur.execute("ATTACH DATABASE ? AS src", (filename,))
+        try:
+            cur.execute("SELECT value FROM src.metadata WHERE name='format'")
+            row = cur.fetchone()
+            if row and img_format and row[0] != img_format:
+                raise ValueError("%s has %s tiles, not %s" % (
+                    filename, row[0], img_format))
+            img_format = img_format or (row[0] if row else None)
+            cur.execute("SELECT type FROM src.sqlite_master WHERE name='tiles'")
+            src_dedup = (cur.fetchone() or ('',))[0] == 'view'
+            cur.execute("BEGIN")
+            if dedup and src_dedup:
+                cur.execute("INSERT OR IGNORE INTO images "
+                            "SELECT tile_id, tile_data FROM src.images")
+                cur.execute("REPLACE INTO map SELECT zoom_level, tile_column, "
+                            "tile_row, tile_id FROM src.map")
+            elif dedup:
+                cur.execute("INSERT OR IGNORE INTO images "
+                            "SELECT md5(tile_data), tile_data FROM src.tiles")
+                cur.execute("REPLACE INTO map SELECT zoom_level, tile_column, "
+                            "tile_row, md5(tile_data) FROM src.tiles")
+            else:
+                cur.execute("REPLACE INTO tiles SELECT zoom_level, tile_column, "
+                            "tile_row, tile_data FROM src.tiles")
+            merged += cur.rowcount
+            if dedup:
+                # images of the tiles the source replaced
+                mbtiles_drop_unused_images(cur)
+            cur.execute("INSERT OR IGNORE INTO metadata "
+                        "SELECT name, value FROM src.metadata")
+            cur.execute("COMMIT")
+        except BaseException:
+            if db.in_transaction:
+                cur.execute("ROLLBACK")
+            raise
+        finally:
+            cur.execute("DETACH DATABASE src")
+    return merged
+
+
+def mbtiles_prune(db, bounds=None, minzoom=None, maxzoom=None):
+    """
+    Delete the tiles outside the zoom range and those not touching
+    `bounds` (min_lon, min_lat, max_lon, max_lat). Returns the number of
+    tiles deleted.
+    """
+    table = 'map' if mbtiles_is_dedup(db) else 'tiles'
+    cur = db.cursor()
+    pruned = 0
+    cur.execute("BEGIN")
+    if minzoom is not None:
+        cur.execute("DELETE FROM %s WHERE zoom_level<?" % table, (minzoom,))
+        pruned += cur.rowcount
+    if maxzoom is not None:
+        cur.execute("DELETE FROM %s WHERE zoom_level>?" % table, (maxzoom,))
+        pruned += cur.rowcount
+    if bounds is not None:
+        lon0, lat0, lon1, lat1 = bounds
+        cur.execute("SELECT DISTINCT zoom_level FROM %s" % table)
+        for zoom, in cur.fetchall():
+            n = 2**zoom
+            x0, y0, x1, y1 = tile_bbox(*tile_extent(lat0, lon0, lat1, lon1, zoom))
+            cur.execute(
+                "DELETE FROM %s WHERE zoom_level=? AND NOT (tile_column "
+                "BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?)" % table,
+                (zoom, x0, x1 - 1, n - y1, n - 1 - y0))
+            pruned += cur.rowcount
+    if table == 'map':
+        mbtiles_drop_unused_images(cur)
+    cur.execute("COMMIT")
+    return pruned
+
+
+def mbtiles_convert_dedup(db):
+    """Move the tiles of a flat MBTiles file to the deduplicated layout."""
+    if mbtiles_is_dedup(db):
+        return
+    db.create_function('md5', 1, tile_md5, deterministic=True)
+    cur = db.cursor()
+    cur.execute("BEGIN")
+    cur.execute("ALTER TABLE tiles RENAME TO flat_tiles")
+    mbtiles_create_dedup(cur)
+    cur.execute("INSERT OR IGNORE INTO images "
+                "SELECT md5(tile_data), tile_data FROM flat_tiles")
+    cur.execute("INSERT INTO map SELECT zoom_level, tile_column, tile_row, "
+                "md5(tile_data) FROM flat_tiles")
+    cur.execute("DROP TABLE flat_tiles")
+    cur.execute("COMMIT")
+
+
+def mbtiles_update_metadata(db):
+    """
+    Recompute the minzoom, maxzoom, bounds and center metadata from the
+    stored tiles. Returns the number of tiles.
+    """
+    cur = db.cursor()
+    cur.execute(
+        "SELECT zoom_level, MIN(tile_column), MAX(tile_column), MIN(tile_row), "
+        "MAX(tile_row), COUNT(*) FROM %s GROUP BY zoom_level" % (
+            'map' if mbtiles_is_dedup(db) else 'tiles'))
+    levels = cur.fetchall()
+    if not levels:
+        cur.execute("DELETE FROM metadata WHERE name IN "
+                    "('minzoom', 'maxzoom', 'bounds', 'center')")
+        return 0
+    bounds = [180.0, 90.0, -180.0, -90.0]
+    for zoom, x0, x1, row0, row1, count in levels:
+        n = 2**zoom
+        lat_max, lon_min = num2deg(x0, n - 1 - row1, zoom)
+        lat_min, lon_max = num2deg(x1 + 1, n - row0, zoom)
+        bounds = [min(bounds[0], lon_min), min(bounds[1], lat_min),
+                  max(bounds[2], lon_max), max(bounds[3], lat_max)]
+    minzoom = levels[0][0]
+    maxzoom = levels[-1][0]
+    cur.execute("BEGIN")
+    cur.executemany("REPLACE INTO metadata VALUES (?, ?)", (
+        ('minzoom', str(minzoom)),
+        ('maxzoom', str(maxzoom)),
+        ('bounds', ",".join(map(str, bounds))),
+        ('center', "%s,%s,%d" % (
+            (bounds[0] + bounds[2])/2, (bounds[1] + bounds[3])/2, maxzoom)),
+    ))
+    cur.execute("COMMIT")
+    return sum(level[-1] for level in levels)
+
+
+def mbtiles_maintain(
+    dbname, sources=(), bounds=None, minzoom=None, maxzoom=None,
+    dedup=False, vacuum=True
+):
+    """
+    Merge `sources` into the MBTiles file `dbname` (created if missing),
+    prune it to `bounds` and the zoom range, optionally convert it to the
+    deduplicated layout, recompute its metadata and VACUUM/ANALYZE it.
+
+    All tile copies are single SQL statements, so the work runs at SQLite's
+    speed. Returns {'merged', 'pruned', 'tiles'} counts.
+    """
+    db = mbtiles_init(dbname, dedup)
+    try:
+        merged = mbtiles_merge(db, sources)
+        pruned = 0
+        if bounds is not None or minzoom is not None or maxzoom is not None:
+            pruned = mbtiles_prune(db, bounds, minzoom, maxzoom)
+        if dedup:
+            mbtiles_convert_dedup(db)
+        tiles = mbtiles_update_metadata(db)
+        if vacuum:
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            db.execute("VACUUM")
+            db.execute("ANALYZE")
+    finally:
+        db.close()
+    return {'merged': merged, 'pruned': pruned, 'tiles': tiles}
 
 
 def download_extent(
     source, lat0, lon0, lat1, lon1, zoom,
     mbtiles=None, save_image=True,
     progress_callback=print_progress,
-    callback_interval=0.05
+    callback_interval=0.05,
+    stream_to=None, block_size=256,
+    engine='thread', concurrency=None, cache=None,
+    resume=False, as_array=False, dedup=False,
+    transcode_processes=None, max_concurrency=None, area=None, buffer=0,
+    telemetry=None, blank_index=None, hedger=None, queue_size=None,
+    decode_threads=None
 ):
-    x0, y0 = deg2num(lat0, lon0, zoom)
-    x1, y1 = deg2num(lat1, lon1, zoom)
-    if x0 > x1:
-        x0, x1 = x1, x0
-    if y0 > y1:
-        y0, y1 = y1, y0
+    """
+    Download the tiles of an extent and composite them into one image.
+
+    Tiles go through a pipeline: at most `queue_size` tiles (default 4x
+    the fetcher's maximum concurrency) are requested or waiting to be
+    decoded at a time, so memory stays flat however large the extent; the
+    NumPy mosaic decodes them on `decode_threads` threads (default: up to
+    4); and this thread composites and stores them in the MBTiles file.
+    The depth of each queue is passed to the progress callback as stats
+    and recorded in `telemetry`.
+    """
+    if as_array and numpy is None:
+        raise RuntimeError("as_array needs numpy")
+    source = tile_source(source)
+    x0, y0, x1, y1 = tile_extent(lat0, lon0, lat1, lon1, zoom)
 
     db = None
+    writer = None
+    transcoder = None
     mbt_img_format = None
     if mbtiles:
-        db = mbtiles_init(mbtiles)
+        db = mbtiles_init(mbtiles, dedup)
+        writer = MBTilesWriter(db)
+        transcoder = TileTranscoder(writer, transcode_processes)
         cur = db.cursor()
         cur.execute("BEGIN")
-        cur.execute("REPLACE INTO metadata VALUES ('name', ?)", (source,))
+        cur.execute("REPLACE INTO metadata VALUES ('name', ?)", (str(source),))
         cur.execute("REPLACE INTO metadata VALUES ('type', 'overlay')")
         cur.execute("REPLACE INTO metadata VALUES ('version', '1.1')")
-        cur.execute("REPLACE INTO metadata VALUES ('description', ?)", (source,))
+        cur.execute("REPLACE INTO metadata VALUES ('description', ?)", (str(source),))
         cur.execute("SELECT value FROM metadata WHERE name='format'")
         row = cur.fetchone()
         if row and row[0]:
@@ -245,97 +2390,692 @@ def download_extent(
             ",".join(map(str, bounds)),))
         cur.execute("REPLACE INTO metadata VALUES ('center', ?)", ("%s,%s,%d" % (
             (lon_max + lon_min)/2, (lat_max + lat_min)/2, zoom),))
-        cur.execute("""
-            INSERT INTO metadata VALUES ('minzoom', ?)
-            ON CONFLICT(name) DO UPDATE SET value=excluded.value
-            WHERE CAST(excluded.value AS INTEGER)<CAST(metadata.value AS INTEGER)
-        """, (str(zoom),))
-        cur.execute("""
-            INSERT INTO metadata VALUES ('maxzoom', ?)
-            ON CONFLICT(name) DO UPDATE SET value=excluded.value
-            WHERE CAST(excluded.value AS INTEGER)>CAST(metadata.value AS INTEGER)
-        """, (str(zoom),))
+        mbtiles_set_zoom_range(cur, zoom, zoom)
         cur.execute("COMMIT")
 
+    bbox = tile_bbox(x0, y0, x1, y1)
     corners = tuple(itertools.product(
-        range(math.floor(x0), math.ceil(x1)),
-        range(math.floor(y0), math.ceil(y1))))
+        range(bbox[0], bbox[2]), range(bbox[1], bbox[3])))
+    if stream_to:
+        # row by row, so only about two rows of blocks wait for tiles
+        corners = tuple(sorted(corners, key=lambda xy: (xy[1], xy[0])))
+    skipped = ()
+    if area is not None:
+        # only the tiles touching the area; the rest of the mosaic stays empty
+        wanted = area_tiles(area, zoom, buffer)
+        skipped = tuple(xy for xy in corners if xy not in wanted)
+        corners = tuple(xy for xy in corners if xy in wanted)
     totalnum = len(corners)
+    stored = set()
+    if mbtiles and resume:
+        stored = mbtiles_existing(db, zoom, bbox)
+        if area is not None:
+            stored &= wanted
+        corners = tuple(xy for xy in corners if xy not in stored)
+    known_blank = ()
+    if blank_index is not None:
+        known_blank = blank_index.blank_tiles(str(source), zoom, corners)
+        corners = tuple(xy for xy in corners if xy not in known_blank)
+        if telemetry is not None:
+            telemetry.count('known_blank', len(known_blank))
     futures = {}
+    decoding = {}
     done_num = 0
-    progress_callback(done_num, totalnum, False)
+    report = progress_with_stats(progress_callback)
+    stats = {}
+    fetcher = None
+
+    def current_stats():
+        if known_blank:
+            stats['known_blank'] = len(known_blank)
+        if hedger is not None:
+            stats['hedges'] = hedger.hedges
+        if fetcher is not None:
+            stats['window'] = fetcher.window()
+        if transcoder is not None and transcoder.pool is not None:
+            stats['encoded'] = transcoder.encoded
+            stats['encoded_per_s'] = transcoder.rate()
+        return stats
+
+    report(done_num, totalnum, False, stats=current_stats())
     last_done_num = 0
     last_callback = time.monotonic()
     cancelled = False
-    with concurrent.futures.ThreadPoolExecutor(5) as executor:
-        for x, y in corners:
-            future = executor.submit(get_tile, source.format(z=zoom, x=x, y=y))
-            futures[future] = (x, y) 
-        bbox = (math.floor(x0), math.floor(y0), math.ceil(x1), math.ceil(y1))
-        bigim = None
-        base_size = [256, 256]
-        while futures:
-            done, not_done = concurrent.futures.wait(
-                futures.keys(), timeout=callback_interval,
-                return_when=concurrent.futures.FIRST_COMPLETED
-            )
-            cur = None
-            if mbtiles:
-                cur = db.cursor()
-                cur.execute("BEGIN")
-            for fut in done:
-                img_data = fut.result()
-                xy = futures[fut]
-                if save_image:
-                    bigim = paste_tile(bigim, base_size, img_data, xy, bbox)
-                if mbtiles:
-                    new_format = mbtiles_save(db, img_data, xy, zoom, mbt_img_format)
-                    if not mbt_img_format:
-                        cur.execute(
-                            "UPDATE metadata SET value=? WHERE name='format'",
-                            (new_format,))
-                        mbt_img_format = new_format
-                del futures[fut]
-                done_num += 1
-            if mbtiles:
-                cur.execute("COMMIT")
-            if time.monotonic() > last_callback + callback_interval:
-                try:
-                    progress_callback(done_num, totalnum, (done_num > last_done_num))
-                except TaskCancelled:
-                    for fut in futures.keys():
-                        fut.cancel()
-                    futures.clear()
-                    cancelled = True
-                    break
-                last_callback = time.monotonic()
-                last_done_num = done_num
+    stream = None
+    mosaic = None
+    force_mode = 'RGBA' if skipped or known_blank else None
+    if stream_to:
+        stream = StreamingGeoTIFF(
+            stream_to, (lat0, lon0, lat1, lon1), (x0, y0, x1, y1), block_size,
+            force_mode)
+        for xy in itertools.chain(skipped, known_blank):
+            stream.add_tile(None, xy)
+    elif save_image and numpy is not None:
+        mosaic = TileMosaic(bbox, force_mode, telemetry)
+    decoder = None
+    if mosaic:
+        decode_threads = decode_threads or min(4, os.cpu_count() or 1)
+        decoder = concurrent.futures.ThreadPoolExecutor(decode_threads)
+    bigim = None
+    base_size = [256, 256]
+    finished = False
+
+    def write(img_data, array, xy):
+        # the single writer stage: composite and store one tile
+        nonlocal bigim, mbt_img_format, done_num
+        if telemetry is not None:
+            start = time.perf_counter()
+        if stream:
+            stream.add_tile(img_data, xy)
+        elif mosaic:
+            if array is not None:
+                mosaic.paste_array(array, xy)
+        elif save_image:
+            bigim = paste_tile(bigim, base_size, img_data, xy, bbox)
+        if telemetry is not None:
+            now = time.perf_counter()
+            if not mosaic:
+                telemetry.record('composite', now - start)
+            start = now
+        if mbtiles:
+            new_format = mbtiles_save(
+                writer, img_data, xy, zoom, mbt_img_format, transcoder)
+            if new_format and not mbt_img_format:
+                db.execute(
+                    "UPDATE metadata SET value=? WHERE name='format'",
+                    (new_format,))
+                mbt_img_format = new_format
+            if telemetry is not None:
+                telemetry.record('db', time.perf_counter() - start)
+        done_num += 1
+        if telemetry is not None:
+            telemetry.count('tiles')
+
+    try:
+        with make_fetcher(engine, concurrency, cache, max_concurrency,
+                          telemetry, hedger) as fetcher:
+            if queue_size is None:
+                queue_size = 4 * fetcher.max_concurrency
+            todo = iter(corners)
+
+            def fetch_more():
+                # tiles waiting to be decoded count too, so a slow decoder
+                # or writer holds back the network
+                while len(futures) + len(decoding) < queue_size:
+                    xy = next(todo, None)
+                    if xy is None:
+                        return
+                    x, y = xy
+                    # hedges go to the next {s} host
+                    shard = source.shard()
+                    alternate = None
+                    if hedger is not None:
+                        alternate = source.url(zoom, x, y, shard + 1)
+                    future = fetcher.submit(
+                        source.url(zoom, x, y, shard), (str(source), zoom, x, y),
+                        alternate)
+                    futures[future] = xy
+
+            fetch_more()
+            if stored and (stream or save_image):
+                # rebuild the mosaic from tiles saved by an earlier run
+                # while the missing ones download
+                for xy, img_data in mbtiles_read(db, zoom, bbox, bool(stream)):
+                    if xy not in stored:
+                        continue
+                    if stream:
+                        stream.add_tile(img_data, xy)
+                    elif mosaic:
+                        mosaic.paste(img_data, xy)
+                    else:
+                        bigim = paste_tile(bigim, base_size, img_data, xy, bbox)
+                    done_num += 1
+                    if time.monotonic() > last_callback + callback_interval:
+                        try:
+                            report(done_num, totalnum, True, stats=current_stats())
+                        except TaskCancelled:
+                            cancelled = True
+                            break
+                        last_callback = time.monotonic()
+                        last_done_num = done_num
+            else:
+                done_num += len(stored)
+            done_num += len(known_blank)
+            if cancelled:
+                futures.clear()
+            decode_depth = 2 * decode_threads if decoder else 0
+            while futures or decoding:
+                decode_full = decoder is not None and len(decoding) >= decode_depth
+                waiting = list(decoding)
+                if not decode_full:
+                    waiting.extend(f for f in futures if not f.done())
+                concurrent.futures.wait(
+                    waiting, timeout=callback_interval,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                decoded = [f for f in decoding if f.done()]
+                depths = {
+                    'fetch': len(futures),
+                    'decode': len(decoding) - len(decoded),
+                    'write': len(decoded),
+                }
+                for fut in decoded:
+                    xy, img_data = decoding.pop(fut)
+                    write(img_data, fut.result(), xy)
+                for fut in [f for f in futures if f.done()]:
+                    if decoder is not None and len(decoding) >= decode_depth:
+                        break
+                    img_data = fut.result()
+                    xy = futures.pop(fut)
+                    if blank_index is not None and is_blank_tile(img_data):
+                        blank_index.add(str(source), zoom, *xy)
+                    if decoder is not None and img_data is not None:
+                        future = decoder.submit(decode_tile, img_data, telemetry)
+                        decoding[future] = (xy, img_data)
+                    else:
+                        write(img_data, None, xy)
+                fetch_more()
+                if transcoder:
+                    transcoder.collect()
+                for name, depth in depths.items():
+                    stats[name + '_queue'] = depth
+                    if telemetry is not None:
+                        telemetry.queue_depth(name, depth)
+                if time.monotonic() > last_callback + callback_interval:
+                    try:
+                        report(done_num, totalnum, (done_num > last_done_num),
+                               stats=current_stats())
+                    except TaskCancelled:
+                        for fut in decoding:
+                            fut.cancel()
+                        decoding.clear()
+                        futures.clear()
+                        cancelled = True
+                        break
+                    last_callback = time.monotonic()
+                    last_done_num = done_num
+            if cancelled:
+                fetcher.cancel()
+        finished = not cancelled
+    finally:
+        if decoder is not None:
+            decoder.shutdown(wait=True, cancel_futures=True)
+        if stream:
+            stream.close()
+        if writer:
+            transcoder.close(cancel=not finished)
+            writer.flush()
+            db.close()
+        if blank_index is not None:
+            blank_index.flush()
+        if telemetry is not None:
+            telemetry.finished = time.time()
     if cancelled:
         raise TaskCancelled()
-    progress_callback(done_num, totalnum, True)
+    report(done_num, totalnum, True, stats=current_stats())
 
+    if stream:
+        return None, stream.matrix
     if not save_image:
         return None, None
 
-    xfrac = x0 - bbox[0]
-    yfrac = y0 - bbox[1]
-    x2 = round(base_size[0]*xfrac)
-    y2 = round(base_size[1]*yfrac)
-    imgw = round(base_size[0]*(x1-x0))
-    imgh = round(base_size[1]*(y1-y0))
+    if mosaic:
+        view = mosaic.crop(x0, y0, x1, y1)
+        matrix = extent_matrix(lat0, lon0, lat1, lon1, (view.shape[1], view.shape[0]))
+        if as_array:
+            return view, matrix
+        return array_to_image(view), matrix
+
+    x2, y2, imgw, imgh = crop_window(x0, y0, x1, y1, bbox, base_size)
     retim = bigim.crop((x2, y2, x2+imgw, y2+imgh))
     if retim.mode == 'RGBA' and retim.getextrema()[3] == (255, 255):
         retim = retim.convert('RGB')
     bigim.close()
-    xp0, yp0 = from4326_to3857(lat0, lon0)
-    xp1, yp1 = from4326_to3857(lat1, lon1)
-    pwidth = abs(xp1 - xp0) / retim.size[0]
-    pheight = abs(yp1 - yp0) / retim.size[1]
-    matrix = (min(xp0, xp1), pwidth, 0, max(yp0, yp1), 0, -pheight)
+    matrix = extent_matrix(lat0, lon0, lat1, lon1, retim.size)
+    return retim, matrix
+
+
+def mbtiles_export(
+    dbname, lat0, lon0, lat1, lon1, zoom,
+    progress_callback=None, stream_to=None, block_size=256,
+    band_rows=64, as_array=False
+):
+    """
+    Composite an extent from the tiles stored in an MBTiles file, without
+    any network access, with the same georeferencing as download_extent.
+
+    Tiles are read `band_rows` tile rows at a time with ordered range
+    queries on the (zoom_level, tile_column, tile_row) index, so a
+    `stream_to` GeoTIFF is written at disk speed with at most a band of
+    blocks in memory. Returns (image, matrix) like download_extent.
+    """
+    if as_array and numpy is None:
+        raise RuntimeError("as_array needs numpy")
+    x0, y0, x1, y1 = tile_extent(lat0, lon0, lat1, lon1, zoom)
+    bbox = tile_bbox(x0, y0, x1, y1)
+    n = 2**zoom
+    where = ("zoom_level=? AND tile_column BETWEEN ? AND ? "
+             "AND tile_row BETWEEN ? AND ?")
+
+    def tms_range(top, bottom):
+        # XYZ rows [top, bottom) are TMS rows n - bottom .. n - 1 - top
+        return (zoom, bbox[0], bbox[2] - 1, n - bottom, n - 1 - top)
+
+    db = sqlite3.connect(
+        'file:%s?mode=ro' % urllib.parse.quote(os.path.abspath(dbname)),
+        uri=True, timeout=60)
+    stream = None
+    try:
+        totalnum = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+        stored = db.execute("SELECT COUNT(*) FROM %s WHERE %s" % (
+            'map' if mbtiles_is_dedup(db) else 'tiles', where),
+            tms_range(bbox[1], bbox[3])).fetchone()[0]
+        if not stored:
+            raise ValueError("No tiles at zoom %d in the extent" % zoom)
+        # keep missing tiles transparent
+        force_mode = 'RGBA' if stored < totalnum else None
+        mosaic = None
+        bigim = None
+        base_size = [256, 256]
+        if stream_to:
+            stream = StreamingGeoTIFF(
+                stream_to, (lat0, lon0, lat1, lon1), (x0, y0, x1, y1),
+                block_size, force_mode)
+        elif numpy is not None:
+            mosaic = TileMosaic(bbox, force_mode)
+        done_num = 0
+        for top in range(bbox[1], bbox[3], band_rows):
+            bottom = min(top + band_rows, bbox[3])
+            seen = set()
+            cur = db.execute(
+                "SELECT tile_column, tile_row, tile_data FROM tiles WHERE %s "
+                "ORDER BY tile_column, tile_row" % where, tms_range(top, bottom))
+            for x, row, data in cur:
+                xy = (x, n - 1 - row)
+                if stream:
+                    seen.add(xy)
+                    stream.add_tile(data, xy)
+                elif mosaic:
+                    mosaic.paste(data, xy)
+                else:
+                    bigim = paste_tile(bigim, base_size, data, xy, bbox)
+            if stream:
+                # complete the blocks that only wait for missing tiles
+                for xy in itertools.product(
+                        range(bbox[0], bbox[2]), range(top, bottom)):
+                    if xy not in seen:
+                        stream.add_tile(None, xy)
+            done_num += (bbox[2] - bbox[0]) * (bottom - top)
+            if progress_callback:
+                progress_callback(done_num, totalnum, True)
+    finally:
+        db.close()
+        if stream:
+            stream.close()
+
+    if stream:
+        return None, stream.matrix
+    if mosaic:
+        view = mosaic.crop(x0, y0, x1, y1)
+        matrix = extent_matrix(lat0, lon0, lat1, lon1, (view.shape[1], view.shape[0]))
+        if as_array:
+            return view, matrix
+        return array_to_image(view), matrix
+    x2, y2, imgw, imgh = crop_window(x0, y0, x1, y1, bbox, base_size)
+    retim = bigim.crop((x2, y2, x2+imgw, y2+imgh))
+    if retim.mode == 'RGBA' and retim.getextrema()[3] == (255, 255):
+        retim = retim.convert('RGB')
+    bigim.close()
+    matrix = extent_matrix(lat0, lon0, lat1, lon1, retim.size)
     return retim, matrix
 
 
-def generate_tiffinfo(matrix):
+class BatchJob:
+    """One extent of a batch: its tiles, mosaic and output file."""
+
+    def __init__(self, lat0, lon0, lat1, lon1, zoom, output, area=None, buffer=0):
+        self.extent = (lat0, lon0, lat1, lon1)
+        self.zoom = zoom
+        self.output = output
+        self.tile_extent = tile_extent(lat0, lon0, lat1, lon1, zoom)
+        bbox = tile_bbox(*self.tile_extent)
+        self.tiles = set(itertools.product(
+            range(bbox[0], bbox[2]), range(bbox[1], bbox[3])))
+        mode = None
+        if area is not None:
+            wanted = area_tiles(area, zoom, buffer)
+            if not self.tiles <= wanted:
+                self.tiles &= wanted
+                mode = 'RGBA'
+        self.mosaic = TileMosaic(bbox, mode)
+        self.remaining = len(self.tiles)
+
+    def add_tile(self, tile, xy):
+        self.mosaic.paste(tile, xy)
+        self.remaining -= 1
+
+    def save(self, **params):
+        view = self.mosaic.crop(*self.tile_extent)
+        matrix = extent_matrix(*self.extent, (view.shape[1], view.shape[0]))
+        save_image_auto(view, self.output, matrix, **params)
+        self.mosaic = None
+
+
+def read_batch_jobs(filename, zoom=None, output_dir='.', buffer=0):
+    """
+    Read batch jobs from a CSV or GeoJSON file.
+
+    CSV rows have min_lon, min_lat, max_lon, max_lat (or one `extent`
+    column in that order), and optionally zoom, output and buffer. GeoJSON
+    features cover their geometry, with the same optional properties.
+    Missing zooms and outputs come from `zoom` and `output_dir`.
+    """
+    rows = []
+    if os.path.splitext(filename)[1].lower() == '.csv':
+        with open(filename, newline='', encoding='utf-8-sig') as f:
+            for row in csv.DictReader(f):
+                if row.get('extent'):
+                    extent = parse_extent(row['extent'])
+                else:
+                    extent = (float(row['max_lat']), float(row['min_lon']),
+                              float(row['min_lat']), float(row['max_lon']))
+                rows.append((extent, None, row))
+    else:
+        with open(filename, encoding='utf-8') as f:
+            collection = json.load(f)
+        features = collection.get('features', [collection])
+        for feature in features:
+            props = feature.get('properties') or {}
+            row_buffer = float(props.get('buffer') or buffer)
+            rows.append((area_extent(feature, row_buffer), feature, props))
+    jobs = []
+    for i, (extent, area, props) in enumerate(rows, 1):
+        row_zoom = int(props.get('zoom') or zoom or 0)
+        if not row_zoom:
+            raise ValueError("No zoom level for job %d" % i)
+        output = props.get('output') or os.path.join(output_dir, 'extent_%d.tif' % i)
+        jobs.append(BatchJob(*extent, row_zoom, output, area,
+                             float(props.get('buffer') or buffer)))
+    return jobs
+
+
+def download_batch(
+    source, jobs, progress_callback=print_progress, callback_interval=0.05,
+    engine='thread', concurrency=None, cache=None, max_concurrency=None,
+    telemetry=None, blank_index=None, hedger=None, queue_size=None,
+    **save_params
+):
+    """
+    Download many BatchJobs at once and save each one's image.
+
+    The jobs' tiles are merged into one set, so a tile shared by several
+    jobs is fetched once, through a single fetcher, with at most
+    `queue_size` requests pending (default 4x the fetcher's maximum
+    concurrency). Each job is saved and its mosaic freed as soon as its
+    last tile arrives. Returns counts of
+    tiles requested by the jobs, tiles fetched, fetches saved, and tiles
+    skipped as known blank by `blank_index`.
+    """
+    if numpy is None:
+        raise RuntimeError("Batch mode needs numpy")
+    source = tile_source(source)
+    waiting = collections.defaultdict(list)
+    for job in jobs:
+        for xy in job.tiles:
+            waiting[(job.zoom,) + xy].append(job)
+        if not job.remaining:
+            job.save(**save_params)
+    requested = sum(len(job.tiles) for job in jobs)
+    totalnum = len(waiting)
+    done_num = 0
+    known_blank = 0
+    if blank_index is not None:
+        for key in [key for key in waiting
+                    if blank_index.is_blank(str(source), *key)]:
+            for job in waiting.pop(key):
+                job.add_tile(None, key[1:])
+                if not job.remaining:
+                    job.save(**save_params)
+            known_blank += 1
+        done_num = known_blank
+    report = progress_with_stats(progress_callback)
+    report(done_num, totalnum, False)
+    last_callback = time.monotonic()
+    futures = {}
+
+    def job_tiles():
+        # job by job, so the first jobs complete and free their mosaics early
+        submitted = set()
+        for job in jobs:
+            for x, y in sorted(job.tiles, key=lambda xy: (xy[1], xy[0])):
+                key = (job.zoom, x, y)
+                if key not in submitted and key in waiting:
+                    submitted.add(key)
+                    yield key
+
+    todo = job_tiles()
+    with make_fetcher(engine, concurrency, cache, max_concurrency,
+                      telemetry, hedger) as fetcher:
+        if queue_size is None:
+            queue_size = 4 * fetcher.max_concurrency
+
+        def fetch_more():
+            while len(futures) < queue_size:
+                key = next(todo, None)
+                if key is None:
+                    return
+                shard = source.shard()
+                alternate = None
+                if hedger is not None:
+                    alternate = source.url(*key, shard=shard + 1)
+                futures[fetcher.submit(
+                    source.url(*key, shard=shard), (str(source),) + key,
+                    alternate)] = key
+
+        try:
+            fetch_more()
+            while futures:
+                done, _ = concurrent.futures.wait(
+                    futures.keys(), timeout=callback_interval,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    zoom, x, y = key = futures.pop(fut)
+                    img_data = fut.result()
+                    if blank_index is not None and is_blank_tile(img_data):
+                        blank_index.add(str(source), zoom, x, y)
+                    for job in waiting.pop(key):
+                        if telemetry is not None:
+                            start = time.perf_counter()
+                        job.add_tile(img_data, (x, y))
+                        if telemetry is not None:
+                            telemetry.record('composite', time.perf_counter() - start)
+                        if not job.remaining:
+                            if telemetry is not None:
+                                start = time.perf_counter()
+                            job.save(**save_params)
+                            if telemetry is not None:
+                                telemetry.record('save', time.perf_counter() - start)
+                    done_num += 1
+                    if telemetry is not None:
+                        telemetry.count('tiles')
+                fetch_more()
+                if time.monotonic() > last_callback + callback_interval:
+                    report(done_num, totalnum, True)
+                    last_callback = time.monotonic()
+        except BaseException:
+            fetcher.cancel()
+            raise
+        finally:
+            if blank_index is not None:
+                blank_index.flush()
+            if telemetry is not None:
+                telemetry.finished = time.time()
+    stats = {'jobs': len(jobs), 'requested': requested,
+             'fetched': totalnum - known_blank, 'saved': requested - totalnum,
+             'known_blank': known_blank}
+    report(done_num, totalnum, True, stats=stats)
+    return stats
+
+
+def chunk_edges(start, end, step):
+    edges = [start]
+    edge = (math.floor(start) // step + 1) * step
+    while edge < end:
+        edges.append(edge)
+        edge += step
+    edges.append(end)
+    return edges
+
+
+def chunk_grid(x0, y0, x1, y1, max_bytes, tile_size=256):
+    """
+    Split a fractional tile extent into rows of chunks on tile edges, each
+    spanning at most as many whole tiles as fit in `max_bytes` of RGBA
+    mosaic. Returns [[(cx0, cy0, cx1, cy1), ...], ...].
+    """
+    side = max(1, math.isqrt(max_bytes // (tile_size * tile_size * 4)))
+    xs = chunk_edges(x0, x1, side)
+    ys = chunk_edges(y0, y1, side)
+    return [[(xs[i], ys[j], xs[i+1], ys[j+1]) for i in range(len(xs) - 1)]
+            for j in range(len(ys) - 1)]
+
+
+_chunk_cache = None
+_chunk_blank_index = None
+
+
+def _chunk_init(cache_file, blank_index_file, cache_bytes, cache_ttl, blank_ttl):
+    global _chunk_cache, _chunk_blank_index
+    if cache_file:
+        _chunk_cache = TileCache(cache_file, cache_bytes, cache_ttl)
+    if blank_index_file:
+        _chunk_blank_index = BlankTileIndex(blank_index_file, blank_ttl)
+
+
+def download_chunk(args, cache=None, blank_index=None):
+    """Download and save one chunk; runs in a worker process."""
+    source, extent, zoom, filename, cog, params = args
+    img, matrix = download_extent(
+        source, *extent, zoom, progress_callback=lambda *args, **kwargs: None,
+        cache=cache or _chunk_cache,
+        blank_index=blank_index or _chunk_blank_index,
+        as_array=numpy is not None, **params)
+    save_image_auto(img, filename, matrix, cog=cog)
+    if numpy is not None:
+        h, w, bands = img.shape
+        return (w, h), bands
+    return img.size, len(img.mode)
+
+
+def download_chunked(
+    source, lat0, lon0, lat1, lon1, zoom, output,
+    max_bytes=1024*1024*1024, processes=1, cache_file=None,
+    progress_callback=print_progress, cog=False, blank_index_file=None,
+    cache_bytes=1024*1024*1024, cache_ttl=7*86400, blank_ttl=30*86400, **params
+):
+    """
+    Download an extent too large for one image as a grid of GeoTIFF chunks
+    next to `output`, and write `output` as a VRT stitching them together.
+
+    Chunks are cut on tile edges, so no tile is fetched twice, and sized so
+    each mosaic fits in `max_bytes` (assuming 256 px tiles). Each chunk is
+    downloaded, saved and released in turn, or in `processes` worker
+    processes that all open the TileCache in `cache_file` and the
+    BlankTileIndex in `blank_index_file` with the given size and TTLs.
+    Other params go to download_extent; a Telemetry or Hedger among them
+    only works in this process. Returns the chunk filenames.
+    """
+    source = tile_source(source)
+    x0, y0, x1, y1 = tile_extent(lat0, lon0, lat1, lon1, zoom)
+    grid = chunk_grid(x0, y0, x1, y1, max_bytes)
+    basename = os.path.splitext(output)[0]
+    tasks = []
+    for row, chunks in enumerate(grid):
+        for col, (cx0, cy0, cx1, cy1) in enumerate(chunks):
+            filename = '%s_%03d_%03d.tif' % (basename, row, col)
+            tasks.append((source, num2deg(cx0, cy0, zoom) + num2deg(cx1, cy1, zoom),
+                          zoom, filename, cog, params))
+    report = progress_with_stats(progress_callback)
+    report(0, len(tasks), False)
+    results = []
+    if processes > 1:
+        # spawn, so workers don't share the parent's pooled HTTP connections
+        with concurrent.futures.ProcessPoolExecutor(
+                processes, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_chunk_init,
+                initargs=(cache_file, blank_index_file, cache_bytes, cache_ttl,
+                          blank_ttl)) as pool:
+            for result in pool.map(download_chunk, tasks):
+                results.append(result)
+                report(len(results), len(tasks), True)
+    else:
+        cache = blank_index = None
+        if cache_file:
+            cache = TileCache(cache_file, cache_bytes, cache_ttl)
+        if blank_index_file:
+            blank_index = BlankTileIndex(blank_index_file, blank_ttl)
+        try:
+            for task in tasks:
+                results.append(download_chunk(task, cache, blank_index))
+                report(len(results), len(tasks), True)
+        finally:
+            if cache:
+                cache.close()
+            if blank_index:
+                blank_index.close()
+    across = len(grid[0])
+    widths = [size[0] for size, bands in results[:across]]
+    heights = [size[1] for size, bands in results[::across]]
+    sources = []
+    for i, (task, (size, bands)) in enumerate(zip(tasks, results)):
+        row, col = divmod(i, across)
+        sources.append((task[3], sum(widths[:col]), sum(heights[:row]), size, bands))
+    size = (sum(widths), sum(heights))
+    write_vrt(output, size, extent_matrix(lat0, lon0, lat1, lon1, size), sources)
+    return [task[3] for task in tasks]
+
+
+VRT_COLORS = ('Red', 'Green', 'Blue', 'Alpha')
+
+
+def write_vrt(filename, size, matrix, sources, epsg=3857):
+    """
+    Write a GDAL VRT mosaic of `sources`, a list of (filename, x offset,
+    y offset, size, bands). RGB sources get an opaque alpha band when others
+    have one.
+    """
+    bands = max(source[4] for source in sources)
+    root = ElementTree.Element('VRTDataset', rasterXSize=str(size[0]),
+                              rasterYSize=str(size[1]))
+    ElementTree.SubElement(root, 'SRS').text = 'EPSG:%d' % epsg
+    ElementTree.SubElement(root, 'GeoTransform').text = ', '.join(
+        repr(float(v)) for v in matrix)
+    vrt_dir = os.path.dirname(os.path.abspath(filename))
+    for band in range(1, bands + 1):
+        band_el = ElementTree.SubElement(
+            root, 'VRTRasterBand', dataType='Byte', band=str(band))
+        ElementTree.SubElement(band_el, 'ColorInterp').text = VRT_COLORS[band - 1]
+        for name, xoff, yoff, (w, h), src_bands in sources:
+            opaque = band > src_bands
+            source_el = ElementTree.SubElement(
+                band_el, 'ComplexSource' if opaque else 'SimpleSource')
+            path = os.path.relpath(os.path.abspath(name), vrt_dir)
+            ElementTree.SubElement(
+                source_el, 'SourceFilename', relativeToVRT='1').text = path
+            ElementTree.SubElement(source_el, 'SourceBand').text = str(
+                1 if opaque else band)
+            ElementTree.SubElement(source_el, 'SrcRect', xOff='0', yOff='0',
+                                   xSize=str(w), ySize=str(h))
+            ElementTree.SubElement(source_el, 'DstRect', xOff=str(xoff),
+                                   yOff=str(yoff), xSize=str(w), ySize=str(h))
+            if opaque:
+                # any value scaled by 0, plus 255
+                ElementTree.SubElement(source_el, 'ScaleOffset').text = '255'
+                ElementTree.SubElement(source_el, 'ScaleRatio').text = '0'
+    ElementTree.indent(root)
+    ElementTree.ElementTree(root).write(filename, encoding='utf-8')
+
+
+def generate_tiffinfo(matrix, epsg=3857):
     ifd = TiffImagePlugin.ImageFileDirectory_v2()
     # GeoKeyDirectoryTag
     gkdt = [
@@ -344,22 +3084,38 @@ def generate_tiffinfo(matrix):
         0,  # NumberOfKeys
     ]
     # KeyID, TIFFTagLocation, KeyCount, ValueOffset
-    geokeys = [
-        # GTModelTypeGeoKey
-        (1024, 0, 1, 1),  # 2D projected coordinate reference system
-        # GTRasterTypeGeoKey
-        (1025, 0, 1, 1),  # PixelIsArea
-        # GTCitationGeoKey
-        (1026, 34737, 25, 0),
-        # GeodeticCitationGeoKey
-        (2049, 34737, 7, 25),
-        # GeogAngularUnitsGeoKey
-        (2054, 0, 1, 9102),  # degree
-        # ProjectedCRSGeoKey
-        (3072, 0, 1, 3857),
-        # ProjLinearUnitsGeoKey
-        (3076, 0, 1, 9001),  # metre
-    ]
+    if epsg == 3857:
+        geokeys = [
+            # GTModelTypeGeoKey
+            (1024, 0, 1, 1),  # 2D projected coordinate reference system
+            # GTRasterTypeGeoKey
+            (1025, 0, 1, 1),  # PixelIsArea
+            # GTCitationGeoKey
+            (1026, 34737, 25, 0),
+            # GeodeticCitationGeoKey
+            (2049, 34737, 7, 25),
+            # GeogAngularUnitsGeoKey
+            (2054, 0, 1, 9102),  # degree
+            # ProjectedCRSGeoKey
+            (3072, 0, 1, 3857),
+            # ProjLinearUnitsGeoKey
+            (3076, 0, 1, 9001),  # metre
+        ]
+    elif crs_is_geographic(epsg):
+        geokeys = [
+            (1024, 0, 1, 2),  # 2D geographic coordinate reference system
+            (1025, 0, 1, 1),  # PixelIsArea
+            # GeodeticCRSGeoKey
+            (2048, 0, 1, epsg),
+            (2054, 0, 1, 9102),  # degree
+        ]
+    else:
+        # the EPSG code implies the datum and units
+        geokeys = [
+            (1024, 0, 1, 1),
+            (1025, 0, 1, 1),
+            (3072, 0, 1, epsg),
+        ]
     gkdt[3] = len(geokeys)
     ifd.tagtype[34735] = 3  # short
     ifd[34735] = tuple(itertools.chain(gkdt, *geokeys))
@@ -367,7 +3123,8 @@ def generate_tiffinfo(matrix):
     ifd.tagtype[34736] = 12  # double
     # GeoAsciiParamsTag
     ifd.tagtype[34737] = 1  # byte
-    ifd[34737] = b'WGS 84 / Pseudo-Mercator|WGS 84|\x00'
+    if epsg == 3857:
+        ifd[34737] = b'WGS 84 / Pseudo-Mercator|WGS 84|\x00'
     a, b, c, d, e, f = matrix
     # ModelPixelScaleTag
     ifd.tagtype[33550] = 12  # double
@@ -390,10 +3147,555 @@ def generate_tiffinfo(matrix):
     return ifd
 
 
+TIFF_TYPE_FORMATS = {1: 'B', 2: 'B', 3: 'H', 4: 'L', 12: 'd', 16: 'Q'}
+
+
+def tiffinfo_tags(ifd):
+    """Convert a PIL ImageFileDirectory_v2 to {tag: (type, values)}."""
+    tags = {}
+    for tag, value in ifd.items():
+        if not isinstance(value, bytes):
+            value = tuple(value) if isinstance(value, (tuple, list)) else (value,)
+        tags[tag] = (ifd.tagtype[tag], value)
+    return tags
+
+
+def tiff_ifd_bytes(tags, offset, bigtiff=False, next_ifd=0):
+    """
+    Serialise one IFD that will be written at file position `offset`.
+
+    `tags` maps tag -> (type, values), values being a tuple or raw bytes.
+    Values that do not fit in the entry are appended after the IFD.
+    """
+    if bigtiff:
+        head = struct.pack('<Q', len(tags))
+        entry_fmt, ptr_fmt, inline = '<HHQ', '<Q', 8
+    else:
+        head = struct.pack('<H', len(tags))
+        entry_fmt, ptr_fmt, inline = '<HHL', '<L', 4
+    entry_size = struct.calcsize(entry_fmt) + inline
+    data_offset = offset + len(head) + entry_size * len(tags) + inline
+    entries = []
+    extra = bytearray()
+    for tag in sorted(tags):
+        tagtype, values = tags[tag]
+        if isinstance(values, bytes):
+            payload = values
+        else:
+            payload = struct.pack(
+                '<%d%s' % (len(values), TIFF_TYPE_FORMATS[tagtype]), *values)
+        count = len(payload) // struct.calcsize('<' + TIFF_TYPE_FORMATS[tagtype])
+        entry = struct.pack(entry_fmt, tag, tagtype, count)
+        if len(payload) <= inline:
+            entry += payload.ljust(inline, b'\0')
+        else:
+            if (data_offset + len(extra)) % 2:
+                extra.append(0)
+            entry += struct.pack(ptr_fmt, data_offset + len(extra))
+            extra += payload
+        entries.append(entry)
+    return head + b''.join(entries) + struct.pack(ptr_fmt, next_ifd) + extra
+
+
+def tiled_tiff_tags(size, bands, block_size, offsets, bytecounts, bigtiff=False):
+    """Baseline tags of a tiled, deflate-compressed 8-bit image."""
+    offset_type = 16 if bigtiff else 4
+    tags = {
+        256: (4, (size[0],)),  # ImageWidth
+        257: (4, (size[1],)),  # ImageLength
+        258: (3, (8,) * bands),  # BitsPerSample
+        259: (3, (8,)),  # Compression: Adobe deflate
+        262: (3, (2 if bands >= 3 else 1,)),  # PhotometricInterpretation
+        277: (3, (bands,)),  # SamplesPerPixel
+        284: (3, (1,)),  # PlanarConfiguration: contiguous
+        322: (3, (block_size,)),  # TileWidth
+        323: (3, (block_size,)),  # TileLength
+        324: (offset_type, tuple(offsets)),  # TileOffsets
+        325: (offset_type, tuple(bytecounts)),  # TileByteCounts
+        339: (3, (1,) * bands),  # SampleFormat: unsigned int
+    }
+    if bands in (2, 4):
+        tags[338] = (3, (2,))  # ExtraSamples: unassociated alpha
+    return tags
+
+
+class TiledTiffWriter:
+    """
+    Write a tiled, deflate-compressed 8-bit TIFF one block at a time.
+
+    Blocks are appended in whatever order they are written and the IFD goes
+    at the end of the file, so only one block has to be held in memory.
+    """
+
+    def __init__(self, filename, size, bands, block_size=256, tags=None,
+                 bigtiff=None, zlevel=6):
+        if block_size % 16:
+            raise ValueError("block_size must be a multiple of 16")
+        self.size = size
+        self.bands = bands
+        self.block_size = block_size
+        self.tags = tags or {}
+        self.zlevel = zlevel
+        if bigtiff is None:
+            bigtiff = size[0] * size[1] * bands >= 4*1024*1024*1024
+        self.bigtiff = bigtiff
+        self.across = -(-size[0] // block_size)
+        self.down = -(-size[1] // block_size)
+        self.offsets = [0] * (self.across * self.down)
+        self.bytecounts = [0] * (self.across * self.down)
+        self.fp = open(filename, 'wb')
+        self.fp.write(b'\0' * (16 if bigtiff else 8))
+
+    def write_block(self, bx, by, data):
+        """Write a block of block_size*block_size*bands interleaved bytes."""
+        if data is None:
+            return
+        index = by * self.across + bx
+        compressed = zlib.compress(data, self.zlevel)
+        self.offsets[index] = self.fp.tell()
+        self.bytecounts[index] = len(compressed)
+        self.fp.write(compressed)
+
+    def base_tags(self):
+        return tiled_tiff_tags(self.size, self.bands, self.block_size,
+                               self.offsets, self.bytecounts, self.bigtiff)
+
+    def close(self):
+        if self.fp.closed:
+            return
+        if not all(self.bytecounts):
+            # Blocks that never received any data share one empty block
+            empty_offset = self.fp.tell()
+            empty = zlib.compress(
+                bytes(self.block_size * self.block_size * self.bands), self.zlevel)
+            self.fp.write(empty)
+            for i, count in enumerate(self.bytecounts):
+                if not count:
+                    self.offsets[i] = empty_offset
+                    self.bytecounts[i] = len(empty)
+        if self.fp.tell() % 2:
+            self.fp.write(b'\0')
+        ifd_offset = self.fp.tell()
+        tags = self.tags.copy()
+        tags.update(self.base_tags())
+        self.fp.write(tiff_ifd_bytes(tags, ifd_offset, self.bigtiff))
+        self.fp.seek(0)
+        if self.bigtiff:
+            self.fp.write(b'II+\0' + struct.pack('<HHQ', 8, 0, ifd_offset))
+        else:
+            self.fp.write(b'II*\0' + struct.pack('<L', ifd_offset))
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class StreamingGeoTIFF:
+    """
+    Write downloaded tiles straight into a tiled GeoTIFF.
+
+    Each output block is flushed as soon as every tile overlapping it has
+    arrived, so with tiles added row by row memory depends on the extent
+    width and the tiles in flight, not the extent height. The tile size and
+    mode are taken from the first non-empty tile.
+    """
+
+    def __init__(self, filename, extent, tile_extent, block_size=256, mode=None):
+        self.filename = filename
+        self.force_mode = mode
+        self.extent = extent
+        self.tile_extent = tile_extent
+        x0, y0, x1, y1 = tile_extent
+        self.bbox = (math.floor(x0), math.floor(y0), math.ceil(x1), math.ceil(y1))
+        self.block_size = block_size
+        self.writer = None
+        self.matrix = None
+        self.mode = None
+        self.tile_size = None
+        self.window = None
+        self.pending = {}
+        self.deferred = []
+
+    def _init(self, tile_size, mode):
+        self.tile_size = tile_size
+        self.mode = mode
+        self.window = crop_window(*self.tile_extent, self.bbox, tile_size)
+        size = self.window[2:]
+        self.matrix = extent_matrix(*self.extent, size)
+        self.writer = TiledTiffWriter(
+            self.filename, size, len(mode), self.block_size,
+            tags=tiffinfo_tags(generate_tiffinfo(self.matrix)))
+        deferred = self.deferred
+        self.deferred = []
+        for xy in deferred:
+            self._add(None, xy)
+
+    def _tiles_in_block(self, bx, by):
+        x2, y2, imgw, imgh = self.window
+        bs = self.block_size
+        px0 = bx * bs + x2
+        px1 = min((bx + 1) * bs, imgw) + x2 - 1
+        py0 = by * bs + y2
+        py1 = min((by + 1) * bs, imgh) + y2 - 1
+        return ((px1 // self.tile_size[0] - px0 // self.tile_size[0] + 1) *
+                (py1 // self.tile_size[1] - py0 // self.tile_size[1] + 1))
+
+    def add_tile(self, tile, xy):
+        if tile is None:
+            if self.writer is None:
+                self.deferred.append(xy)
+            else:
+                self._add(None, xy)
+            return
+        im = Image.open(io.BytesIO(tile))
+        if self.writer is None:
+            self._init(im.size, self.force_mode or (
+                'RGB' if im.mode == 'RGB' else 'RGBA'))
+        elif im.size != self.tile_size:
+            raise ValueError("Tile size changed from %s to %s" % (
+                self.tile_size, im.size))
+        if im.mode != self.mode:
+            im = im.convert(self.mode)
+        if self.mode == 'RGBA' and is_empty(im):
+            im.close()
+            im = None
+        self._add(im, xy)
+        if im is not None:
+            im.close()
+
+    def _add(self, im, xy):
+        x2, y2, imgw, imgh = self.window
+        bs = self.block_size
+        left = (xy[0] - self.bbox[0]) * self.tile_size[0] - x2
+        top = (xy[1] - self.bbox[1]) * self.tile_size[1] - y2
+        ox0, ox1 = max(0, left), min(imgw, left + self.tile_size[0])
+        oy0, oy1 = max(0, top), min(imgh, top + self.tile_size[1])
+        if ox0 >= ox1 or oy0 >= oy1:
+            return
+        for by in range(oy0 // bs, (oy1 - 1) // bs + 1):
+            for bx in range(ox0 // bs, (ox1 - 1) // bs + 1):
+                entry = self.pending.get((bx, by))
+                if entry is None:
+                    entry = self.pending[(bx, by)] = [
+                        self._tiles_in_block(bx, by), None]
+                if im is not None:
+                    if entry[1] is None:
+                        entry[1] = Image.new(self.mode, (bs, bs))
+                    entry[1].paste(im, (left - bx * bs, top - by * bs))
+                entry[0] -= 1
+                if entry[0] <= 0:
+                    del self.pending[(bx, by)]
+                    self._flush(bx, by, entry[1])
+
+    def _flush(self, bx, by, block):
+        if block is None:
+            return
+        self.writer.write_block(bx, by, block.tobytes())
+        block.close()
+
+    def close(self):
+        if self.writer is None:
+            self._init((256, 256), 'RGBA')
+        # Blocks still pending here belong to a cancelled or failed download
+        for (bx, by), entry in self.pending.items():
+            self._flush(bx, by, entry[1])
+        self.pending.clear()
+        self.writer.close()
+
+
+def level_size(level):
+    if numpy is not None and isinstance(level, numpy.ndarray):
+        return (level.shape[1], level.shape[0])
+    return level.size
+
+
+def halve_image(level):
+    """Halve an image or (H, W, bands) array by averaging 2x2 blocks."""
+    if numpy is None or not isinstance(level, numpy.ndarray):
+        return level.reduce(2)
+    h, w, bands = level.shape
+    if h % 2 or w % 2:
+        # repeat the last row/column so edge pixels average with themselves
+        level = numpy.pad(level, ((0, h % 2), (0, w % 2), (0, 0)), mode='edge')
+    if bands == 4:
+        return downsample_2x2(level)
+    blocks = level.reshape(
+        level.shape[0] // 2, 2, level.shape[1] // 2, 2, bands).astype(numpy.uint16)
+    return ((blocks.sum(axis=(1, 3)) + 2) // 4).astype(numpy.uint8)
+
+
+def image_block(level, bx, by, block_size):
+    """Bytes of one block of an image or array, zero-padded at the edges."""
+    x, y = bx * block_size, by * block_size
+    if numpy is None or not isinstance(level, numpy.ndarray):
+        return level.crop((x, y, x + block_size, y + block_size)).tobytes()
+    block = level[y:y+block_size, x:x+block_size]
+    if block.shape[:2] != (block_size, block_size):
+        padded = numpy.zeros((block_size, block_size, block.shape[2]), numpy.uint8)
+        padded[:block.shape[0], :block.shape[1]] = block
+        block = padded
+    return block.tobytes()
+
+
+def save_cog(img, filename, matrix, block_size=512, zlevel=6, epsg=3857):
+    """
+    Save a Cloud-Optimized GeoTIFF without GDAL.
+
+    The image is tiled and gets reduced-resolution IFDs down to one block.
+    All IFDs come first, then the blocks from the smallest overview to the
+    full resolution, so readers can fetch a window or a low zoom with a few
+    range requests.
+    """
+    if numpy is not None and isinstance(img, numpy.ndarray):
+        level = img if img.ndim == 3 else img[..., None]
+    else:
+        if img.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+        level = numpy.asarray(img) if numpy is not None else img
+        if numpy is not None and level.ndim == 2:
+            level = level[..., None]
+    size = level_size(level)
+    bands = level.shape[2] if numpy is not None else len(level.getbands())
+    levels = [level]
+    while max(level_size(level)) > block_size:
+        level = halve_image(level)
+        levels.append(level)
+    bigtiff = size[0] * size[1] * bands >= 4*1024*1024*1024
+    geotags = tiffinfo_tags(generate_tiffinfo(matrix, epsg))
+    grids = []
+    ifds = []
+    # IFD sizes don't depend on the offset values, so lay them out first
+    pos = 16 if bigtiff else 8
+    for i, level in enumerate(levels):
+        w, h = level_size(level)
+        across, down = -(-w // block_size), -(-h // block_size)
+        grids.append((across, down))
+        tags = tiled_tiff_tags((w, h), bands, block_size, (0,) * (across * down),
+                               (0,) * (across * down), bigtiff)
+        if i:
+            tags[254] = (4, (1,))  # NewSubfileType: reduced resolution
+        else:
+            tags.update(geotags)
+        ifds.append([pos, tags])
+        pos += len(tiff_ifd_bytes(tags, pos, bigtiff))
+        pos += pos % 2
+    with open(filename, 'wb') as fp:
+        fp.write(b'\0' * pos)
+        for (pos, tags), level, (across, down) in reversed(
+                list(zip(ifds, levels, grids))):
+            offsets = []
+            bytecounts = []
+            for by in range(down):
+                for bx in range(across):
+                    data = zlib.compress(
+                        image_block(level, bx, by, block_size), zlevel)
+                    offsets.append(fp.tell())
+                    bytecounts.append(len(data))
+                    fp.write(data)
+            tags[324] = (tags[324][0], tuple(offsets))
+            tags[325] = (tags[325][0], tuple(bytecounts))
+        fp.seek(0)
+        if bigtiff:
+            fp.write(b'II+\0' + struct.pack('<HHQ', 8, 0, ifds[0][0]))
+        else:
+            fp.write(b'II*\0' + struct.pack('<L', ifds[0][0]))
+        for i, (pos, tags) in enumerate(ifds):
+            next_ifd = ifds[i + 1][0] if i + 1 < len(ifds) else 0
+            fp.seek(pos)
+            fp.write(tiff_ifd_bytes(tags, pos, bigtiff, next_ifd))
+    return img
+
+
+def lonlat_to_mercator(lon, lat):
+    return (numpy.radians(lon) * EARTH_EQUATORIAL_RADIUS,
+            numpy.log(numpy.tan(numpy.radians(45 + lat / 2.0))) * EARTH_EQUATORIAL_RADIUS)
+
+
+def mercator_to_lonlat(x, y):
+    return (numpy.degrees(x / EARTH_EQUATORIAL_RADIUS),
+            numpy.degrees(2 * numpy.arctan(numpy.exp(y / EARTH_EQUATORIAL_RADIUS))
+                          - math.pi / 2))
+
+
+def crs_is_geographic(epsg):
+    if epsg in (3857, 4326):
+        return epsg == 4326
+    import pyproj
+    return pyproj.CRS.from_epsg(epsg).is_geographic
+
+
+def crs_transformers(epsg):
+    """
+    Return (to_3857, from_3857), functions mapping x and y arrays between
+    EPSG:3857 and `epsg` (x = longitude for geographic CRSs). EPSG:4326 is
+    built in, other codes need pyproj.
+    """
+    if epsg == 3857:
+        return (lambda x, y: (x, y)), (lambda x, y: (x, y))
+    elif epsg == 4326:
+        return lonlat_to_mercator, mercator_to_lonlat
+    try:
+        import pyproj
+    except ImportError:
+        raise RuntimeError("Reprojecting to EPSG:%d needs pyproj" % epsg)
+    to_3857 = pyproj.Transformer.from_crs(epsg, 3857, always_xy=True)
+    from_3857 = pyproj.Transformer.from_crs(3857, epsg, always_xy=True)
+    return to_3857.transform, from_3857.transform
+
+
+def reproject_grid(size, matrix, epsg, resolution=None):
+    """
+    Size and geotransform of the north-up grid in `epsg` that covers an
+    EPSG:3857 image. By default the pixel count stays about the same.
+    """
+    w, h = size
+    a, b, c, d, e, f = matrix
+    # the outline bulges in most projections, so sample along the edges
+    t = numpy.linspace(0, 1, 65)
+    xs = numpy.concatenate((a + t*w*b, numpy.full_like(t, a + w*b),
+                            a + t*w*b, numpy.full_like(t, a)))
+    ys = numpy.concatenate((numpy.full_like(t, d), d + t*h*f,
+                            numpy.full_like(t, d + h*f), d + t*h*f))
+    X, Y = crs_transformers(epsg)[1](xs, ys)
+    minx, maxx = float(numpy.min(X)), float(numpy.max(X))
+    miny, maxy = float(numpy.min(Y)), float(numpy.max(Y))
+    if resolution is None:
+        resolution = math.sqrt((maxx - minx) * (maxy - miny) / (w * h))
+    size = (max(1, math.ceil((maxx - minx) / resolution)),
+            max(1, math.ceil((maxy - miny) / resolution)))
+    return size, (minx, resolution, 0.0, maxy, 0.0, -resolution)
+
+
+def reproject_block(src, src_matrix, to_3857, dst_matrix, x0, y0, w, h,
+                    resampling='bilinear'):
+    """
+    Resample one (h, w) block of the output grid from an (H, W, bands)
+    EPSG:3857 array by inverse mapping every output pixel centre. Returns
+    RGBA, transparent where the block falls outside the source.
+    """
+    sh, sw, bands = src.shape
+    a, b, _, d, _, f = dst_matrix
+    cols = a + (numpy.arange(x0, x0 + w) + 0.5) * b
+    rows = d + (numpy.arange(y0, y0 + h) + 0.5) * f
+    X, Y = numpy.meshgrid(cols, rows)
+    mx, my = to_3857(X.ravel(), Y.ravel())
+    sa, sb, _, sd, _, sf = src_matrix
+    sx = ((numpy.asarray(mx) - sa) / sb - 0.5).reshape(h, w)
+    sy = ((numpy.asarray(my) - sd) / sf - 0.5).reshape(h, w)
+    out = numpy.zeros((h, w, 4), dtype=numpy.uint8)
+    inside = (sx >= -0.5) & (sx < sw - 0.5) & (sy >= -0.5) & (sy < sh - 0.5)
+    if not inside.any():
+        return out
+    sx = sx[inside]
+    sy = sy[inside]
+    if resampling == 'nearest':
+        values = src[numpy.floor(sy + 0.5).astype(numpy.intp),
+                     numpy.floor(sx + 0.5).astype(numpy.intp)]
+    else:
+        # the outer half pixel repeats the edge pixels
+        sx = numpy.clip(sx, 0, sw - 1)
+        sy = numpy.clip(sy, 0, sh - 1)
+        fx = numpy.floor(sx)
+        fy = numpy.floor(sy)
+        wx = (sx - fx)[:, None]
+        wy = (sy - fy)[:, None]
+        ix0 = fx.astype(numpy.intp)
+        ix1 = numpy.minimum(ix0 + 1, sw - 1)
+        iy0 = fy.astype(numpy.intp)
+        iy1 = numpy.minimum(iy0 + 1, sh - 1)
+        top = src[iy0, ix0] * (1 - wx) + src[iy0, ix1] * wx
+        bottom = src[iy1, ix0] * (1 - wx) + src[iy1, ix1] * wx
+        values = (top * (1 - wy) + bottom * wy + 0.5).astype(numpy.uint8)
+    out[inside, :bands] = values
+    if bands == 3:
+        out[inside, 3] = 255
+    return out
+
+
+def save_reprojected(img, filename, matrix, epsg, resampling='bilinear',
+                     resolution=None, block_size=256, cog=False):
+    """
+    Save an EPSG:3857 image or array as a tiled GeoTIFF in another CRS.
+
+    Output blocks are computed one at a time and written straight to the
+    file, so the only full-size copy is the source image itself; a `cog`
+    needs the whole output for its overviews, so it is assembled first.
+    Returns the output size and geotransform.
+    """
+    if numpy is None:
+        raise RuntimeError("Reprojection needs numpy")
+    if not os.path.splitext(filename)[1].lower().startswith('.tif'):
+        raise ValueError("Reprojected output must be a .tif/.tiff file")
+    src = img if isinstance(img, numpy.ndarray) else numpy.asarray(img)
+    if src.ndim == 2:
+        src = src[..., None].repeat(3, axis=2)
+    size, dst_matrix = reproject_grid(
+        (src.shape[1], src.shape[0]), matrix, epsg, resolution)
+    to_3857 = crs_transformers(epsg)[0]
+    if cog:
+        out = numpy.zeros((size[1], size[0], 4), dtype=numpy.uint8)
+        for y in range(0, size[1], block_size):
+            for x in range(0, size[0], block_size):
+                w = min(block_size, size[0] - x)
+                h = min(block_size, size[1] - y)
+                out[y:y+h, x:x+w] = reproject_block(
+                    src, matrix, to_3857, dst_matrix, x, y, w, h, resampling)
+        save_cog(out, filename, dst_matrix, epsg=epsg)
+        return size, dst_matrix
+    tags = tiffinfo_tags(generate_tiffinfo(dst_matrix, epsg))
+    with TiledTiffWriter(filename, size, 4, block_size, tags=tags) as writer:
+        for by in range(writer.down):
+            for bx in range(writer.across):
+                block = reproject_block(
+                    src, matrix, to_3857, dst_matrix, bx * block_size,
+                    by * block_size, block_size, block_size, resampling)
+                if block[..., 3].any():
+                    writer.write_block(bx, by, block.tobytes())
+    return size, dst_matrix
+
+
 def img_memorysize(img):
+    if numpy is not None and isinstance(img, numpy.ndarray):
+        return img.size
     return img.size[0] * img.size[1] * len(img.getbands())
 
 
+def peak_rss():
+    """Peak resident set size of this process in bytes, or None if unknown."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes everywhere except macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def image_blocks(img, block_size):
+    """
+    Yield (xoff, yoff, block) windows of an image or (H, W, bands) array as
+    (h, w, bands) uint8 arrays. Array windows are views of the array, image
+    windows are copied out one block at a time.
+    """
+    if isinstance(img, numpy.ndarray):
+        h, w = img.shape[:2]
+    else:
+        w, h = img.size
+    for yoff in range(0, h, block_size):
+        for xoff in range(0, w, block_size):
+            if isinstance(img, numpy.ndarray):
+                block = img[yoff:yoff+block_size, xoff:xoff+block_size]
+            else:
+                block = numpy.asarray(img.crop((
+                    xoff, yoff, min(w, xoff + block_size), min(h, yoff + block_size))))
+            if block.ndim == 2:
+                block = block[..., None]
+            yield xoff, yoff, block
+
+
 def save_image(img, filename, matrix, **params):
     wld_ext = {
         '.gif': '.gfw',
@@ -406,6 +3708,11 @@ def save_image(img, filename, matrix, **params):
     }
     basename, ext = os.path.splitext(filename)
     ext = ext.lower()
+    if ext.startswith('.tif') and img_memorysize(img) >= 4*1024*1024*1024:
+        # BigTIFF; an array goes to GDAL as is, without a PIL copy
+        return save_geotiff_gdal(img, filename, matrix)
+    if numpy is not None and isinstance(img, numpy.ndarray):
+        img = array_to_image(img)
     wld_name = basename + wld_ext.get(ext, '.wld')
     img_params = params.copy()
     if ext == '.jpg':
@@ -414,9 +3721,6 @@ def save_image(img, filename, matrix, **params):
     elif ext == '.png':
         img_params['optimize'] = True
     elif ext.startswith('.tif'):
-        if img_memorysize(img) >= 4*1024*1024*1024:
-            # BigTIFF
-            return save_geotiff_gdal(img, filename, matrix)
         img_params['compression'] = 'tiff_adobe_deflate'
         img_params['tiffinfo'] = generate_tiffinfo(matrix)
     img.save(filename, **img_params)
@@ -427,7 +3731,14 @@ def save_image(img, filename, matrix, **params):
     return img
 
 
-def save_geotiff_gdal(img, filename, matrix):
+def save_geotiff_gdal(img, filename, matrix, block_size=256):
+    """
+    Save a tiled GeoTIFF with GDAL, one block-sized window at a time.
+
+    `img` can be a PIL image or an (H, W, bands) uint8 array such as the
+    mosaic from download_extent(as_array=True); the whole image is never
+    converted or copied, so memory stays close to the image itself.
+    """
     if 'GDAL_DATA' in os.environ:
         del os.environ['GDAL_DATA']
     if 'PROJ_LIB' in os.environ:
@@ -437,36 +3748,231 @@ def save_geotiff_gdal(img, filename, matrix):
     from osgeo import gdal
     gdal.UseExceptions()
 
-    imgbands = len(img.getbands())
+    if isinstance(img, numpy.ndarray):
+        if img.ndim == 2:
+            img = img[..., None]
+        height, width, imgbands = img.shape
+    else:
+        width, height = img.size
+        imgbands = len(img.getbands())
     driver = gdal.GetDriverByName('GTiff')
-    gdal_options = ['COMPRESS=DEFLATE', 'PREDICTOR=2', 'ZLEVEL=9', 'TILED=YES']
+    gdal_options = ['COMPRESS=DEFLATE', 'PREDICTOR=2', 'ZLEVEL=9', 'TILED=YES',
+                    'BLOCKXSIZE=%d' % block_size, 'BLOCKYSIZE=%d' % block_size]
     if img_memorysize(img) >= 4*1024*1024*1024:
         gdal_options.append('BIGTIFF=YES')
     if img_memorysize(img) >= 50*1024*1024:
         gdal_options.append('NUM_THREADS=%d' % max(1, os.cpu_count()))
 
-    gtiff = driver.Create(filename, img.size[0], img.size[1],
+    gtiff = driver.Create(filename, width, height,
         imgbands, gdal.GDT_Byte,
         options=gdal_options)
     gtiff.SetGeoTransform(matrix)
     gtiff.SetProjection(WKT_3857)
-    for band in range(imgbands):
-        array = numpy.array(img.getdata(band), dtype='u8')
-        array = array.reshape((img.size[1], img.size[0]))
-        band = gtiff.GetRasterBand(band + 1)
-        band.WriteArray(array)
+    bands = [gtiff.GetRasterBand(band + 1) for band in range(imgbands)]
+    for xoff, yoff, block in image_blocks(img, block_size):
+        for band, gdal_band in enumerate(bands):
+            gdal_band.WriteArray(block[..., band], xoff, yoff)
     gtiff.FlushCache()
+    gtiff = None
     return img
 
 
-def save_image_auto(img, filename, matrix, use_gdal=False, **params):
+def save_image_auto(img, filename, matrix, use_gdal=False, cog=False, **params):
     ext = os.path.splitext(filename)[1].lower()
     if ext in ('.tif', '.tiff') and use_gdal:
         return save_geotiff_gdal(img, filename, matrix)
+    elif ext in ('.tif', '.tiff') and cog:
+        return save_cog(img, filename, matrix)
     else:
         return save_image(img, filename, matrix, **params)
 
 
+def image_mime(data):
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    elif data.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    elif data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    elif data.startswith(b'GIF8'):
+        return 'image/gif'
+    return 'application/octet-stream'
+
+
+class MBTilesReader:
+    """
+    Look up XYZ tiles in one or more MBTiles files, the first file that has
+    a tile wins. Read-only connections are pooled and reuse their prepared
+    statements; files that don't exist yet are picked up once they do.
+    """
+
+    QUERY = ("SELECT tile_data FROM tiles "
+             "WHERE zoom_level=? AND tile_column=? AND tile_row=?")
+
+    def __init__(self, filenames):
+        self.filenames = list(filenames)
+        self.pools = [queue.LifoQueue() for _ in self.filenames]
+
+    def _connect(self, filename):
+        uri = 'file:%s?mode=ro' % urllib.parse.quote(os.path.abspath(filename))
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    def get(self, zoom, x, y):
+        row = (1 << zoom) - 1 - y
+        for filename, pool in zip(self.filenames, self.pools):
+            try:
+                db = pool.get_nowait()
+            except queue.Empty:
+                if not os.path.isfile(filename):
+                    continue
+                db = self._connect(filename)
+            try:
+                found = db.execute(self.QUERY, (zoom, x, row)).fetchone()
+            except sqlite3.OperationalError:
+                # the file is still being created
+                db.close()
+                continue
+            pool.put(db)
+            if found and found[0]:
+                return found[0]
+        return None
+
+    def close(self):
+        for pool in self.pools:
+            while not pool.empty():
+                pool.get_nowait().close()
+
+
+class LRUTileCache:
+    """In-memory LRU of tile data, bounded by total bytes."""
+
+    def __init__(self, max_bytes=64*1024*1024):
+        self.max_bytes = max_bytes
+        self.tiles = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.tiles.get(key)
+            if value is not None:
+                self.tiles.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            old = self.tiles.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.tiles[key] = value
+            self.size += len(value[0])
+            while self.size > self.max_bytes and self.tiles:
+                self.size -= len(self.tiles.popitem(last=False)[1][0])
+
+
+class TileRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    re_path = re.compile(r'^/(\d+)/(\d+)/(\d+)(?:\.\w+)?/?(?:\?.*)?$')
+
+    def do_GET(self):
+        server = self.server
+        match = self.re_path.match(self.path)
+        if not match:
+            self.send_empty(404)
+            return
+        key = tuple(map(int, match.groups()))
+        entry = server.lru.get(key)
+        if entry is None:
+            data = server.reader.get(*key)
+            if data is None and server.upstream is not None:
+                try:
+                    # one short attempt, so a viewer isn't held up by an
+                    # upstream that is down
+                    data = get_tile(server.upstream.url(*key), retries=1,
+                                    timeout=server.upstream_timeout)
+                except Exception:
+                    self.send_empty(502)
+                    return
+            if data is None:
+                self.send_empty(404, 'max-age=60')
+                return
+            entry = (data, '"%s"' % hashlib.md5(data).hexdigest(), image_mime(data))
+            server.lru.put(key, entry)
+        data, etag, mime = entry
+        cache_control = 'public, max-age=%d' % server.max_age
+        if self.headers.get('If-None-Match') == etag:
+            self.send_empty(304, cache_control, etag)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', mime)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('ETag', etag)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_empty(self, code, cache_control='no-cache', etag=None):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.send_header('Cache-Control', cache_control)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TileServer(http.server.ThreadingHTTPServer):
+    """
+    Serve /{z}/{x}/{y} tiles out of MBTiles files, with an in-memory LRU of
+    hot tiles. Tiles missing from the files are fetched from `upstream` (a
+    template or TileSource) if given, otherwise answered with 404. An
+    upstream that fails or takes longer than `upstream_timeout` seconds
+    gets a 502.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, mbtiles, host='127.0.0.1', port=0, upstream=None,
+                 cache_bytes=64*1024*1024, max_age=86400, upstream_timeout=5):
+        super().__init__((host, port), TileRequestHandler)
+        if isinstance(mbtiles, str):
+            mbtiles = [mbtiles]
+        self.reader = MBTilesReader(mbtiles)
+        self.lru = LRUTileCache(cache_bytes)
+        self.upstream = tile_source(upstream) if upstream else None
+        self.upstream_timeout = upstream_timeout
+        self.max_age = max_age
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d/{z}/{x}/{y}' % self.server_address[:2]
+
+    def start(self):
+        """Serve from a daemon thread and return self."""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        if self.thread is not None:
+            self.shutdown()
+            self.thread = None
+        self.server_close()
+        self.reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 class TaskCancelled(RuntimeError):
     pass
 
@@ -479,6 +3985,46 @@ def parse_extent(s):
     except (IndexError, ValueError):
         raise ValueError("Invalid extent, should be: min_lon,min_lat,max_lon,max_lat")
 
+class DownloadWorker(threading.Thread):
+    """
+    Download an extent and save it on a background thread.
+
+    Events are posted to `events` as tuples: ('progress', progress, total,
+    done), ('saving',), then one of ('done',), ('cancelled',) or
+    ('error', exception).
+    """
+
+    def __init__(self, args, filename=None, **kwargs):
+        super().__init__(daemon=True)
+        self.args = args
+        self.filename = filename
+        self.kwargs = kwargs
+        self.events = queue.Queue()
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def progress(self, progress, total, done=False):
+        if self.cancelled.is_set():
+            raise TaskCancelled()
+        self.events.put(('progress', progress, total, done))
+
+    def run(self):
+        try:
+            img, matrix = download_extent(
+                *self.args, progress_callback=self.progress, **self.kwargs)
+            if self.filename:
+                self.events.put(('saving',))
+                save_image_auto(img, self.filename, matrix)
+        except TaskCancelled:
+            self.events.put(('cancelled',))
+        except Exception as ex:
+            self.events.put(('error', ex))
+        else:
+            self.events.put(('done',))
+
+
 def gui():
     import tkinter as tk
     import tkinter.ttk as ttk
@@ -540,37 +4086,72 @@ def gui():
     e_mbtiles.grid(column=1, row=6, sticky='we')
     b_mbtiles = ttk.Button(frame, text='...', width=3, command=cmd_get_save_mbtiles)
     b_mbtiles.grid(column=2, row=6, sticky='we')
+    l_concurrency = ttk.Label(frame, width=10, text="Workers:")
+    l_concurrency.grid(column=0, row=7, sticky='w')
+    v_concurrency = tk.StringVar()
+    v_concurrency.set(str(DEFAULT_CONCURRENCY['thread']))
+    e_concurrency = ttk.Spinbox(frame, width=10, textvariable=v_concurrency, **{
+        'from': 1, 'to': 256, 'increment': 1
+    })
+    e_concurrency.grid(column=1, row=7, sticky='w')
+    v_async = tk.BooleanVar()
+
+    def cmd_toggle_async():
+        v_concurrency.set(str(DEFAULT_CONCURRENCY[
+            'async' if v_async.get() else 'thread']))
+
+    c_async = ttk.Checkbutton(
+        frame, text='Async (HTTP/2)', variable=v_async, command=cmd_toggle_async)
+    c_async.grid(column=1, row=7, columnspan=2, sticky='e')
+    if httpx is None:
+        c_async.configure(state='disabled')
+    else:
+        # cancelling aborts async requests in flight
+        v_async.set(True)
+        cmd_toggle_async()
     p_progress = ttk.Progressbar(frame, mode='determinate')
-    p_progress.grid(column=0, row=7, columnspan=3, sticky='we', pady=(5, 2))
+    p_progress.grid(column=0, row=8, columnspan=3, sticky='we', pady=(5, 2))
 
-    started = False
-    stop_download = False
+    worker = None
 
     def reset():
         b_download.configure(
             text='Download', state='normal', command=cmd_download)
-        root_tk.update()
 
-    def update_progress(progress, total, done):
-        nonlocal started, stop_download
-        if not started:
-            if done:
-                p_progress.configure(maximum=total, value=progress)
+    def show_message(show, message):
+        show(title='tms2geotiff', message=message, master=frame)
+
+    def poll():
+        nonlocal worker
+        while 1:
+            try:
+                event = worker.events.get_nowait()
+            except queue.Empty:
+                root_tk.after(50, poll)
+                return
+            kind = event[0]
+            if kind == 'progress':
+                progress, total, done = event[1:]
+                p_progress.configure(maximum=max(total, 1))
+                if done:
+                    p_progress.configure(value=progress)
+            elif kind == 'saving':
+                b_download.configure(text='Saving...', state='disabled')
             else:
-                p_progress.configure(maximum=total)
-            started = True
-        elif done:
-            p_progress.configure(value=progress)
-        root_tk.update()
-        if stop_download:
-            raise TaskCancelled()
+                break
+        worker = None
+        reset()
+        if kind == 'done':
+            show_message(tkinter.messagebox.showinfo, "Download complete.")
+        elif kind == 'cancelled':
+            show_message(tkinter.messagebox.showwarning, "Download cancelled.")
+        else:
+            ex = event[1]
+            show_message(tkinter.messagebox.showerror,
+                         "%s: %s" % (type(ex).__name__, ex))
 
     def cmd_download():
-        nonlocal started, stop_download
-        started = False
-        stop_download = False
-        b_download.configure(text='Cancel', command=cmd_cancel)
-        root_tk.update()
+        nonlocal worker
         try:
             url = v_url.get().strip()
             args = [url]
@@ -578,53 +4159,27 @@ def gui():
             args.append(int(v_zoom.get()))
             filename = v_output.get()
             mbtiles = v_mbtiles.get()
-            kwargs = {'mbtiles': mbtiles, 'save_image': bool(filename)}
+            kwargs = {
+                'mbtiles': mbtiles, 'save_image': bool(filename),
+                'engine': 'async' if v_async.get() else 'thread',
+                'concurrency': int(v_concurrency.get()),
+            }
             if not all(args) or not any((filename, mbtiles)):
                 raise ValueError("Empty input")
         except (TypeError, ValueError, IndexError) as ex:
-            reset()
-            tkinter.messagebox.showerror(
-                title='tms2geotiff',
-                message="Invalid input: %s: %s" % (type(ex).__name__, ex),
-                master=frame
-            )
+            show_message(tkinter.messagebox.showerror,
+                         "Invalid input: %s: %s" % (type(ex).__name__, ex))
             return
-        root_tk.update()
-        try:
-            img, matrix = download_extent(
-                *args, progress_callback=update_progress, **kwargs)
-            b_download.configure(text='Saving...', state='disabled')
-            root_tk.update()
-            if filename:
-                save_image_auto(img, filename, matrix)
-            reset()
-        except TaskCancelled:
-            reset()
-            tkinter.messagebox.showwarning(
-                title='tms2geotiff',
-                message="Download cancelled.",
-                master=frame
-            )
-            return
-        except Exception as ex:
-            reset()
-            tkinter.messagebox.showerror(
-                title='tms2geotiff',
-                message="%s: %s" % (type(ex).__name__, ex),
-                master=frame
-            )
-            return
-        tkinter.messagebox.showinfo(
-            title='tms2geotiff',
-            message="Download complete.",
-            master=frame
-        )
+        p_progress.configure(value=0)
+        b_download.configure(text='Cancel', command=cmd_cancel)
+        worker = DownloadWorker(args, filename, **kwargs)
+        worker.start()
+        root_tk.after(50, poll)
 
     def cmd_cancel():
-        nonlocal started, stop_download
-        started = False
-        stop_download = True
-        reset()
+        if worker is not None:
+            worker.cancel()
+        b_download.configure(text='Cancelling...', state='disabled')
 
     b_download = ttk.Button(
         width=15, text='Download', default='active', command=cmd_download)
@@ -633,20 +4188,299 @@ def gui():
     root_tk.mainloop()
 
 
+def main_pyramid(argv):
+    parser = argparse.ArgumentParser(
+        prog="tms2geotiff.py pyramid",
+        description="Build the lower zoom levels of an MBTiles file from "
+        "its highest zoom level, without downloading anything.")
+    parser.add_argument("mbtiles", help="MBTiles file")
+    parser.add_argument("--minzoom", type=int, required=True,
+        help="lowest zoom level to build")
+    parser.add_argument("--maxzoom", type=int,
+        help="zoom level to build from (default: highest stored)")
+    parser.add_argument("--resampling", choices=('mean', 'lanczos'), default='mean',
+        help="2x2 downsampling filter (default: mean)")
+    parser.add_argument("-p", "--processes", type=int,
+        help="worker processes (default: CPU count)")
+    args = parser.parse_args(argv)
+
+    def print_level(zoom, done, total):
+        print("\rZoom %d: %d/%d" % (zoom, done, total),
+              end='\n' if done == total else '', flush=True)
+
+    written = mbtiles_build_pyramid(
+        args.mbtiles, args.minzoom, args.maxzoom, args.resampling,
+        args.processes, progress_callback=print_level)
+    print("Wrote %d tiles." % sum(written.values()))
+    return 0
+
+
+def main_batch(argv):
+    parser = argparse.ArgumentParser(
+        prog="tms2geotiff.py batch",
+        description="Download many extents in one run, fetching tiles shared "
+        "by several extents only once.")
+    parser.add_argument("jobs", help="CSV (min_lon,min_lat,max_lon,max_lat"
+        "[,zoom,output,buffer]) or GeoJSON file of extents")
+    parser.add_argument("-s", "--source", metavar='URL', default=DEFAULT_TMS,
+        help="TMS server url (default is OpenStreetMap: %s)" % DEFAULT_TMS)
+    parser.add_argument("-z", "--zoom", type=int,
+        help="zoom level for rows without one")
+    parser.add_argument("-d", "--output-dir", default='.',
+        help="directory for rows without an output (default: current)")
+    parser.add_argument("-b", "--buffer", type=float, default=0, metavar='METRES',
+        help="corridor half-width for GeoJSON lines without a buffer property")
+    parser.add_argument("--engine", choices=('thread', 'async'), default='thread')
+    parser.add_argument("-c", "--concurrency", type=int)
+    parser.add_argument("--max-concurrency", type=int)
+    parser.add_argument("--cache", metavar='FILE',
+        help="keep downloaded tiles in this SQLite cache and reuse them")
+    parser.add_argument("--cog", action='store_true',
+        help="save .tif outputs as Cloud-Optimized GeoTIFFs")
+    parser.add_argument("--blank-index", metavar='FILE',
+        help="skip tiles this SQLite index knows to be blank, and record "
+        "new ones")
+    parser.add_argument("--hedge", type=float, nargs='?', const=0.05,
+        metavar='RATE', help="duplicate requests slower than twice the running p95, "
+        "for at most RATE of all requests (default 0.05)")
+    parser.add_argument("--telemetry", metavar='FILE',
+        help="write a JSON report of stage timings, status codes and retries")
+    parser.add_argument("--prometheus", metavar='FILE',
+        help="also write it as a Prometheus textfile (.prom)")
+    args = parser.parse_args(argv)
+    jobs = read_batch_jobs(args.jobs, args.zoom, args.output_dir, args.buffer)
+    cache = TileCache(args.cache) if args.cache else None
+    telemetry = Telemetry() if args.telemetry or args.prometheus else None
+    blank_index = BlankTileIndex(args.blank_index) if args.blank_index else None
+    hedger = Hedger(max_rate=args.hedge, telemetry=telemetry) if args.hedge else None
+    check_http2(args.engine)
+    concurrency = args.concurrency or DEFAULT_CONCURRENCY[args.engine]
+    progress_bar = ProgressBar()
+    try:
+        stats = download_batch(
+            args.source, jobs, progress_bar.print_progress, engine=args.engine,
+            concurrency=concurrency, cache=cache,
+            max_concurrency=args.max_concurrency or 4 * concurrency,
+            telemetry=telemetry, blank_index=blank_index, hedger=hedger,
+            cog=args.cog)
+    finally:
+        progress_bar.close()
+        if cache:
+            cache.close()
+        if blank_index:
+            blank_index.close()
+    print("%(jobs)d extents: %(requested)d tiles, %(fetched)d fetched, "
+          "%(saved)d fetches saved by dedup, %(known_blank)d known blank." % stats)
+    if args.telemetry:
+        telemetry.write_json(args.telemetry)
+    if args.prometheus:
+        telemetry.write_prometheus(args.prometheus)
+    return 0
+
+
+def main_export(argv):
+    parser = argparse.ArgumentParser(
+        prog="tms2geotiff.py export",
+        description="Write an extent of an MBTiles file as a GeoTIFF, COG or "
+        "image, without downloading anything.")
+    parser.add_argument("mbtiles", help="MBTiles file")
+    parser.add_argument("output", help="output image file")
+    parser.add_argument("-z", "--zoom", type=int,
+        help="zoom level (default: highest stored)")
+    parser.add_argument("-f", "--from", metavar='LAT,LON', help="one corner")
+    parser.add_argument("-t", "--to", metavar='LAT,LON', help="the other corner")
+    parser.add_argument("-e", "--extent",
+        metavar='min_lon,min_lat,max_lon,max_lat',
+        help="extent in one string (default: the bounds metadata)")
+    parser.add_argument("--cog", action='store_true',
+        help="save a .tif output as a Cloud-Optimized GeoTIFF with overviews")
+    parser.add_argument("--block-size", type=int, default=256, choices=(256, 512),
+        help="GeoTIFF block size of a streamed .tif (default 256)")
+    args = parser.parse_args(argv)
+    db = sqlite3.connect(
+        'file:%s?mode=ro' % urllib.parse.quote(os.path.abspath(args.mbtiles)),
+        uri=True)
+    zoom = args.zoom
+    if zoom is None:
+        zoom = db.execute("SELECT MAX(zoom_level) FROM tiles").fetchone()[0]
+    bounds = db.execute(
+        "SELECT value FROM metadata WHERE name='bounds'").fetchone()
+    db.close()
+    if zoom is None:
+        parser.error("no tiles in %s" % args.mbtiles)
+    if args.extent:
+        extent = parse_extent(args.extent)
+    elif getattr(args, 'from') and args.to:
+        extent = (tuple(map(float, getattr(args, 'from').split(','))) +
+                  tuple(map(float, args.to.split(','))))
+    elif bounds:
+        extent = parse_extent(bounds[0])
+    else:
+        parser.error("no bounds metadata, give an extent")
+    stream = (os.path.splitext(args.output)[1].lower() in ('.tif', '.tiff')
+              and not args.cog)
+
+    def print_rows(progress, total, done=False):
+        print("\rExported %d/%d tiles" % (progress, total),
+              end='\n' if progress == total else '', flush=True)
+
+    img, matrix = mbtiles_export(
+        args.mbtiles, *extent, zoom, progress_callback=print_rows,
+        stream_to=args.output if stream else None, block_size=args.block_size)
+    if not stream:
+        save_image_auto(img, args.output, matrix, cog=args.cog)
+    return 0
+
+
+def main_maintain(argv):
+    parser = argparse.ArgumentParser(
+        prog="tms2geotiff.py maintain",
+        description="Merge MBTiles files, prune them to an extent or zoom "
+        "range, deduplicate and compact them.")
+    parser.add_argument("mbtiles", help="MBTiles file to update (created if missing)")
+    parser.add_argument("--merge", nargs='+', default=(), metavar='FILE',
+        help="copy the tiles of these MBTiles files in; later files win")
+    parser.add_argument("-e", "--extent",
+        metavar='min_lon,min_lat,max_lon,max_lat',
+        help="delete the tiles not touching this extent")
+    parser.add_argument("--minzoom", type=int, help="delete lower zoom levels")
+    parser.add_argument("--maxzoom", type=int, help="delete higher zoom levels")
+    parser.add_argument("--dedup", action='store_true',
+        help="convert to deduplicated tile storage")
+    parser.add_argument("--no-vacuum", action='store_true',
+        help="skip the final VACUUM and ANALYZE")
+    args = parser.parse_args(argv)
+    bounds = None
+    if args.extent:
+        lat0, lon0, lat1, lon1 = parse_extent(args.extent)
+        bounds = (lon0, lat0, lon1, lat1)
+    stats = mbtiles_maintain(
+        args.mbtiles, args.merge, bounds, args.minzoom, args.maxzoom,
+        args.dedup, not args.no_vacuum)
+    print("Merged %(merged)d tiles, pruned %(pruned)d, %(tiles)d left." % stats)
+    return 0
+
+
+def main_serve(argv):
+    parser = argparse.ArgumentParser(
+        prog="tms2geotiff.py serve",
+        description="Serve /{z}/{x}/{y} tiles from MBTiles files.")
+    parser.add_argument("mbtiles", nargs='+', help="MBTiles files, first match wins")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument("--upstream", metavar='URL',
+        help="fetch tiles missing from the files from this tile server")
+    parser.add_argument("--cache-size", type=int, default=64, metavar='MB',
+        help="in-memory cache of hot tiles (default 64)")
+    parser.add_argument("--max-age", type=int, default=86400, metavar='SECONDS',
+        help="Cache-Control max-age sent with tiles (default 1 day)")
+    args = parser.parse_args(argv)
+    server = TileServer(args.mbtiles, args.host, args.port, args.upstream,
+                        args.cache_size*1024*1024, args.max_age)
+    print("Serving %s" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
+
+
+COMMANDS = {
+    'pyramid': main_pyramid,
+    'serve': main_serve,
+    'batch': main_batch,
+    'export': main_export,
+    'maintain': main_maintain,
+}
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        return COMMANDS[sys.argv[1]](sys.argv[2:])
     parser = argparse.ArgumentParser(
         description="Merge TMS tiles to a big image.",
-        epilog="If no parameters are specified, it will open the GUI.")
+        epilog="If no parameters are specified, it will open the GUI. "
+        "Other commands: %s (see COMMAND --help)." % ', '.join(COMMANDS))
     parser.add_argument(
         "-s", "--source", metavar='URL', default=DEFAULT_TMS,
-        help="TMS server url (default is OpenStreetMap: %s)" % DEFAULT_TMS)
+        help="TMS server url (default is OpenStreetMap: %s); besides {z} {x} "
+        "{y} it may use {q} (quadkey), {s} (subdomain) and {-y} (TMS row)"
+        % DEFAULT_TMS)
+    parser.add_argument("--subdomains", default='abc',
+        help="comma-separated hosts or letters for {s} (default: abc)")
+    parser.add_argument("--tms", action='store_true',
+        help="the server numbers rows from the south (flip {y})")
+    parser.add_argument("--wmts", metavar='LAYER', nargs='?', const='',
+        help="the source is a WMTS GetCapabilities URL; use this layer "
+        "(default: the first one)")
     parser.add_argument("-f", "--from", metavar='LAT,LON', help="one corner")
     parser.add_argument("-t", "--to", metavar='LAT,LON', help="the other corner")
     parser.add_argument("-e", "--extent",
         metavar='min_lon,min_lat,max_lon,max_lat',
         help="extent in one string (use either -e, or -f and -t)")
+    parser.add_argument("-a", "--area", metavar='GEOJSON',
+        help="only download tiles touching the polygons/lines in this GeoJSON "
+        "file, leaving the rest transparent (extent defaults to its bounds)")
+    parser.add_argument("-b", "--buffer", type=float, default=0, metavar='METRES',
+        help="corridor half-width around lines in --area (also grows polygons)")
     parser.add_argument("-z", "--zoom", type=int, help="zoom level")
     parser.add_argument("-m", "--mbtiles", help="save MBTiles file")
+    parser.add_argument("--dedup", action='store_true',
+        help="create the MBTiles file with deduplicated tile storage")
+    parser.add_argument("-r", "--resume", action='store_true',
+        help="only download tiles missing from the MBTiles file (needs -m)")
+    parser.add_argument("--stream", action='store_true',
+        help="write the output GeoTIFF block by block while downloading, "
+        "without holding the whole image in memory")
+    parser.add_argument("--cog", action='store_true',
+        help="save a .tif output as a Cloud-Optimized GeoTIFF with overviews")
+    parser.add_argument("--epsg", type=int, default=3857,
+        help="reproject a .tif output to this CRS (4326 is built in, others "
+        "need pyproj; default: 3857, no reprojection)")
+    parser.add_argument("--resampling", choices=('nearest', 'bilinear'),
+        default='bilinear', help="resampling for --epsg (default: bilinear)")
+    parser.add_argument("--block-size", type=int, default=256, choices=(256, 512),
+        help="GeoTIFF block size for --stream (default 256)")
+    parser.add_argument("--transcode-processes", type=int, metavar='N',
+        help="worker processes for re-encoding tiles whose format differs "
+        "from the MBTiles file (default: CPU count)")
+    parser.add_argument("--engine", choices=('thread', 'async'), default='thread',
+        help="tile fetch engine: a thread pool, or asyncio with HTTP/2 "
+        "(default: thread)")
+    parser.add_argument("-c", "--concurrency", type=int,
+        help="requests in flight per host (default: %s)" % ', '.join(
+            '%d for %s' % (v, k) for k, v in DEFAULT_CONCURRENCY.items()))
+    parser.add_argument("--max-concurrency", type=int, metavar='N',
+        help="let the requests in flight grow up to N while the server keeps "
+        "up, backing off on 429/503 and timeouts (default: 4x --concurrency)")
+    parser.add_argument("--cache", metavar='FILE',
+        help="keep downloaded tiles in this SQLite cache and reuse them")
+    parser.add_argument("--cache-size", type=int, default=1024, metavar='MB',
+        help="cache size budget in MB, least recently used tiles are evicted "
+        "(default 1024)")
+    parser.add_argument("--cache-ttl", type=float, default=7*86400, metavar='SECONDS',
+        help="revalidate cached tiles older than this (default 7 days)")
+    parser.add_argument("--blank-index", metavar='FILE',
+        help="skip tiles this SQLite index knows to be blank (404, empty or "
+        "transparent), and record new ones")
+    parser.add_argument("--blank-ttl", type=float, default=30*86400,
+        metavar='SECONDS', help="forget blank tiles after this (default 30 days)")
+    parser.add_argument("--max-memory", type=int, default=2048, metavar='MB',
+        help="with a .vrt output file, write GeoTIFF chunks of at most this "
+        "size and a .vrt index of them (default 2048)")
+    parser.add_argument("-p", "--processes", type=int, default=1,
+        help="download .vrt chunks in this many worker processes (default 1)")
+    parser.add_argument("--hedge", type=float, nargs='?', const=0.05,
+        metavar='RATE', help="send a duplicate of requests slower than "
+        "twice the running p95, to the next {s} host, for at most RATE of all "
+        "requests (default 0.05)")
+    parser.add_argument("--telemetry", metavar='FILE',
+        help="write per-stage timing percentiles, status codes, bytes and "
+        "retries of the run to this JSON file")
+    parser.add_argument("--prometheus", metavar='FILE',
+        help="also write them as a Prometheus textfile (.prom)")
     parser.add_argument("-g", "--gui", action='store_true', help="show GUI")
     parser.add_argument("output", nargs='?', help="output image file (can be omitted)")
     args = parser.parse_args()
@@ -655,10 +4489,21 @@ def main():
         # parser.print_help()
         return 1
 
-    download_args = [args.source]
+    subdomains = args.subdomains.split(',') if ',' in args.subdomains else args.subdomains
+    if args.wmts is not None:
+        source = wmts_source(args.source, args.wmts or None)
+    else:
+        source = TileSource(args.source, subdomains, args.tms)
+    download_args = [source]
+    area = None
+    if args.area:
+        with open(args.area, encoding='utf-8') as f:
+            area = json.load(f)
     try:
         if args.extent:
             download_args.extend(parse_extent(args.extent))
+        elif area is not None and not getattr(args, 'from'):
+            download_args.extend(area_extent(area, args.buffer))
         else:
             coords0 = tuple(map(float, getattr(args, 'from').split(',')))
             coords1 = tuple(map(float, getattr(args, 'to').split(',')))
@@ -671,14 +4516,90 @@ def main():
     download_args.append(bool(args.output))
     progress_bar = ProgressBar()
     download_args.append(progress_bar.print_progress)
-    img, matrix = download_extent(*download_args)
+    check_http2(args.engine)
+    concurrency = args.concurrency or DEFAULT_CONCURRENCY[args.engine]
+    kwargs = {'engine': args.engine, 'concurrency': concurrency,
+              'area': area, 'buffer': args.buffer,
+              'max_concurrency': args.max_concurrency or 4 * concurrency,
+              'dedup': args.dedup, 'transcode_processes': args.transcode_processes}
+    if args.resume:
+        if not args.mbtiles:
+            parser.error("--resume needs an MBTiles file (-m)")
+        kwargs['resume'] = True
+    if args.epsg != 3857 and not (args.output and os.path.splitext(
+            args.output)[1].lower().startswith('.tif')):
+        parser.error("--epsg needs a .tif/.tiff output file")
+    if args.stream and args.cog:
+        # the streaming writer has no overviews
+        parser.error("--stream can't be combined with --cog")
+    chunked = bool(args.output) and args.output.lower().endswith('.vrt')
+    if chunked:
+        if args.mbtiles or args.stream or args.epsg != 3857:
+            parser.error("chunked .vrt output can't be combined with -m, "
+                         "--stream or --epsg")
+        if args.processes > 1 and (args.hedge or args.telemetry or args.prometheus):
+            parser.error("--hedge, --telemetry and --prometheus need -p 1 "
+                         "with a .vrt output")
+    telemetry = None
+    if args.telemetry or args.prometheus:
+        telemetry = kwargs['telemetry'] = Telemetry()
+    hedger = None
+    if args.hedge:
+        hedger = kwargs['hedger'] = Hedger(max_rate=args.hedge, telemetry=telemetry)
+    if chunked:
+        del kwargs['dedup'], kwargs['transcode_processes']
+        download_chunked(
+            *download_args[:6], args.output, args.max_memory * 1024 * 1024,
+            args.processes, args.cache, progress_bar.print_progress,
+            cog=args.cog, blank_index_file=args.blank_index,
+            cache_bytes=args.cache_size*1024*1024, cache_ttl=args.cache_ttl,
+            blank_ttl=args.blank_ttl, **kwargs)
+        progress_bar.close()
+        print_run_report(hedger, telemetry, args.telemetry, args.prometheus)
+        return 0
+    cache = None
+    if args.cache:
+        cache = kwargs['cache'] = TileCache(
+            args.cache, args.cache_size*1024*1024, args.cache_ttl)
+    blank_index = None
+    if args.blank_index:
+        blank_index = kwargs['blank_index'] = BlankTileIndex(
+            args.blank_index, args.blank_ttl)
+    if args.stream:
+        if not args.output or not os.path.splitext(
+                args.output)[1].lower().startswith('.tif'):
+            parser.error("--stream needs a .tif/.tiff output file")
+        if args.epsg != 3857:
+            parser.error("--stream can't be combined with --epsg")
+        kwargs['stream_to'] = args.output
+        kwargs['block_size'] = args.block_size
+    elif numpy is not None:
+        # the savers take the mosaic array as is, without a full-size copy
+        kwargs['as_array'] = True
+    img, matrix = download_extent(*download_args, **kwargs)
     progress_bar.close()
-    if args.output:
+    if cache:
+        print("Tile cache: %(hits)d hits, %(revalidated)d revalidated, "
+              "%(misses)d misses" % cache.stats())
+        cache.close()
+    if blank_index:
+        blank_index.close()
+    start = time.perf_counter()
+    if args.output and not args.stream and args.epsg != 3857:
+        print("Reprojecting to EPSG:%d..." % args.epsg)
+        save_reprojected(img, args.output, matrix, args.epsg, args.resampling,
+                         cog=args.cog)
+    elif args.output and not args.stream:
         print("Saving image...")
-        save_image_auto(img, args.output, matrix)
+        save_image_auto(img, args.output, matrix, cog=args.cog)
+        rss = peak_rss()
+        if rss:
+            print("Peak memory: %.0f MB" % (rss / 1024 / 1024))
+    if telemetry is not None and args.output and not args.stream:
+        telemetry.record('save', time.perf_counter() - start)
+    print_run_report(hedger, telemetry, args.telemetry, args.prometheus)
     return 0
 
 
 if __name__ == '__main__':
-    import sys
     sys.exit(main())